@@ -11,16 +11,95 @@ You can also override things in local_config.py
 #
 items_file = 'doc/sample_items.json'
 
+# File to keep the items from items_file in once they have been loaded, so
+# that starting up is quicker next time (e.g. 'magic.items.cache'). It's
+# made again whenever items_file changes. None to always load items_file
+items_cache = None
+
+# Remove dependencies from new tasks that are implied by other dependencies
+# (e.g. those added to everything in a group). This makes tasks smaller and
+# quicker to work with, but items can then be ready to run while something they
+# originally depended on isn't complete, if that was set back to incomplete
+# after the items depending on it were completed
+reduce_dependencies = False
+
+
+# How to store information about tasks. One of:
+#	'mongodb':		MongoDB with a collection for each task
+#	'mongodb_shared':	MongoDB with all tasks in the same collections.
+#				Much better if you have lots of tasks
+#	'sqlite':		SQLite database file. Good for a single server
+#	'memory':		Keep everything in memory, with changes written to
+#				a journal file. Only for a single process
+#	'sharded':		Spread tasks over the stores in store_shards
+store = 'mongodb'
+
+# Stores to spread tasks over when store is 'sharded'. Each is a pair of a
+# name and a dict with 'store' set to one of the stores above, and the rest
+# being arguments for that store (e.g. server, port and database for mongodb,
+# path for sqlite, or journal for memory, which every memory shard must have
+# a different one of).  Tasks are placed by the name of the shard, so don't
+# rename shards once they have tasks in them
+store_shards = [
+#	('shard0', {'store': 'mongodb_shared', 'server': 'db0'}),
+#	('shard1', {'store': 'mongodb_shared', 'server': 'db1'}),
+]
+
+# SQLite database file to store information about tasks in
+sqlite_path = 'magic.sqlite'
+
+# Journal file for the memory store (None to not keep tasks at all), how many
+# changes to write out at once, how long to wait (in seconds) before writing them
+# anyway, and after how many changes to rewrite the journal to save space
+memory_journal = 'magic.journal'
+memory_journal_sync_batch = 100
+memory_journal_sync_interval = 1.0
+memory_journal_compact_every = 100000
+
+# How many connections to the store the web server can have at once, and how
+# long (in seconds) to wait for one to be free before giving up on a request
+store_pool_size = 10
+store_pool_timeout = 30
 
 # MongoDB database to store information about tasks in
 mongodb_server = 'localhost'
 mongodb_port = 27017
 mongodb_database = 'magic' 
+# Most changes to keep in the log for each task. They are kept in the task's
+# metadata, which mongodb won't let grow past 16MB
+mongodb_max_changes = 1000
+
+# How many tasks to keep loaded in memory for working out what's ready
+# to run, and roughly how many bytes they can use between them
+task_cache_entries = 1000
+task_cache_size = 256*1024*1024
 
 # Where the webserver should listen
 httpd_listen_address = '127.0.0.1'
 httpd_listen_port = 4554
 
+# How the webserver turns things into JSON. One of:
+#	'json':		the standard library json module
+#	'simplejson':	simplejson, which is faster if it's C extension is built
+#	'ujson':	ultrajson, which is faster still
+httpd_json_encoder = 'json'
+
+# Longest time (in seconds) that the webserver will wait for items to become
+# available when asked to, and how often to send something to clients
+# listening for events so that they know we're still here
+httpd_max_wait = 60
+httpd_events_keepalive = 15
+
+# Most requests that can be waiting (for items to become available, or for
+# events) at once.  Each one holds one of cherrypy's threads (of which there are
+# 10 unless server.thread_pool is set), so keep this below that to leave some for
+# everything else.  Waits above this are answered straight away, and listening
+# for events gets a 503 (Service Unavailable).  magic_gevent.py has no limit
+httpd_max_waiters = 5
+
+# Most connections to handle at once when running with magic_gevent.py
+httpd_gevent_max_connections = 10000
+
 
 # Attempt to import a local config to override stuff
 try:
@@ -1,16 +1,40 @@
 #! /usr/bin/env python
 
+import sys
+from array import array
 from uuid import uuid4
 
 class Scheme(object):
 	def __init__(self, items):
 		self.items = items
 
+class ItemType(type):
+	'''metaclass for items that lets classes and their instances have different depends
+
+	Item instances keep their dependencies in a slot rather than a dict, and
+	a slot can't have the same name as a class attribute.  The depends given
+	for a class are kept in class_depends instead, and are what you get (or
+	set) with cls.depends.  Instances start off with the class's depends.
+	'''
+	def __new__(mcs, name, bases, attrs):
+		if 'depends' in attrs:
+			attrs = dict(attrs)
+			attrs['class_depends'] = attrs.pop('depends')
+		return type.__new__(mcs, name, bases, attrs)
+
+	def _get_depends(cls): return cls.class_depends
+	def _set_depends(cls, depends): cls.class_depends = depends
+	depends = property(_get_depends, _set_depends)
+
 class BaseItem(object):
+	__metaclass__ = ItemType
+	__slots__ = ('depends',)
 	description = ""
 	depends = ()
 	predicate = lambda task: True
 	name = property(lambda self: self.__class__.__name__)
+	def __init__(self):
+		self.depends = self.__class__.depends
 	def __repr__(self):
 		return '<'+self.name+'('+self.__class__.__bases__[0].__name__+') instance>'
 
@@ -22,7 +46,9 @@ class Item(BaseItem):
 	COMPLETE = 'COMPLETE'
 
 	allowed_states = set((INCOMPLETE,FAILED,IN_PROGRESS,CANNOT_AUTOMATE,COMPLETE))
+	__slots__ = ('data',)
 	def __init__(self, data=None):
+		BaseItem.__init__(self)
 		if data == None:
 			data = dict(state=self.INCOMPLETE)
 		self.data = data
@@ -31,14 +57,16 @@ class Item(BaseItem):
 
 class TaskComplete(Item):
 	'''sentinal task that contains all items required for completion'''
+	__slots__ = ()
 	def __init__(self, goals=None, data=None):
+		Item.__init__(self,data)
 		if goals != None:
 			self.depends = tuple(goals)
 		if len(self.depends) == 0:
 			raise ValueError('MUST provide goals to create TaskComplete')
-		Item.__init__(self,data)
 
 class DataItem(Item):
+	__slots__ = ()
 	def __init__(self):
 		Item.__init__(self)
 		self.data = None
@@ -85,3 +113,62 @@ class Task(object):
 		self.goal = goal
 	def __repr__(self):
 		return "Task(uuid='%s')" % (self.uuid,)
+
+class CompactTask(object):
+	'''a task with it's items packed into arrays, for tasks with a lot of items
+
+	Every item is an object with a dict and a class of it's own in a Task,
+	which adds up for big tasks. Here items are just ids instead: names[i] is
+	the name of item i, the ids of the items it depends on are
+	depends[depends_start[i]:depends_start[i+1]], and states[i] is where it's
+	state is in state_codes. Nothing else about the items is kept.
+	'''
+	state_codes = (Item.INCOMPLETE, Item.FAILED, Item.IN_PROGRESS, Item.CANNOT_AUTOMATE, Item.COMPLETE)
+	state_code = dict((state,code) for code,state in enumerate(state_codes))
+
+	def __init__(self, names, depends, states, requirements, uuid=None, data=None):
+		'''names, depends and states are lists with the name, the ids of the dependencies,
+		and the state of each item. One item must be called TaskComplete
+		'''
+		if uuid == None:
+			uuid = str(uuid4())
+		if data == None:
+			data = dict()
+		self.uuid, self.requirements, self.data = uuid, requirements, data
+		self.names = [intern(str(name)) for name in names]
+		self.ids = dict((name,i) for i,name in enumerate(self.names))
+		self.depends, self.depends_start = array('i'), array('i', [0])
+		for deps in depends:
+			self.depends.extend(deps)
+			self.depends_start.append(len(self.depends))
+		self.states = bytearray(self.state_code[state] for state in states)
+		self.goal = self.ids['TaskComplete']
+
+	@classmethod
+	def from_task(cls, task):
+		'''return a CompactTask for a Task'''
+		items = list(task.items)
+		position = dict((item,pos) for pos,item in enumerate(items))
+		return cls([item.name for item in items], [[position[dep] for dep in item.depends] for item in items],
+				[item.data['state'] for item in items], task.requirements, task.uuid, task.data)
+
+	def __len__(self):
+		return len(self.names)
+
+	def item_depends(self, i):
+		'''return the ids of the items that item i depends on'''
+		return self.depends[self.depends_start[i]:self.depends_start[i+1]]
+
+	def state(self, name):
+		return self.state_codes[self.states[self.ids[name]]]
+
+	def set_state(self, name, state):
+		'''raises KeyError if there is no such item or state'''
+		self.states[self.ids[name]] = self.state_code[state]
+
+	def sizeof(self):
+		'''return roughly how many bytes the task is using'''
+		size = sys.getsizeof(self.depends) + sys.getsizeof(self.depends_start) + sys.getsizeof(self.states)
+		# Each name is in the list of names and in ids
+		size += sys.getsizeof(self.names) + sys.getsizeof(self.ids)
+		return size + sum(sys.getsizeof(name) for name in self.names)
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+'''simple in-process caches
+
+Loading things back out of the store and turning them into objects
+is expensive, and most of the time we're asked about the same few
+things over and over again.
+'''
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+	'''bounded least recently used cache
+
+	The cache is bounded by both the number of entries, and an estimate
+	of the memory used by the entries as given by the sizeof callable.
+	Either limit can be None for no limit. When adding an entry takes
+	the cache over either limit, the least recently used entries are
+	thrown away until it fits again.
+	'''
+	def __init__(self, max_entries=None, max_size=None, sizeof=None):
+		self.max_entries, self.max_size = max_entries, max_size
+		self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+		self.entries = OrderedDict()
+		self.sizes = dict()
+		self.size = 0
+		self.hits = self.misses = self.evictions = 0
+		self.lock = threading.RLock()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key, default=None):
+		'''return the value for key, marking it as recently used'''
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return default
+			self.hits += 1
+			value = self.entries.pop(key)
+			self.entries[key] = value
+			return value
+
+	def peek(self, key, default=None):
+		'''return the value for key without counting it as a use'''
+		with self.lock:
+			return self.entries.get(key, default)
+
+	def set(self, key, value):
+		'''add an entry to the cache, evicting old entries if needed'''
+		with self.lock:
+			self.pop(key)
+			self.entries[key] = value
+			self.sizes[key] = self.sizeof(value)
+			self.size += self.sizes[key]
+			self._evict()
+
+	def pop(self, key, default=None):
+		'''remove an entry from the cache and return it'''
+		with self.lock:
+			if key not in self.entries:
+				return default
+			self.size -= self.sizes.pop(key)
+			return self.entries.pop(key)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.sizes.clear()
+			self.size = 0
+
+	def _over_limit(self):
+		if self.max_entries is not None and len(self.entries) > self.max_entries:
+			return True
+		return self.max_size is not None and self.size > self.max_size
+
+	def _evict(self):
+		while len(self.entries) and self._over_limit():
+			key = next(iter(self.entries))
+			self.pop(key)
+			self.evictions += 1
+
+	def stats(self):
+		'''return a dict of counters about how well the cache is working'''
+		with self.lock:
+			return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+					entries=len(self.entries), size=self.size,
+					max_entries=self.max_entries, max_size=self.max_size)
@@ -2,13 +2,59 @@
 from collections import deque,defaultdict
 from itertools import ifilter
 import digraphtools
+try: import numpy
+except ImportError: numpy = None	# CompactDependencyStrategy manages without it
 
 from core.bits import Item,Group
+from core.marshal import StringPredicate
 
 def unbound(func):
 	'''always return the underlying function from a bound method'''
 	return getattr(func, 'im_func', func)
 
+def postorder(node, children, seen=None):
+	'''iterate depth first over node and everything under it, with every node after it's children
+
+	children(node) returns the nodes under a node. Nodes already in seen
+	(which is added to as we go) are skipped, along with everything under them.
+	Uses a stack of it's own rather than recursion, so that there is no
+	limit to how deep it can go.
+	'''
+	if seen is None: seen = set()
+	if node in seen: return
+	seen.add(node)
+	stack = [(node, iter(children(node)))]
+	while stack:
+		node, under = stack[-1]
+		for child in under:
+			if child not in seen:
+				seen.add(child)
+				stack.append((child, iter(children(child))))
+				break
+		else:
+			stack.pop()
+			yield node
+
+def predicate_evaluator(requirements):
+	'''return a function that returns whether an item's predicate is true for requirements
+
+	The requirements are made into a frozenset (if they can be) so that
+	looking things up in them is quick, and each distinct predicate is only
+	evaluated once however many items share it.
+	'''
+	try: requirements = frozenset(requirements)
+	except TypeError: pass
+	results = dict()
+	def evaluate(item):
+		pred = unbound(item.predicate)
+		# Predicates made from equivalent strings share what they evaluate
+		if isinstance(pred, StringPredicate):
+			pred = pred.func
+		if pred not in results:
+			results[pred] = pred(requirements)
+		return results[pred]
+	return evaluate
+
 class BaseDependencyStrategy:
 	'''Base class for strategies for dependency resolution'''
 	@classmethod
@@ -75,24 +121,13 @@ class SimpleDependencyStrategy(BaseDependencyStrategy):
 			- doing a post-order traversal to maintain the invaraint that a node's
 			  dependencies preceed it in the traversal.
 		'''
-		if seen is None: seen = set()
-		if item in seen: raise StopIteration
-		seen.add(item)
-		filtereddeps = ifilter(lambda i: unbound(i.predicate)(requirements), item.depends)
-		for dep in filtereddeps:
-			for cdep in cls.iterate_pruned_item_dependencies(requirements,dep,seen):
-				yield cdep
-		yield item
+		keep = predicate_evaluator(requirements)
+		filtereddeps = lambda item: ifilter(keep, item.depends)
+		return postorder(item, filtereddeps, seen)
 
 	@classmethod
 	def iterate_item_dependencies(cls, item, seen=None):
-		if seen is None: seen = set()
-		if item in seen: raise StopIteration
-		seen.add(item)
-		for dep in item.depends:
-			for cdep in cls.iterate_item_dependencies(dep,seen):
-				yield cdep
-		yield item
+		return postorder(item, lambda item: item.depends, seen)
 
 	@classmethod
 	def early_iter_all_items(cls, item, seen=None):
@@ -100,17 +135,11 @@ class SimpleDependencyStrategy(BaseDependencyStrategy):
 		before groups are unrolled into soemthing that can be represented by a digraph we
 		need a way of getting all items, including traversing group contents
 		'''
-		if seen is None: seen = set()
-		if item in seen: raise StopIteration
-		seen.add(item)
-		for dep in item.depends:
-			for cdep in cls.early_iter_all_items(dep,seen):
-				yield cdep
-		if isinstance(item,Group) or type(item) == type and issubclass(item,Group):
-			for member in item.contains:
-				for cdep in cls.early_iter_all_items(member,seen):
-					yield cdep
-		yield item
+		def deps_and_contents(item):
+			if isinstance(item,Group) or isinstance(item,type) and issubclass(item,Group):
+				return item.depends + tuple(item.contains)
+			return item.depends
+		return postorder(item, deps_and_contents, seen)
 
 	@classmethod
 	def filter_dependency_graph(cls, requirements, items):
@@ -118,7 +147,7 @@ class SimpleDependencyStrategy(BaseDependencyStrategy):
 		It's highly recommended you only do this on item instances and not classes as
 		it alters or the depends attribute on all items in the supplied DAG '''
 
-		keptitems = set(filter(lambda i: unbound(i.predicate)(requirements), items))
+		keptitems = set(filter(predicate_evaluator(requirements), items))
 		droppeditems = set(items).difference(keptitems)
 
 		for survivor in keptitems:
@@ -168,70 +197,150 @@ class SimpleDependencyStrategy(BaseDependencyStrategy):
 		assert item in items
 		return item
 
+	@classmethod
+	def groups_innermost_first(cls, groups):
+		'''return groups in an order where every group comes after all the groups it contains'''
+		order, seen = [], set()
+		for outer in groups:
+			if outer in seen: continue
+			seen.add(outer)
+			stack = [(outer, iter(outer.contains))]
+			while stack:
+				group, contents = stack[-1]
+				for k in contents:
+					if k in groups and k not in seen:
+						seen.add(k)
+						stack.append((k, iter(k.contains)))
+						break
+				else:
+					stack.pop()
+					order.append(group)
+		return order
+
 	@classmethod
 	def make_group_dependencies_explicit_for_items(cls, items):
+		'''give items the dependencies of all the groups they are in, and replace
+		dependencies on groups with dependencies on everything in them
+
+		returns the items that aren't groups. The contains attribute of groups is
+		replaced with a set of all the items in the group, at any depth.
+
+		Each group is only looked at once, rather than once for every group it's
+		in: Going from the innermost groups out, the items in each group are those
+		it contains plus the items of the groups it contains. Going from the
+		outermost groups in, the dependencies inherited by each group are it's own
+		plus those inherited by the groups containing it.
+		'''
 		allitems = items
-		items = set(k for k in allitems if isinstance(k,Item) or type(k) == type and issubclass(k,Item))
-		groups = set(k for k in allitems if isinstance(k,Group) or type(k) == type and issubclass(k,Group))
-		origitems,origgroups = set(items),set(groups)	# For later testing
+		items = set(k for k in allitems if isinstance(k,Item) or isinstance(k,type) and issubclass(k,Item))
+		groups = set(k for k in allitems if isinstance(k,Group) or isinstance(k,type) and issubclass(k,Group))
 		assert allitems == items.union(groups)
 		assert items.isdisjoint(groups)
 
-		contained_by = defaultdict(set)
-
-		# First find out what groups an item is contained by
-		def iter_group_contents(group):
+		order = cls.groups_innermost_first(groups)
+		members = dict()
+		for group in order:
+			members[group] = set()
 			for k in group.contains:
-				if k in groups: 
-					for kk in iter_group_contents(k): yield kk
-				else: yield k
-		for group in groups:
-			for k in iter_group_contents(group):
-				contained_by[k].add(group)
+				if k in groups: members[group].update(members[k])
+				else: members[group].add(k)
+		inherited = dict((group, set(group.depends)) for group in groups)
+		for group in reversed(order):
+			for k in group.contains:
+				if k in groups: inherited[k].update(inherited[group])
 
 		# Item dependencies are the explicit dependencies of the items themselves
 		# plus the dependencies of the groups they are contained by
-		for item,ingroups in contained_by.items(): 
-			assert ingroups.issubset(groups)
-			new_deps = set(item.depends)
-			for g in ingroups:
-				new_deps.update(g.depends)
-			item.depends = tuple(new_deps)
-
-		# Now the dependencies of the items inside groups are unrolled, reduce any
-		# references of groups to the contents of the groups
+		new_deps = defaultdict(set)
+		for group in groups:
+			for k in group.contains:
+				if k not in groups: new_deps[k].update(inherited[group])
+		for item,deps in new_deps.items():
+			deps.update(item.depends)
+			item.depends = tuple(deps)
 
-		# First do the group contents themselves recursively, and store as sets
+		# Now reduce any references to groups to the contents of the groups
 		for group in groups:
-			group.contains = set(group.contains)
-			while not group.contains.isdisjoint(groups):
-				for containedgroup in group.contains.intersection(groups):
-					assert containedgroup != group
-					group.contains.update(containedgroup.contains)
-					group.contains.remove(containedgroup)
-
-		# Now that for group.contains has been reduced to non-group items,
-		# replace any reference to groups in the dependencies of any item with
-		# the contents of that group
-		for item in items.difference(groups):
-			assert item not in groups
+			group.contains = members[group]
+		for item in items:
 			if not groups.isdisjoint(item.depends):
 				item.depends = set(item.depends)
 				for groupdep in item.depends.intersection(groups):
-					item.depends.update(groupdep.contains)
+					item.depends.update(members[groupdep])
 					item.depends.remove(groupdep)
 				item.depends = tuple(item.depends)
 			assert groups.isdisjoint(item.depends)
 
-		assert items == origitems
-		assert groups == origgroups
-		assert allitems == items.union(groups)
-		assert items.isdisjoint(groups)
-		assert items == allitems.difference(groups)
-
 		return items
 
 
+	@classmethod
+	def dependency_order(cls, items, depends=None):
+		'''return items in an order where every item comes after all of it's dependencies
+		depends(item) returns the dependencies of an item, defaulting to item.depends
+		raises ValueError if the dependencies have a cycle
+		'''
+		if depends is None: depends = lambda item: item.depends
+		waiting = dict((item, len(depends(item))) for item in items)
+		dependents = defaultdict(list)
+		for item in items:
+			for dep in depends(item):
+				dependents[dep].append(item)
+		order = [item for item in items if waiting[item] == 0]
+		for item in order:
+			for dependent in dependents[item]:
+				waiting[dependent] -= 1
+				if waiting[dependent] == 0:
+					order.append(dependent)
+		if len(order) != len(waiting):
+			raise ValueError('dependencies have a cycle')
+		return order
+
+	@classmethod
+	def transitive_reduction(cls, items):
+		'''remove dependencies INPLACE that are already implied by other dependencies
+
+		If a depends on b and c, and b depends on c, a doesn't need to depend
+		on c directly.  Every item can still reach all the same items through
+		it's dependencies, and the dependencies that are left stay in the same order.
+
+		Be aware that this is only the same as far as ready_to_run is concerned
+		if items are never complete when their dependencies aren't.
+
+		returns the number of dependencies before and after
+		'''
+		order = cls.dependency_order(items)
+		position = dict((item, pos) for pos,item in enumerate(order))
+		reachable = dict()	# item -> bitset of every item it depends on, directly or not
+		# Bitsets are thrown away once everything that depends on an item has been
+		# done, otherwise long chains would keep one for every item in the chain
+		dependents = defaultdict(int)
+		for item in order:
+			for dep in item.depends:
+				dependents[dep] += 1
+		before = after = 0
+		for item in order:
+			# Dependencies later in the order can't be reached from earlier ones, so
+			# going latest first we know about anything that reaches a dependency by
+			# the time we get to it
+			covered, keep = 0, set()
+			for dep in sorted(item.depends, key=position.get, reverse=True):
+				bit = 1 << position[dep]
+				if not covered & bit:
+					keep.add(dep)
+					covered |= reachable[dep] | bit
+			for dep in item.depends:
+				dependents[dep] -= 1
+				if not dependents[dep]:
+					del reachable[dep]
+			if dependents[item]:
+				reachable[item] = covered
+			before += len(item.depends)
+			after += len(keep)
+			if len(keep) != len(item.depends):
+				item.depends = tuple(dep for dep in item.depends if dep in keep)
+		return before, after
+
 not_none = lambda n: n is not None
 
 class GraphDependencyStrategy(SimpleDependencyStrategy):
@@ -252,29 +361,27 @@ class GraphDependencyStrategy(SimpleDependencyStrategy):
 		'''return a DAG from a base item and a set of requirements
 		items are pruned from the graph if their predicates are false for the requirements
 		'''
-		if seen is None: seen = dict()
-		if item in seen: return seen[item]
-		branches = []
-		seen[item] = [item, branches]
-		for dep in item.depends:
-			branch = cls.get_graph(dep, seen)
-			if branch: 
-				branches.append(branch)
-		return seen[item]
+		return cls.get_pruned_graph(None, item, seen, lambda i: True)
 
 	@classmethod
-	def get_pruned_graph(cls, requirements, item, seen=None):
+	def get_pruned_graph(cls, requirements, item, seen=None, keep=None):
 		'''return a DAG from a base item and a set of requirements
 		items are pruned from the graph if their predicates are false for the requirements
+		(or if keep(item) is false, if it's given)
 		'''
+		if keep is None: keep = predicate_evaluator(requirements)
 		if seen is None: seen = dict()
 		if item in seen: return seen[item]
-		branches = []
-		seen[item] = [item, branches]
-		for dep in filter(lambda i: unbound(i.predicate)(requirements), item.depends):
-			branch = cls.get_pruned_graph(requirements, dep, seen)
-			if branch: 
-				branches.append(branch)
+		seen[item] = [item, []]
+		tovisit = [item]
+		while tovisit:
+			node = tovisit.pop()
+			branches = seen[node][1]
+			for dep in filter(keep, node.depends):
+				if dep not in seen:
+					seen[dep] = [dep, []]
+					tovisit.append(dep)
+				branches.append(seen[dep])
 		return seen[item]
 
 	@classmethod
@@ -284,16 +391,36 @@ class GraphDependencyStrategy(SimpleDependencyStrategy):
 		if seen is None: seen=set()
 		if node in seen: return None
 		seen.add(node)
-		connected = [cls.tree_from_graph(sub,seen) for sub in connected]
-		return [ node,filter(not_none,connected) ]
+		tree = [node, []]
+		stack = [(tree, iter(connected))]
+		while stack:
+			branch, connected = stack[-1]
+			for subnode,subconnected in connected:
+				if subnode not in seen:
+					seen.add(subnode)
+					subtree = [subnode, []]
+					branch[1].append(subtree)
+					stack.append((subtree, iter(subconnected)))
+					break
+			else:
+				stack.pop()
+		return tree
 
 
 	@classmethod
 	def postorder_traversal(cls, tree):
 		'''traverse tree post-order and return a list of nodes'''
-		root,branches = tree
-		ret = map(cls.postorder_traversal,branches)
-		return sum(ret,[]) + [root]
+		order = []
+		stack = [(tree[0], iter(tree[1]))]
+		while stack:
+			root, branches = stack[-1]
+			for node,subbranches in branches:
+				stack.append((node, iter(subbranches)))
+				break
+			else:
+				stack.pop()
+				order.append(root)
+		return order
 		
 	@classmethod
 	def iterate_pruned_item_dependencies(cls, requirements, item):
@@ -311,11 +438,14 @@ class DigraphDependencyStrategy(SimpleDependencyStrategy):
 	def edges_from_item_deps(cls, item):
 		'''iterates over dependency edges with transiability from item'''
 		tovisit = deque([item])
+		seen = set(tovisit)
 		while len(tovisit):
 			item = tovisit.pop()
 			for dep in item.depends:
 				yield (item,dep)
-			tovisit.extendleft(item.depends)
+				if dep not in seen:
+					seen.add(dep)
+					tovisit.appendleft(dep)
 
 	@classmethod
 	def graph_from_item_deps(cls, item):
@@ -324,7 +454,8 @@ class DigraphDependencyStrategy(SimpleDependencyStrategy):
 	@classmethod
 	def iterate_item_dependencies(cls, item):
 		g = cls.graph_from_item_deps(item)
-		return digraphtools.dfs_topsort_traversal(g, item)
+		# Same order as digraphtools.dfs_topsort_traversal, without walking every path through the graph
+		return postorder(item, lambda node: g.get(node, ()))
 
 	@classmethod
 	def graph_from_items(cls, items):
@@ -337,9 +468,9 @@ class DigraphDependencyStrategy(SimpleDependencyStrategy):
 	@classmethod
 	def find_goal_nodes(cls, items):
 		'''return the set of all nodes that aren't depended on'''
-		graph = cls.graph_from_items(items)
-		start_nodes,dependencies = zip(*list(digraphtools.iter_edges(graph)))
-		return set(start_nodes).difference(dependencies)
+		# Items with no dependencies that nothing depends on are goals too
+		dependencies = set(dep for item in items for dep in item.depends)
+		return set(items).difference(dependencies)
 
 	@classmethod
 	def needed_dependencies(cls, graph, item):
@@ -353,16 +484,93 @@ class DigraphDependencyStrategy(SimpleDependencyStrategy):
 		incomplete =  [item for item in items if item.data['state'] == item.INCOMPLETE]
 		return [item for item in incomplete if len(cls.needed_dependencies(graph,item)) == 0]
 
-class DeprecatedDependencyMagic(object):
-	#TODO: Figure out the object structure for *Magic. Likely it shouldn't even be in this module
-	def __init__(self, strategy=DigraphDependencyStrategy):
-		self.strategy = strategy
-	def make_new_dep_graph(self, goal_node):
-		goal_node = self.strategy.item_factory(goal_node)
-		self.strategy.make_group_dependencies_explicit(goal_node)
-		return goal_node
-	def item_list_for_task(self, task):
-		# FIXME: Doesn't look at all goal nodes. If we want only 1 goal node we should enforce it
-		goal = self.make_new_dep_graph(task.will[0])
-		goal = self.strategy.filter_dependency_graph(task.wants, goal)
-		return self.strategy.iterate_item_dependencies(goal)
+class CompactDependencyStrategy(object):
+	'''work out the goals and what's ready to run for a core.bits.CompactTask
+
+	Everything is done for the whole task at once over the arrays in the task,
+	using numpy if it's installed.  Items are ids rather than objects.
+	'''
+	use_numpy = numpy is not None
+
+	@classmethod
+	def find_goal_nodes(cls, task):
+		'''return the set of ids of items that nothing depends on'''
+		if cls.use_numpy:
+			depended = numpy.zeros(len(task), dtype=bool)
+			depended[numpy.frombuffer(task.depends, dtype=task.depends.typecode)] = True
+			return set(numpy.flatnonzero(~depended).tolist())
+		depended = bytearray(len(task))
+		for dep in task.depends:
+			depended[dep] = 1
+		return set(i for i,isdep in enumerate(depended) if not isdep)
+
+	@classmethod
+	def ready_to_run(cls, task):
+		'''return a sorted list of ids of incomplete items with no incomplete dependencies'''
+		complete = task.state_code[Item.COMPLETE]
+		incomplete = task.state_code[Item.INCOMPLETE]
+		if cls.use_numpy:
+			states = numpy.frombuffer(task.states, dtype=numpy.uint8)
+			start = numpy.frombuffer(task.depends_start, dtype=task.depends_start.typecode)
+			# How many incomplete dependencies there are up to each point in depends
+			waiting = numpy.zeros(len(task.depends)+1, dtype=numpy.int32)
+			numpy.cumsum(states[numpy.frombuffer(task.depends, dtype=task.depends.typecode)] != complete, out=waiting[1:])
+			blocked = waiting[start[1:]] - waiting[start[:-1]]
+			return numpy.flatnonzero((states == incomplete) & (blocked == 0)).tolist()
+		states, depends, start = task.states, task.depends, task.depends_start
+		return [i for i in xrange(len(states)) if states[i] == incomplete and
+				all(states[dep] == complete for dep in depends[start[i]:start[i+1]])]
+
+class TaskDependencyManager(object):
+	'''keep track of which items in a task are ready to run
+
+	Rather than building a graph of the whole task every time we want to know
+	what can be run, keep a count of incomplete dependencies for every item and
+	an index of which items depend on it.  When an item changes state, only the
+	items that depend on it have to be looked at.
+
+	The manager only knows about state changes that are passed to update_item.
+	If anything else changes the items in the task, throw the manager away and
+	make a new one.  version is for the owner to keep track of which version
+	of the stored task the manager is up to date with.
+	'''
+	def __init__(self, task, version=None):
+		self.task = task
+		self.version = version
+		self.item_by_name = dict((item.name,item) for item in task.items)
+		self.position = dict((item,pos) for pos,item in enumerate(task.items))
+		self.dependents = defaultdict(list)
+		self.waiting_on = dict()
+		self.ready = set()
+		for item in task.items:
+			for dep in item.depends:
+				self.dependents[dep].append(item)
+			self.waiting_on[item] = len([dep for dep in item.depends if not dep.isComplete()])
+		for item in task.items:
+			self._check_ready(item)
+
+	def _check_ready(self, item):
+		if item.data['state'] == item.INCOMPLETE and self.waiting_on[item] == 0:
+			self.ready.add(item)
+		else:
+			self.ready.discard(item)
+
+	def update_item(self, name, data):
+		'''replace the data for an item, updating the items that depend on it
+		raises KeyError if the item is not in the task
+		'''
+		item = self.item_by_name[name]
+		was_complete = item.isComplete()
+		item.data = data
+		if item.isComplete() != was_complete:
+			change = -1 if item.isComplete() else 1
+			for dependent in self.dependents[item]:
+				self.waiting_on[dependent] += change
+				self._check_ready(dependent)
+		self._check_ready(item)
+
+	def ready_to_run(self):
+		'''return items that are incomplete who have no uncompleted dependencies
+		items are returned in the same order they are in the task
+		'''
+		return sorted(self.ready, key=self.position.get)
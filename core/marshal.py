@@ -71,7 +71,25 @@ write predicates in pure python, the whole system has to be usable
 by someone that doesn't know a line of python.
 '''
 import core.bits
-from digraphtools.predicate import PredicateContainsFactory
+from digraphtools.predicate import PredicateContainsFactory, predicate
+
+# Predicates that have already been made, by the string they were made from,
+# and the parsed predicates they share, by their normalised string.  Item files
+# tend to use the same few predicates over and over, and equivalent predicates
+# sharing what they evaluate lets them be evaluated once for all of them
+predicate_cache = dict()
+parsed_predicates = dict()
+
+class StringPredicate(predicate):
+	'''a predicate made from a string, which it keeps so that it can be turned
+	back into exactly the same string
+
+	func is the parsed predicate, which is shared with all the predicates made
+	from equivalent strings
+	'''
+	def __init__(self, string, parsed):
+		predicate.__init__(self, parsed)
+		self._predicate_string = string
 
 class ItemConverter(object):
 	'''Convert items to and from Item objects
@@ -87,12 +105,25 @@ class ItemConverter(object):
 			name = '_'+name
 		return name
 
+	def normalise_predicate_string(self, predicate):
+		'''return a predicate string with the whitespace between tokens made the same'''
+		tokens = PredicateContainsFactory().lex(predicate)
+		return ' '.join(getattr(tok, 'data', tok) for tok in tokens)
+
 	def predicate_string_to_callable(self, predicate):
-		'''turn a predicate into a callable'''
-		pf = PredicateContainsFactory()
-		pred = pf.predicate_from_string(predicate)
-		pred._predicate_string = predicate  # Save for marshalling back the other way
-		return pred
+		'''turn a predicate into a callable
+		callables made from equivalent predicate strings share the parsed predicate
+		'''
+		pred = predicate_cache.get(predicate)
+		if pred is not None:
+			return pred
+		normalised = self.normalise_predicate_string(predicate)
+		parsed = parsed_predicates.get(normalised)
+		if parsed is None:
+			pf = PredicateContainsFactory()
+			parsed = parsed_predicates.setdefault(normalised, pf.predicate_from_string(normalised))
+		# Save the string as it was for marshalling back the other way
+		return predicate_cache.setdefault(predicate, StringPredicate(predicate, parsed))
 
 	def predicate_callable_to_string(self, predicate):
 		'''turn a predicate into a callable'''
@@ -111,7 +142,7 @@ class ItemConverter(object):
 		if itemdict.has_key('depends'): attrs['depends'] = tuple(itemdict['depends'])
 		if itemdict.has_key('description'): attrs['description'] = itemdict['description']
 		if itemdict.has_key('if'): attrs['predicate'] = self.predicate_string_to_callable(itemdict['if'])
-		return type.__new__(type, name, (core.bits.Group,), attrs)
+		return core.bits.ItemType(name, (core.bits.Group,), attrs)
 		
 	def itemdict_to_item_class(self, itemdict):
 		'''return an Item subclass from an item dict datastructure
@@ -127,11 +158,11 @@ class ItemConverter(object):
 			itemsuper = core.bits.TaskComplete
 		else:
 			itemsuper = core.bits.Item
-		attrs = dict()
+		attrs = dict(__slots__=())	# Item instances don't need a dict of their own
 		if itemdict.has_key('depends'): attrs['depends'] = tuple(itemdict['depends'])
 		if itemdict.has_key('description'): attrs['description'] = itemdict['description']
 		if itemdict.has_key('if'): attrs['predicate'] = self.predicate_string_to_callable(itemdict['if'])
-		return type.__new__(type, name, (itemsuper,), attrs)
+		return core.bits.ItemType(name, (itemsuper,), attrs)
 
 	def itemdict_to_item_instance(self, itemdict):
 		cl = self.itemdict_to_item_class(itemdict)
@@ -165,14 +196,40 @@ class ItemConverter(object):
 		return itemdict
 
 class TaskConverter(ItemConverter):
+	'''Convert tasks to and from Task objects
+
+	Making a class for every item is slow, so items are made from the item
+	classes we were given (normally those of the TaskFactory) where there is
+	one with the same name and description. Classes made for anything else
+	are kept for next time.
+	'''
+	def __init__(self, classes=()):
+		self.classes = dict()
+		for cls in classes:
+			if not issubclass(cls, core.bits.Group):
+				self.classes[(cls.__name__, cls.description)] = cls
+
+	def item_class(self, itemdict):
+		'''return the class for an item in a task'''
+		key = (self.normalise_item_name(itemdict['name']), itemdict.get('description', core.bits.BaseItem.description))
+		cls = self.classes.get(key)
+		if cls is None:
+			# Predicates have already been used by the time a task exists
+			itemdict = dict((k,v) for k,v in itemdict.items() if k != 'if')
+			cls = self.classes.setdefault(key, self.itemdict_to_item_class(itemdict))
+		return cls
+
 	def taskdict_to_task(self, taskdict):
 		# turn the items into instances
-		items = map(self.itemdict_to_item_instance, taskdict['items'])
+		items = []
+		for itemdict in taskdict['items']:
+			data = dict((k,v) for k,v in itemdict.items() if k not in self.reserved_keys)
+			items.append(self.item_class(itemdict)(data=data))
 
 		# reference them to each other correctly
 		item_by_name = dict((item.name,item) for item in items)
-		for item in items:
-			item.depends = tuple(item_by_name[dep] for dep in item.depends)
+		for item,itemdict in zip(items, taskdict['items']):
+			item.depends = tuple(item_by_name[dep] for dep in itemdict.get('depends', ()))
 
 		# Find the goal node
 		metadata = taskdict['metadata']
@@ -180,3 +237,14 @@ class TaskConverter(ItemConverter):
 		requirements = metadata['requirements']
 		uuid = metadata['uuid']
 		return core.bits.Task(items, requirements, goal, uuid, metadata)
+
+	def taskdict_to_compact_task(self, taskdict):
+		'''return a core.bits.CompactTask from a task dict
+		This is much quicker than taskdict_to_task as no classes are made for the items
+		'''
+		items = taskdict['items']
+		ids = dict((itemdict['name'],i) for i,itemdict in enumerate(items))
+		depends = [[ids[dep] for dep in itemdict.get('depends', ())] for itemdict in items]
+		metadata = taskdict['metadata']
+		return core.bits.CompactTask([itemdict['name'] for itemdict in items], depends,
+				[itemdict['state'] for itemdict in items], metadata['requirements'], metadata['uuid'], metadata)
@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+'''telling things when tasks change
+
+Rather than asking the store over and over again whether anything has
+happened to a task, things that want to know can watch it and wait to be
+told.  Only changes made in this process are seen.
+'''
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class Watcher(object):
+	'''collects changes to a task until they are asked for
+
+	If more than backlog changes pile up before anyone asks for them, the
+	oldest are thrown away and missed is set.
+	'''
+	def __init__(self, uuid, lock, backlog):
+		self.uuid = uuid
+		self.condition = threading.Condition(lock)
+		self.changes = deque(maxlen=backlog)
+		self.missed = False
+
+	def add(self, change):
+		'''called with the notifier lock held'''
+		if len(self.changes) == self.changes.maxlen:
+			self.missed = True
+		self.changes.append(change)
+		self.condition.notify()
+
+	def wait(self, timeout=None):
+		'''wait up to timeout seconds for changes to the task
+		returns a list of the changes since we last asked, which is empty if nothing happened
+		'''
+		deadline = time.time() + timeout if timeout is not None else None
+		with self.condition:
+			while not self.changes:
+				if deadline is None:
+					self.condition.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					self.condition.wait(remaining)
+			changes = list(self.changes)
+			self.changes.clear()
+			return changes
+
+class TaskNotifier(object):
+	'''pass changes to tasks on to anything watching them
+
+	Anything that changes a task calls changed() with it's uuid and a
+	description of the change.  Changes to tasks nobody is watching cost
+	next to nothing.
+	'''
+	def __init__(self, backlog=1000):
+		self.backlog = backlog
+		self.lock = threading.Lock()
+		self.watchers = dict()	# uuid -> set of watchers
+
+	@contextmanager
+	def watch(self, uuid):
+		'''watch a task for changes while in this context. yields a Watcher'''
+		watcher = Watcher(uuid, self.lock, self.backlog)
+		with self.lock:
+			self.watchers.setdefault(uuid, set()).add(watcher)
+		try:
+			yield watcher
+		finally:
+			with self.lock:
+				watchers = self.watchers[uuid]
+				watchers.discard(watcher)
+				if not watchers:
+					del self.watchers[uuid]
+
+	def changed(self, uuid, change):
+		'''let everything watching a task know about a change to it'''
+		with self.lock:
+			for watcher in self.watchers.get(uuid, ()):
+				watcher.add(change)
+
+	def watching(self):
+		'''return how many things are watching tasks'''
+		with self.lock:
+			return sum(len(watchers) for watchers in self.watchers.values())
@@ -11,71 +11,1085 @@ try: import pymongo
 except: pass	# allow import where noone is using the MongoStore
 
 import config
+import atexit
+import bisect
+import copy
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import os
 import random
+import sqlite3
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
 
-class MongoStore(object):
-	'''persistant mongodb store'''
+class StoreUnavailable(Exception): pass
 
-	def __init__(self):
-		self.connection = pymongo.Connection(config.mongodb_server,config.mongodb_port)
-		self.db = self.connection[config.mongodb_database]
-	def get_tasks(self):
-		return [name for name in self.db.collection_names() if 'system.' not in name]
+def page_of_tasks(uuids, limit=None, after=None):
+	'''return a sorted page of uuids as per BaseStore.get_tasks from an unsorted list of all of them'''
+	uuids = sorted(uuids)
+	if after is not None:
+		uuids = uuids[bisect.bisect_right(uuids, after):]
+	if limit is not None:
+		uuids = uuids[:limit]
+	return uuids
+
+def is_internal_key(key):
+	'''return True iff key is one that stores may keep things of their own in (starting with _)'''
+	return isinstance(key, basestring) and key.startswith('_')
+
+def without_internal_keys(updatedict):
+	'''return a copy of an update without any keys that stores may keep things of their own in'''
+	return dict((k,v) for k,v in updatedict.items() if not is_internal_key(k))
+
+class BaseStore(object):
+	'''Base class for persistant storage of tasks
+
+	A task is stored as a list of item dicts and a metadata dict, and
+	is refered to by it's uuid
+	'''
+	# Can more than one instance of the store share the same tasks?
+	poolable = True
+	# Do calls wait on something outside the process, like a database server?
+	blocking = True
+
+	def get_tasks(self, limit=None, after=None):
+		'''return a list of the uuids of stored tasks in sorted order
+
+		Only uuids that sort after 'after' are returned, and at most 'limit' of
+		them.  To go through all the tasks a page at a time, pass the last uuid
+		from each page as 'after' for the next one.
+		'''
+		raise NotImplementedError
+	def new_task(self, uuid, items, metadata=None):
+		'''store a new task with a list of item dicts and a metadata dict'''
+		raise NotImplementedError
+	def item(self, uuid, name):
+		'''get a specific item for a task, or None if there is no such item'''
+		raise NotImplementedError
+	def items(self, uuid):
+		'''get all the items for a task'''
+		raise NotImplementedError
+	def metadata(self, uuid):
+		'''get metadata for a task, or None if there is no such task'''
+		raise NotImplementedError
+	def version(self, uuid):
+		'''get the version of a task, or None if there is no such task
+
+		The version starts at 0 and goes up every time an item or the metadata
+		of the task is updated, so if it hasn't changed, neither has the task
+		'''
+		raise NotImplementedError
+	def changes(self, uuid, since):
+		'''get the changes made to a task after version since
+
+		Every update to an item or the metadata of a task is logged along with the
+		version of the task it made. Changes to an item look like
+		{'version': 3, 'item': 'name', 'update': updatedict} and changes to the
+		metadata look like {'version': 4, 'metadata': True, 'update': updatedict}.
+
+		returns a tuple of (version, changes) with the current version of the task
+		and a list of changes after since in the order they were made.  changes is
+		None if the log no longer goes back as far as since, and both are None if
+		there is no such task
+		'''
+		raise NotImplementedError
+	def forget_changes(self, uuid):
+		'''throw away the change log for a task'''
+		raise NotImplementedError
+	def update_item(self, uuid, name, updatedict, existingstate={}):
+		'''updates an item similar to dict.update()
+
+		if 'existingdict' is supplied, the update will only succeed if 
+		the items in existingdict match what is in the item already
+
+		returns a tuple of (updated, item) where updated is True iff the update
+		was made, and item is the contents of the item after the attempt is made
+		(or None if there is no such item)
+		'''
+		raise NotImplementedError
+	def update_items(self, uuid, updates):
+		'''update many items at once with a single batch of writes
+
+		updates is a list of (name, updatedict, existingstate) tuples, each of which
+		is done as per update_item. Each item should only be updated once.
+
+		returns a list of (updated, item) tuples in the same order as updates,
+		where updated is True iff the update was made, and item is the contents of
+		the item after the updates (or None if there is no such item)
+		'''
+		raise NotImplementedError
+	def update_metadata(self, uuid, updatedict, existingstate={}):
+		'''updates a metadata similar to dict.update()
+
+		if 'existingdict' is supplied, the update will only succeed if 
+		the items in existingdict match what is in the metadata already
+
+		returns a tuple of (updated, metadata) as per update_item
+		'''
+		raise NotImplementedError
+	def versioned_update_items(self, uuid, updates):
+		'''update many items as per update_items, and say what version of the task that made
+
+		returns a tuple of (version, results) with results as per update_items.  The
+		updates that were made are the last changes up to version, and the items
+		are at least as new as that.  version is None if nothing was updated, or if
+		the store can't tell.
+		'''
+		return None, self.update_items(uuid, updates)
+	def versioned_update_metadata(self, uuid, updatedict, existingstate={}):
+		'''update the metadata as per update_metadata, and say what version of the task that made
+
+		returns a tuple of (version, updated, metadata), with version as per
+		versioned_update_items
+		'''
+		updated, metadata = self.update_metadata(uuid, updatedict, existingstate)
+		return None, updated, metadata
+	def delete_task(self, uuid):
+		'''delete a task, all it's items, and all it's metadata
+
+		This is not recoverable.
+		'''
+		raise NotImplementedError
+
+class MongoStore(BaseStore):
+	'''persistant mongodb store
+
+	Every task is kept in it's own collection, named after the task uuid
+
+	mongodb can only change one document at once, and items are kept apart
+	from the metadata that has the version and change log of the task.  So
+	that an item can't be changed without the change being logged, the change
+	is kept on the item (as _unlogged) by the same write that makes it, and
+	only taken off once it's been logged.  Anything left there by a writer that
+	stopped in between is logged when the log is next trimmed or forgotten,
+	so that reading the version doesn't have to go looking for it.
+
+	The change log is kept in the metadata too, and once it has more than
+	max_changes in it the oldest are dropped, down to half that many.
+	'''
+
+	def __init__(self, server=None, port=None, database=None, max_changes=None):
+		if server is None: server = config.mongodb_server
+		if port is None: port = config.mongodb_port
+		if database is None: database = config.mongodb_database
+		if max_changes is None: max_changes = config.mongodb_max_changes
+		self.max_changes = max_changes
+		self.connection = pymongo.Connection(server,port)
+		self.db = self.connection[database]
+
+	# Where things are kept. Override these to store tasks somewhere else
+	def _item_collection(self, uuid):
+		return self.db[uuid]
+	def _item_query(self, uuid, **query):
+		'''return a query that finds items in the task, restricted by query'''
+		query.setdefault('name', {'$exists': True})
+		query['metadata'] = {'$exists': False}
+		return query
+	def _metadata_collection(self, uuid):
+		return self.db[uuid]
+	def _metadata_query(self, uuid, **query):
+		'''return a query that finds the metadata for a task, restricted by query'''
+		query['metadata'] = {'$exists': True}
+		return query
+
+	def get_tasks(self, limit=None, after=None):
+		# There's no way to page through collection names, so this still has to look at them all
+		not_tasks = (SharedMongoStore.items_collection_name, SharedMongoStore.metadata_collection_name)
+		uuids = [name for name in self.db.collection_names() if 'system.' not in name and name not in not_tasks]
+		return page_of_tasks(uuids, limit, after)
 	def new_task(self, uuid, items, metadata=None):
 		if metadata == None: metadata = {}
 		metadata['uuid'] = uuid
 		metadata['metadata'] = True
 		self.db[uuid].create_index('name')
 		self.db[uuid].create_index('metadata')
+		self.db[uuid].create_index('_unlogged.id', sparse=True)
 		self.db[uuid].insert(items)
 		self.db[uuid].insert(metadata)
 	def _noid(self, item):
-		if item is None or '_id' not in item: return item
-		del item['_id']
+		if item is None: return item
+		item.pop('_id', None)
+		item.pop('_update_token', None)
+		item.pop('_version', None)
+		item.pop('_changes_from', None)
+		item.pop('_unlogged', None)
 		return item
+	def _log_changes(self, uuid, changes):
+		'''add changes to the log for a task, and note that it has been changed
+
+		The log is kept in the metadata, starting from the version in
+		_changes_from. Changes don't need their version stored with them, as
+		it's bumped at the same time as the change is added.
+
+		Changes are logged at most once by their id, then taken off their items.
+
+		returns the version the changes were logged up to, or None if they
+		weren't all logged together or their items have been changed since
+		'''
+		collection = self._metadata_collection(uuid)
+		ids = [change['id'] for change in changes]
+		fields = {'_version': True, '_changes_from': True}
+		# Usually none of them have been logged, and they can all go in at once
+		metadata = collection.find_and_modify(self._metadata_query(uuid, **{'_changes.id': {'$nin': ids}}),
+				{'$inc': {'_version': len(changes)}, '$push': {'_changes': {'$each': changes}}},
+				new=True, fields=fields)
+		version = metadata.get('_version') if metadata is not None else None
+		if metadata is None:
+			for change in changes:
+				metadata = collection.find_and_modify(self._metadata_query(uuid, **{'_changes.id': {'$ne': change['id']}}),
+						{'$inc': {'_version': 1}, '$push': {'_changes': change}},
+						new=True, fields=fields) or metadata
+		# Anyone else changing one of the items takes our change off it
+		cleared = self._item_collection(uuid).update(self._item_query(uuid, **{'_unlogged.id': {'$in': ids}}),
+				{'$unset': {'_unlogged': True}}, multi=True, w=1)
+		if metadata is not None:
+			self._trim_changes(uuid, metadata)
+		if cleared.get('n') != len(ids):
+			return None
+		return version
+	def _trim_changes(self, uuid, metadata):
+		'''drop the oldest changes from the log if it has got too long
+
+		metadata is the task's metadata (or at least it's _version and _changes_from)
+		as it was just after the last change was logged
+		'''
+		version, start = metadata.get('_version', 0), metadata.get('_changes_from', 0)
+		if version - start <= self.max_changes:
+			return
+		# Often enough to look for anything left unlogged; Logging it trims the log again
+		if self._log_unlogged(uuid):
+			return
+		keep = self.max_changes // 2
+		# Only if nothing else has been logged in the meantime, so we know how long the log is
+		self._metadata_collection(uuid).update(self._metadata_query(uuid, _version=version),
+				{'$set': {'_changes_from': version-keep}, '$push': {'_changes': {'$each': [], '$slice': -keep}}})
+	def _log_unlogged(self, uuid):
+		'''log changes left on items by writers that stopped before logging them
+		returns True iff there were any
+		'''
+		unlogged = self._item_collection(uuid).find(self._item_query(uuid, **{'_unlogged.id': {'$exists': True}}),
+				{'_unlogged': True})
+		changes = [item['_unlogged'] for item in unlogged]
+		if changes:
+			self._log_changes(uuid, changes)
+		return bool(changes)
+	def _unlogged_change(self, name, updatedict):
+		'''return a change to an item to be kept on it until it has been logged'''
+		return {'id': uuid4().hex, 'item': name, 'update': updatedict}
 	def item(self, uuid, name):
-		'''get a specific item for a task'''
-		return self._noid( self.db[uuid].find_one({'name': name}) )
+		return self._noid( self._item_collection(uuid).find_one(self._item_query(uuid, name=name)) )
 	def items(self, uuid):
-		'''get all the items for a task'''
 		# ALL THE THINGS!
-		return [self._noid(item) for item in self.db[uuid].find({'name': {'$exists': True},'metadata': {'$exists': False}})]
+		return [self._noid(item) for item in self._item_collection(uuid).find(self._item_query(uuid))]
 	def metadata(self, uuid):
-		'''get metadata for a task'''
-		metadata = self.db[uuid].find_one({'metadata': {'$exists': True}})
+		metadata = self._metadata_collection(uuid).find_one(self._metadata_query(uuid), {'_changes': False})
 		return self._noid(metadata)
+	def version(self, uuid):
+		metadata = self._metadata_collection(uuid).find_one(self._metadata_query(uuid), {'_version': True})
+		if metadata is None:
+			return None
+		return metadata.get('_version', 0)
+	def changes(self, uuid, since):
+		metadata = self._metadata_collection(uuid).find_one(self._metadata_query(uuid),
+				{'_version': True, '_changes_from': True, '_changes': True})
+		if metadata is None:
+			return None, None
+		version, start = metadata.get('_version', 0), metadata.get('_changes_from', 0)
+		if since < start:
+			return version, None
+		log = metadata.get('_changes', [])
+		changes = [dict(change, version=start+i+1) for i,change in enumerate(log) if start+i+1 > since]
+		for change in changes:
+			change.pop('id', None)
+		return version, changes
+	def forget_changes(self, uuid):
+		collection = self._metadata_collection(uuid)
+		# So the version still goes up for them
+		self._log_unlogged(uuid)
+		while True:
+			version = self.version(uuid)
+			if version is None:
+				return
+			# Only if nothing else has been logged in the meantime
+			query = self._metadata_query(uuid)
+			query['_version'] = version if version else {'$in': [0, None]}
+			if collection.find_and_modify(query, {'$set': {'_changes_from': version, '_changes': []}}, fields={'_id': True}):
+				return
+	def _set_item(self, uuid, name, updatedict, existingstate):
+		'''make an update to an item without logging it
+
+		returns a tuple of (change, item) where change is the unlogged change if
+		the update was made (or None), and item is what find_and_modify gave back
+		'''
+		# Items keep _task, _unlogged and the like next to their own attributes
+		updatedict = without_internal_keys(updatedict)
+		matchon = self._item_query(uuid, **existingstate)
+		matchon['name'] = name
+		change = self._unlogged_change(name, updatedict)
+		# Bulk updates by older versions left _update_token behind; Tidy it up on the way past
+		item = self._item_collection(uuid).find_and_modify(matchon,
+				{'$set': dict(updatedict, _unlogged=change), '$unset': {'_update_token': True}}, new=True)
+		if item is None:
+			return None, None
+		return change, self._noid(item)
 	def update_item(self, uuid, name, updatedict, existingstate={}):
-		'''updates an item similar to dict.update()
+		change, item = self._set_item(uuid, name, updatedict, existingstate)
+		if change is not None:
+			self._log_changes(uuid, [change])
+			return True, item
+		# Only need to go back for the item if we didn't update it
+		return False, self.item(uuid, name)
+	def update_items(self, uuid, updates):
+		return self.versioned_update_items(uuid, updates)[1]
+	def versioned_update_items(self, uuid, updates):
+		# A bulk write can't say which of it's updates matched, or what they left
+		# the items as, so each item is updated by itself and only logging is batched
+		results, changes, version = [], [], None
+		for name,updatedict,existingstate in updates:
+			change, item = self._set_item(uuid, name, updatedict, existingstate)
+			if change is not None:
+				changes.append(change)
+			results.append((change is not None, item))
+		# Go back for all the items that weren't updated at once
+		missed = [name for (name,u,e),(updated,item) in zip(updates,results) if not updated]
+		if missed:
+			found = self._item_collection(uuid).find(self._item_query(uuid, name={'$in': missed}))
+			found = dict((item['name'],self._noid(item)) for item in found)
+			results = [(updated, item if updated else found.get(name))
+					for (name,u,e),(updated,item) in zip(updates,results)]
+		if changes:
+			version = self._log_changes(uuid, changes)
+		return version, results
+	def update_metadata(self, uuid, updatedict, existingstate={}):
+		return self.versioned_update_metadata(uuid, updatedict, existingstate)[1:]
+	def versioned_update_metadata(self, uuid, updatedict, existingstate={}):
+		# The version and change log are kept in the metadata
+		updatedict = without_internal_keys(updatedict)
+		matchon = self._metadata_query(uuid, **existingstate)
+		change = {'metadata': True, 'update': updatedict}
+		update = {'$inc': {'_version': 1}, '$push': {'_changes': change}}
+		if updatedict:
+			update['$set'] = updatedict
+		metadata = self._metadata_collection(uuid).find_and_modify(matchon, update,
+				new=True, fields={'_changes': False})
+		if metadata is not None:
+			self._trim_changes(uuid, metadata)
+			return metadata.get('_version'), True, self._noid(metadata)
+		return None, False, self.metadata(uuid)
+	def delete_task(self, uuid):
+		self.db[uuid].drop()
 
-		if 'existingdict' is supplied, the update will only succeed if 
-		the items in existingdict match what is in the item already
+class SharedMongoStore(MongoStore):
+	'''persistant mongodb store keeping all tasks in the same collections
+
+	MongoStore makes a collection for every task, which gets expensive for
+	mongodb when there are lots of tasks.  This keeps the items for all tasks
+	in a single collection, with the uuid of the task they belong to in a
+	'_task' attribute, and all the metadata in another collection.
+
+	Use tools/migratestore.py to move tasks from a MongoStore into one of these
+	'''
+	items_collection_name = 'task_items'
+	metadata_collection_name = 'task_metadata'
+
+	def __init__(self, server=None, port=None, database=None, max_changes=None):
+		MongoStore.__init__(self, server, port, database, max_changes)
+		self.items_collection = self.db[self.items_collection_name]
+		self.metadata_collection = self.db[self.metadata_collection_name]
+		self.items_collection.ensure_index([('_task',pymongo.ASCENDING),('name',pymongo.ASCENDING)], unique=True)
+		self.metadata_collection.ensure_index('uuid', unique=True)
+		self.items_collection.ensure_index('_unlogged.id', sparse=True)
+
+	def _item_collection(self, uuid):
+		return self.items_collection
+	def _item_query(self, uuid, **query):
+		query['_task'] = uuid
+		return query
+	def _metadata_collection(self, uuid):
+		return self.metadata_collection
+	def _metadata_query(self, uuid, **query):
+		query['uuid'] = uuid
+		return query
+
+	def get_tasks(self, limit=None, after=None):
+		query = {'uuid': {'$gt': after}} if after is not None else {}
+		cursor = self.metadata_collection.find(query, {'uuid': True}).sort('uuid', pymongo.ASCENDING)
+		if limit is not None:
+			cursor = cursor.limit(limit)
+		return [metadata['uuid'] for metadata in cursor]
+	def new_task(self, uuid, items, metadata=None):
+		if metadata == None: metadata = {}
+		metadata['uuid'] = uuid
+		metadata['metadata'] = True
+		for item in items:
+			item['_task'] = uuid
+		if len(items):
+			self.items_collection.insert(items)
+		self.metadata_collection.insert(metadata)
+		for item in items:
+			del item['_task']
+	def _noid(self, item):
+		if item is None: return item
+		item.pop('_task', None)
+		return MongoStore._noid(self, item)
+	def delete_task(self, uuid):
+		self.items_collection.remove({'_task': uuid})
+		self.metadata_collection.remove({'uuid': uuid})
+
+class SQLiteStore(BaseStore):
+	'''persistant store in an SQLite database
 
-		returns the contents of the item after the attempt is made. 
-		It is up to the caller to check if the update worked or failed.
+	Good for running on a single machine without needing a database server,
+	and for testing.  Items and metadata are kept as JSON, and conditional
+	updates are done in a single UPDATE statement using SQLite's JSON functions
+	(which need SQLite 3.9 or newer).
+
+	Every thread gets it's own connection to the database.
+	'''
+	schema = (
+		'''CREATE TABLE IF NOT EXISTS tasks (uuid TEXT PRIMARY KEY, metadata TEXT NOT NULL,
+			version INTEGER NOT NULL DEFAULT 0, changes_from INTEGER NOT NULL DEFAULT 0)''',
+		'''CREATE TABLE IF NOT EXISTS items (uuid TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL,
+			PRIMARY KEY (uuid, name))''',
+		'''CREATE TABLE IF NOT EXISTS changes (uuid TEXT NOT NULL, version INTEGER NOT NULL, change TEXT NOT NULL,
+			PRIMARY KEY (uuid, version))''',
+	)
+	# Columns that have been added to tasks since the first version of the schema
+	added_columns = (
+		('version', 'version INTEGER NOT NULL DEFAULT 0'),
+		('changes_from', 'changes_from INTEGER NOT NULL DEFAULT 0'),
+	)
+
+	def __init__(self, path=None, timeout=30):
+		if path is None: path = config.sqlite_path
+		self.path, self.timeout = path, timeout
+		self.local = threading.local()
+		with self.connection as conn:
+			for statement in self.schema:
+				conn.execute(statement)
+			# Upgrade databases made with older versions of the schema
+			columns = [column[1] for column in conn.execute('PRAGMA table_info(tasks)')]
+			for name, definition in self.added_columns:
+				if name not in columns:
+					conn.execute('ALTER TABLE tasks ADD COLUMN '+definition)
+
+	@property
+	def connection(self):
+		'''the connection to the database for this thread'''
+		conn = getattr(self.local, 'connection', None)
+		if conn is None:
+			conn = self.local.connection = sqlite3.connect(self.path, timeout=self.timeout)
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('PRAGMA synchronous=NORMAL')
+		return conn
+
+	def _path(self, key):
+		'''return a JSON path for a key in an item or metadata'''
+		if '"' in key:
+			raise ValueError('cannot use " in attribute names')
+		return '$."%s"' % (key,)
+
+	def _update_sql(self, column, updatedict, existingstate):
+		'''return SQL and arguments to conditionally update the JSON in a column
+		returns the new value for the column and it's arguments, and extra WHERE clauses and their arguments
 		'''
-		matchon = dict(existingstate)
-		matchon['name'] = name
-		self.db[uuid].update(matchon, {'$set': updatedict})
-		return self.item(uuid, name)
+		setargs, whereclauses, whereargs = [], [], []
+		for k,v in updatedict.items():
+			setargs.extend((self._path(k), json.dumps(v)))
+		for k,v in existingstate.items():
+			if isinstance(v, (dict,list)):
+				whereclauses.append('json_extract(%s, ?) = json(?)' % (column,))
+				whereargs.extend((self._path(k), json.dumps(v)))
+			else:
+				whereclauses.append('json_extract(%s, ?) IS ?' % (column,))
+				whereargs.extend((self._path(k), int(v) if isinstance(v,bool) else v))
+		setsql = 'json_set(%s%s)' % (column, ', ?, json(?)'*len(updatedict))
+		wheresql = ''.join(' AND '+clause for clause in whereclauses)
+		return setsql, setargs, wheresql, whereargs
+
+	def _update_item(self, conn, uuid, name, updatedict, existingstate):
+		'''conditionally update an item. returns True iff it was updated'''
+		setsql, setargs, wheresql, whereargs = self._update_sql('data', updatedict, existingstate)
+		cursor = conn.execute('UPDATE items SET data = '+setsql+' WHERE uuid = ? AND name = ?'+wheresql,
+				setargs + [uuid, name] + whereargs)
+		if cursor.rowcount == 0:
+			return False
+		conn.execute('UPDATE tasks SET version = version + 1 WHERE uuid = ?', (uuid,))
+		self._log_change(conn, uuid, {'item': name, 'update': updatedict})
+		return True
+
+	def _log_change(self, conn, uuid, change):
+		'''add a change to the log for a task, as of the version it's just been bumped to'''
+		conn.execute('INSERT INTO changes (uuid, version, change) SELECT uuid, version, ? FROM tasks WHERE uuid = ?',
+				(json.dumps(change), uuid))
+
+	def get_tasks(self, limit=None, after=None):
+		sql, args = 'SELECT uuid FROM tasks', []
+		if after is not None:
+			sql, args = sql+' WHERE uuid > ?', [after]
+		sql += ' ORDER BY uuid'
+		if limit is not None:
+			sql, args = sql+' LIMIT ?', args+[limit]
+		return [row[0] for row in self.connection.execute(sql, args)]
+	def new_task(self, uuid, items, metadata=None):
+		if metadata == None: metadata = {}
+		metadata['uuid'] = uuid
+		metadata['metadata'] = True
+		with self.connection as conn:
+			conn.execute('INSERT INTO tasks (uuid, metadata) VALUES (?, ?)', (uuid, json.dumps(metadata)))
+			conn.executemany('INSERT INTO items (uuid, name, data) VALUES (?, ?, ?)',
+					((uuid, item['name'], json.dumps(item)) for item in items))
+	def item(self, uuid, name):
+		row = self.connection.execute('SELECT data FROM items WHERE uuid = ? AND name = ?', (uuid, name)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+	def items(self, uuid):
+		rows = self.connection.execute('SELECT data FROM items WHERE uuid = ? ORDER BY rowid', (uuid,))
+		return [json.loads(row[0]) for row in rows]
+	def metadata(self, uuid):
+		row = self.connection.execute('SELECT metadata FROM tasks WHERE uuid = ?', (uuid,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+	def _version(self, conn, uuid):
+		row = conn.execute('SELECT version FROM tasks WHERE uuid = ?', (uuid,)).fetchone()
+		return row[0] if row is not None else None
+	def version(self, uuid):
+		return self._version(self.connection, uuid)
+	def changes(self, uuid, since):
+		conn = self.connection
+		with conn:
+			row = conn.execute('SELECT version, changes_from FROM tasks WHERE uuid = ?', (uuid,)).fetchone()
+			if row is None:
+				return None, None
+			version, start = row
+			if since < start:
+				return version, None
+			rows = conn.execute('SELECT version, change FROM changes WHERE uuid = ? AND version > ? ORDER BY version',
+					(uuid, since)).fetchall()
+		return version, [dict(json.loads(change), version=v) for v,change in rows]
+	def forget_changes(self, uuid):
+		with self.connection as conn:
+			conn.execute('UPDATE tasks SET changes_from = version WHERE uuid = ?', (uuid,))
+			conn.execute('DELETE FROM changes WHERE uuid = ?', (uuid,))
+	def update_item(self, uuid, name, updatedict, existingstate={}):
+		with self.connection as conn:
+			updated = self._update_item(conn, uuid, name, updatedict, existingstate)
+		return updated, self.item(uuid, name)
+	def update_items(self, uuid, updates):
+		return self.versioned_update_items(uuid, updates)[1]
+	def versioned_update_items(self, uuid, updates):
+		version = None
+		with self.connection as conn:
+			updated = [self._update_item(conn, uuid, name, updatedict, existingstate)
+					for name,updatedict,existingstate in updates]
+			if any(updated):
+				version = self._version(conn, uuid)
+		return version, [(u, self.item(uuid, name)) for u,(name,updatedict,existingstate) in zip(updated,updates)]
 	def update_metadata(self, uuid, updatedict, existingstate={}):
-		'''updates a metadata similar to dict.update()
+		return self.versioned_update_metadata(uuid, updatedict, existingstate)[1:]
+	def versioned_update_metadata(self, uuid, updatedict, existingstate={}):
+		updatedict = without_internal_keys(updatedict)
+		setsql, setargs, wheresql, whereargs = self._update_sql('metadata', updatedict, existingstate)
+		version = None
+		with self.connection as conn:
+			cursor = conn.execute('UPDATE tasks SET metadata = '+setsql+', version = version + 1 WHERE uuid = ?'+wheresql,
+					setargs + [uuid] + whereargs)
+			updated = cursor.rowcount > 0
+			if updated:
+				self._log_change(conn, uuid, {'metadata': True, 'update': updatedict})
+				version = self._version(conn, uuid)
+		return version, updated, self.metadata(uuid)
+	def delete_task(self, uuid):
+		with self.connection as conn:
+			conn.execute('DELETE FROM items WHERE uuid = ?', (uuid,))
+			conn.execute('DELETE FROM changes WHERE uuid = ?', (uuid,))
+			conn.execute('DELETE FROM tasks WHERE uuid = ?', (uuid,))
 
-		if 'existingdict' is supplied, the update will only succeed if 
-		the items in existingdict match what is in the metadata already
+class MemoryStore(BaseStore):
+	'''store that keeps everything in memory
+
+	Reads never have to leave the process.  If a journal file is given, every
+	change is appended to it so that the state of all tasks can be rebuilt
+	when the store is next started.  Writing to the journal is done in the
+	background: Changes are queued up and written out (and fsync'd) when
+	sync_batch changes are waiting or every sync_interval seconds, whichever
+	happens first.  This means up to that many changes can be lost if the machine
+	falls over; Set sync_batch to 1 if that matters more than speed.
+
+	The journal is rewritten to contain only the current state of all tasks
+	every compact_every changes so that it doesn't grow forever.
+
+	Pass journal=False to not keep a journal at all.
+	'''
+	poolable = False
+	# The journal is written by it's own thread
+	blocking = False
+
+	def __init__(self, journal=None, sync_batch=None, sync_interval=None, compact_every=None):
+		if journal is None: journal = config.memory_journal
+		if sync_batch is None: sync_batch = config.memory_journal_sync_batch
+		if sync_interval is None: sync_interval = config.memory_journal_sync_interval
+		if compact_every is None: compact_every = config.memory_journal_compact_every
+		self.journal, self.sync_batch, self.sync_interval, self.compact_every = journal, sync_batch, sync_interval, compact_every
+		self.tasks = dict()		# uuid -> (items by name, list of item names, metadata)
+		self.versions = dict()		# uuid -> version
+		self.change_logs = dict()	# uuid -> (version the log starts from, list of changes)
+		self.lock = threading.RLock()
+		self.pending = []
+		self.since_compaction = 0
+		self.journal_file = None
+		if self.journal:
+			self.replay()
+			self.journal_file = open(self.journal, 'a')
+			self.wakeup = threading.Condition(self.lock)
+			self.write_lock = threading.Lock()
+			self.closed = False
+			self.writer = threading.Thread(target=self._write_journal, name='MemoryStore journal')
+			self.writer.daemon = True
+			self.writer.start()
+			atexit.register(self.close)
+
+	#
+	# Journal handling
+	#
+	def _apply(self, record):
+		'''make the change described by a journal record. returns True iff anything changed'''
+		op, uuid, args = record[0], record[1], record[2:]
+		if op == 'new':
+			# Snapshots also record the version the task was up to
+			items, metadata = args[:2]
+			self.tasks[uuid] = (dict((item['name'],item) for item in items), [item['name'] for item in items], metadata)
+			self.versions[uuid] = args[2] if len(args) > 2 else 0
+			self.change_logs[uuid] = (self.versions[uuid], [])
+			return True
+		if op == 'delete':
+			self.versions.pop(uuid, None)
+			self.change_logs.pop(uuid, None)
+			return self.tasks.pop(uuid, None) is not None
+		if uuid not in self.tasks:
+			return False
+		if op == 'forget':
+			self.change_logs[uuid] = (self.versions[uuid], [])
+			return True
+		items, order, metadata = self.tasks[uuid]
+		if op == 'item':
+			name, updatedict, existingstate = args
+			target = items.get(name)
+			change = {'item': name}
+		elif op == 'metadata':
+			updatedict, existingstate = args
+			target = metadata
+			change = {'metadata': True}
+		if target is None or not all(target.get(k) == v for k,v in existingstate.items()):
+			return False
+		target.update(copy.deepcopy(updatedict))
+		self.versions[uuid] += 1
+		change.update(version=self.versions[uuid], update=copy.deepcopy(updatedict))
+		self.change_logs[uuid][1].append(change)
+		return True
+
+	def _record(self, *record):
+		'''make a change and queue it to be written to the journal. returns True iff anything changed'''
+		with self.lock:
+			if not self._apply(record):
+				return False
+			if self.journal_file is not None:
+				# Conditions have already been checked; Don't bother checking them on replay
+				if record[0] in ('item','metadata'):
+					record = record[:-1] + ({},)
+				self.pending.append(json.dumps(record))
+				if len(self.pending) >= self.sync_batch:
+					self.wakeup.notify()
+			return True
+
+	def replay(self):
+		'''load the state of all tasks from the journal
+
+		Anything after the last complete record was only partly written
+		before we stopped, and is cut off so that new records don't get
+		appended onto the end of it.
+		'''
+		if not os.path.exists(self.journal):
+			return
+		with open(self.journal, 'r+b') as journal:
+			good = 0	# Offset of the end of the last complete record
+			while True:
+				line = journal.readline()
+				if not line.endswith('\n'):
+					break
+				try:
+					record = json.loads(line)
+				except ValueError:
+					break
+				self._apply(record)
+				self.since_compaction += 1
+				good = journal.tell()
+			journal.seek(0, os.SEEK_END)
+			if journal.tell() > good:
+				journal.truncate(good)
+				journal.flush()
+				os.fsync(journal.fileno())
 
-		returns the contents of the metadata after the attempt is made. 
-		It is up to the caller to check if the update worked or failed.
+	def _write_journal(self):
+		while not self.closed:
+			with self.lock:
+				if len(self.pending) < self.sync_batch and not self.closed:
+					self.wakeup.wait(self.sync_interval)
+			self._flush()
+
+	def _flush(self, compact=False):
+		'''write out any pending changes to the journal
+
+		The store isn't locked while writing to disk, so that everything
+		else can go on while we wait for the disk to catch up
 		'''
-		matchon = dict(existingstate)
-		matchon['metadata'] = {'$exists': True}
-		self.db[uuid].update(matchon, {'$set': updatedict})
-		return self.metadata(uuid)
+		with self.write_lock:
+			with self.lock:
+				pending, self.pending = self.pending, []
+				self.since_compaction += len(pending)
+				snapshot = None
+				if compact or self.since_compaction >= self.compact_every:
+					# Everything pending is already in the current state, so we can forget it
+					snapshot = [json.dumps(('new', uuid, [items[name] for name in order], metadata, self.versions[uuid]))
+							for uuid,(items,order,metadata) in self.tasks.items()]
+					self.since_compaction = len(snapshot)
+			if snapshot is not None:
+				self._write_snapshot(snapshot)
+			elif pending:
+				self.journal_file.write(''.join(line+'\n' for line in pending))
+				self.journal_file.flush()
+				os.fsync(self.journal_file.fileno())
+
+	def _write_snapshot(self, snapshot):
+		'''replace the journal with a new one'''
+		tmpname = self.journal+'.compact'
+		with open(tmpname, 'w') as journal:
+			journal.write(''.join(line+'\n' for line in snapshot))
+			journal.flush()
+			os.fsync(journal.fileno())
+		os.rename(tmpname, self.journal)
+		self.journal_file.close()
+		self.journal_file = open(self.journal, 'a')
+
+	def sync(self):
+		'''write out all pending changes to the journal now'''
+		if self.journal_file is not None:
+			self._flush()
+
+	def compact(self):
+		'''rewrite the journal now to contain only the current state of all tasks'''
+		if self.journal_file is not None:
+			self._flush(compact=True)
+
+	def close(self):
+		'''write out all pending changes and stop writing to the journal'''
+		if self.journal_file is not None and not self.closed:
+			with self.lock:
+				self.closed = True
+				self.wakeup.notify()
+			self.writer.join()
+			self._flush()
+			self.journal_file.close()
+
+	#
+	# Store interface
+	#
+	def get_tasks(self, limit=None, after=None):
+		with self.lock:
+			uuids = self.tasks.keys()
+		return page_of_tasks(uuids, limit, after)
+	def new_task(self, uuid, items, metadata=None):
+		if metadata == None: metadata = {}
+		metadata['uuid'] = uuid
+		metadata['metadata'] = True
+		self._record('new', uuid, copy.deepcopy(items), copy.deepcopy(metadata))
+	def item(self, uuid, name):
+		with self.lock:
+			if uuid not in self.tasks:
+				return None
+			return copy.deepcopy(self.tasks[uuid][0].get(name))
+	def items(self, uuid):
+		with self.lock:
+			if uuid not in self.tasks:
+				return []
+			items, order, metadata = self.tasks[uuid]
+			return copy.deepcopy([items[name] for name in order])
+	def metadata(self, uuid):
+		with self.lock:
+			if uuid not in self.tasks:
+				return None
+			return copy.deepcopy(self.tasks[uuid][2])
+	def version(self, uuid):
+		with self.lock:
+			return self.versions.get(uuid)
+	def changes(self, uuid, since):
+		with self.lock:
+			if uuid not in self.tasks:
+				return None, None
+			start, log = self.change_logs[uuid]
+			if since < start:
+				return self.versions[uuid], None
+			# Versions in the log are consecutive, so we can skip straight to since
+			return self.versions[uuid], copy.deepcopy(log[since-start:])
+	def forget_changes(self, uuid):
+		self._record('forget', uuid)
+	def update_item(self, uuid, name, updatedict, existingstate={}):
+		with self.lock:
+			return self._record('item', uuid, name, updatedict, existingstate), self.item(uuid, name)
+	def update_items(self, uuid, updates):
+		return self.versioned_update_items(uuid, updates)[1]
+	def versioned_update_items(self, uuid, updates):
+		with self.lock:
+			results = [(self._record('item', uuid, name, updatedict, existingstate), self.item(uuid, name))
+					for name,updatedict,existingstate in updates]
+			version = self.versions.get(uuid) if any(u for u,item in results) else None
+		return version, results
+	def update_metadata(self, uuid, updatedict, existingstate={}):
+		return self.versioned_update_metadata(uuid, updatedict, existingstate)[1:]
+	def versioned_update_metadata(self, uuid, updatedict, existingstate={}):
+		updatedict = without_internal_keys(updatedict)
+		with self.lock:
+			updated = self._record('metadata', uuid, updatedict, existingstate)
+			return self.versions.get(uuid) if updated else None, updated, self.metadata(uuid)
 	def delete_task(self, uuid):
-		'''delete a task, all it's items, and all it's metadata
+		self._record('delete', uuid)
 
-		This is not recoverable.
+class PooledStore(object):
+	'''share a bounded pool of store instances between threads
+
+	This looks just like a store, but every call is passed on to a store
+	borrowed from the pool for the duration of the call. Stores are made with
+	store_factory as they are needed, up to size of them. If they are all in use,
+	callers wait up to timeout seconds for one to be returned before giving up
+	and raising StoreUnavailable.
+	'''
+	def __init__(self, store_factory=None, size=None, timeout=None):
+		if store_factory is None: store_factory = Store
+		if size is None: size = config.store_pool_size
+		if timeout is None: timeout = config.store_pool_timeout
+		self.store_factory, self.size, self.timeout = store_factory, size, timeout
+		self.pool = Queue.LifoQueue()
+		self.lock = threading.Lock()
+		self.created = 0
+		self.checkouts = self.waits = self.timeouts = 0
+		self.wait_time = self.max_wait_time = 0.0
+		self.in_use = 0
+
+	def _get(self):
+		'''return a store from the pool, making a new one if there's room'''
+		try:
+			return self.pool.get_nowait()
+		except Queue.Empty:
+			pass
+		with self.lock:
+			make_new = self.created < self.size
+			if make_new: self.created += 1
+		if make_new:
+			try:
+				return self.store_factory()
+			except:
+				with self.lock: self.created -= 1
+				raise
+		start = time.time()
+		try:
+			return self.pool.get(timeout=self.timeout)
+		except Queue.Empty:
+			with self.lock: self.timeouts += 1
+			raise StoreUnavailable('timed out waiting for a store connection')
+		finally:
+			waited = time.time() - start
+			with self.lock:
+				self.waits += 1
+				self.wait_time += waited
+				self.max_wait_time = max(self.max_wait_time, waited)
+
+	@contextmanager
+	def checkout(self):
+		'''borrow a store from the pool'''
+		store = self._get()
+		with self.lock:
+			self.checkouts += 1
+			self.in_use += 1
+		try:
+			yield store
+		finally:
+			with self.lock: self.in_use -= 1
+			self.pool.put(store)
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		def pooled(*args, **argd):
+			with self.checkout() as store:
+				return getattr(store, name)(*args, **argd)
+		pooled.__name__ = name
+		return pooled
+
+	def stats(self):
+		'''return a dict of counters about how the pool is being used'''
+		with self.lock:
+			return dict(size=self.size, created=self.created, in_use=self.in_use,
+					checkouts=self.checkouts, waits=self.waits, timeouts=self.timeouts,
+					wait_time=self.wait_time, max_wait_time=self.max_wait_time)
+
+class ExecutorStore(object):
+	'''run every call to a store somewhere else
+
+	This looks just like the store, but every call is passed to
+	apply(method, args, kwargs) to be run, e.g. by a pool of threads so
+	that blocking on the store doesn't hold up anything else.
+	'''
+	def __init__(self, store, apply):
+		self.store, self.apply = store, apply
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		method = getattr(self.store, name)
+		def executed(*args, **argd):
+			return self.apply(method, args, argd)
+		executed.__name__ = name
+		return executed
+
+class ShardedStore(BaseStore):
+	'''spread tasks over several stores by their uuid
+
+	Each task is kept entirely in one of the stores (shards), picked by
+	consistent hashing of it's uuid, so all the reads, writes and locking for
+	a task happen in one place and the load is split between the shards.
+	Shards are placed on the hash ring by name rather than by position, and
+	adding a shard only moves the tasks that now hash to it.  Calls that need
+	every shard (get_tasks) are made to all of them at once on a thread pool.
+
+	shards is a list of (name, store) pairs.  The stores are shared between
+	threads, so give each shard a PooledStore if it can have one.
+	'''
+	# One instance is shared by everything; It does any pooling per shard
+	poolable = False
+	# Any waiting is done by the shards
+	blocking = False
+	# Points on the hash ring for each shard. More spreads tasks more evenly
+	replicas = 100
+
+	def __init__(self, shards=None, replicas=None):
+		if shards is None: shards = self.shards_from_config(config.store_shards)
+		if replicas is None: replicas = self.replicas
+		if not shards:
+			raise ValueError('need at least one shard to store tasks in')
+		self.shards = dict(shards)
+		if len(self.shards) != len(shards):
+			raise ValueError('shard names must be unique')
+		ring = sorted((self._hash('%s-%d' % (name, i)), name) for name in self.shards for i in range(replicas))
+		self.ring_points = [point for point,name in ring]
+		self.ring_shards = [self.shards[name] for point,name in ring]
+		self.threads = ThreadPool(len(self.shards))
+
+	@classmethod
+	def shards_from_config(cls, shard_config, wrap_blocking=None):
+		'''return a list of (name, store) from a list of (name, {'store': kind, args...})
+
+		If wrap_blocking is given, each store that blocks is passed through it
+		(before it is pooled), e.g. to make an ExecutorStore of it.
+
+		Memory shards must each be given a journal of their own (or False),
+		rather than all writing to config.memory_journal.
 		'''
-		self.db[uuid].drop()
+		# Check them all before making any, as memory stores start writing straight away
+		journals = set()
+		for name,args in shard_config:
+			if issubclass(stores[args['store']], MemoryStore):
+				journal = args.get('journal')
+				if journal is None:
+					raise ValueError('memory shard %s needs a journal of it\'s own (or False for none)' % (name,))
+				if journal:
+					journal = os.path.abspath(journal)
+					if journal in journals:
+						raise ValueError('memory shard %s has the same journal as another shard' % (name,))
+					journals.add(journal)
+		shards = []
+		for name,args in shard_config:
+			args = dict(args)
+			store_class = stores[args.pop('store')]
+			make_store = functools.partial(store_class, **args)
+			if wrap_blocking is not None and store_class.blocking:
+				make_store = lambda make_store=make_store: wrap_blocking(make_store())
+			shards.append((name, PooledStore(make_store) if store_class.poolable else make_store()))
+		return shards
+
+	def _hash(self, key):
+		return int(hashlib.md5(unicode(key).encode('utf-8')).hexdigest()[:16], 16)
+
+	def shard(self, uuid):
+		'''return the store that a task is kept in'''
+		pos = bisect.bisect(self.ring_points, self._hash(uuid))
+		return self.ring_shards[pos % len(self.ring_shards)]
+
+	def get_tasks(self, limit=None, after=None):
+		pages = self.threads.map(lambda store: store.get_tasks(limit, after), self.shards.values())
+		return list(itertools.islice(heapq.merge(*pages), limit))
+	def new_task(self, uuid, items, metadata=None):
+		return self.shard(uuid).new_task(uuid, items, metadata)
+	def item(self, uuid, name):
+		return self.shard(uuid).item(uuid, name)
+	def items(self, uuid):
+		return self.shard(uuid).items(uuid)
+	def metadata(self, uuid):
+		return self.shard(uuid).metadata(uuid)
+	def version(self, uuid):
+		return self.shard(uuid).version(uuid)
+	def changes(self, uuid, since):
+		return self.shard(uuid).changes(uuid, since)
+	def forget_changes(self, uuid):
+		return self.shard(uuid).forget_changes(uuid)
+	def update_item(self, uuid, name, updatedict, existingstate={}):
+		return self.shard(uuid).update_item(uuid, name, updatedict, existingstate)
+	def update_items(self, uuid, updates):
+		return self.shard(uuid).update_items(uuid, updates)
+	def update_metadata(self, uuid, updatedict, existingstate={}):
+		return self.shard(uuid).update_metadata(uuid, updatedict, existingstate)
+	def versioned_update_items(self, uuid, updates):
+		return self.shard(uuid).versioned_update_items(uuid, updates)
+	def versioned_update_metadata(self, uuid, updatedict, existingstate={}):
+		return self.shard(uuid).versioned_update_metadata(uuid, updatedict, existingstate)
+	def delete_task(self, uuid):
+		return self.shard(uuid).delete_task(uuid)
+
+	def close(self):
+		'''stop the thread pool, and close the shards that can be'''
+		self.threads.close()
+		for store in self.shards.values():
+			# Look on the class; PooledStores make up any method asked for
+			if getattr(type(store), 'close', None):
+				store.close()
+
+	def stats(self):
+		'''return the stats of each shard that has them'''
+		return dict(shards=dict((name, store.stats()) for name,store in self.shards.items()
+				if getattr(store, 'stats', None)))
+
+def pooled_store_factory(store_factory=None, size=None, timeout=None):
+	'''return a store factory that makes a PooledStore of store_factory
+
+	Stores that can't be shared between instances are returned as is
+	'''
+	if store_factory is None: store_factory = Store
+	if not getattr(store_factory, 'poolable', True):
+		return store_factory
+	return lambda: PooledStore(store_factory, size, timeout)
+
+# Stores that can be picked by setting 'store' in config
+stores = {
+	'mongodb': MongoStore,
+	'mongodb_shared': SharedMongoStore,
+	'sqlite': SQLiteStore,
+	'memory': MemoryStore,
+	'sharded': ShardedStore,
+}
 
 # Define the default Store here
-Store = MongoStore
+Store = stores[config.store]
@@ -16,9 +16,13 @@ WSGI interface rather than cherrypy's own one
 '''
 
 import cherrypy
+import functools
 import json
+import threading
+import urllib
 
 import config
+import core.store
 import lib.magic
 
 from contextlib import contextmanager
@@ -31,6 +35,116 @@ def expose_json(func):
 	wrapper.exposed = True
 	return wrapper
 
+# Ways to make JSON that can be picked by setting 'httpd_json_encoder' in config.
+# These all make compact JSON; Pipe it through python -m json.tool to read it
+json_encoders = {
+	'json': lambda: functools.partial(json.dumps, separators=(',',':')),
+	'simplejson': lambda: functools.partial(__import__('simplejson').dumps, separators=(',',':')),
+	'ujson': lambda: __import__('ujson').dumps,
+}
+dumps = json_encoders[config.httpd_json_encoder]()
+
+def stream_json_list(items, chunksize=1000):
+	'''generate a JSON list a chunk at a time rather than all at once'''
+	yield '['
+	for start in xrange(0, len(items), chunksize):
+		chunk = ','.join(dumps(item) for item in items[start:start+chunksize])
+		yield (',' if start else '') + chunk
+	yield ']'
+
+def version_etag(version):
+	return 'W/"%d"' % (version,)
+
+def check_version(magic, uuid, version=None):
+	'''set the ETag for a version of a task, and stop with 304 (Not Modified)
+	if the client already has it
+
+	version defaults to the current version. Either way, the response must
+	be at least as new as version: Call this before reading anything from the
+	task, or pass the version that what's being returned was read at. If the
+	task is newer than the ETag says, the client just fetches it again next time.
+	'''
+	if version is None:
+		version = magic.get_version(uuid)
+	etag = version_etag(version)
+	cherrypy.response.headers['ETag'] = etag
+	match = cherrypy.request.headers.get('If-None-Match')
+	if match is not None:
+		tags = [tag.strip() for tag in match.split(',')]
+		if '*' in tags or etag in tags or etag[2:] in tags:
+			raise cherrypy.HTTPRedirect([], 304)
+
+class WaiterLimit(object):
+	'''keep count of requests that are waiting, up to limit of them at once
+
+	A limit of None lets any number of them wait
+	'''
+	def __init__(self, limit):
+		self.limit = limit
+		self.waiting = 0
+		self.lock = threading.Lock()
+
+	def enter(self):
+		'''start waiting. returns False if there are already too many waiting'''
+		with self.lock:
+			if self.limit is not None and self.waiting >= self.limit:
+				return False
+			self.waiting += 1
+			return True
+
+	def leave(self):
+		with self.lock:
+			self.waiting -= 1
+
+	def held(self, generator):
+		'''generate the same things as generator, then leave'''
+		try:
+			for chunk in generator:
+				yield chunk
+		finally:
+			self.leave()
+
+def server_sent_event(event, data):
+	return 'event: %s\ndata: %s\n\n' % (event, dumps(data))
+
+def task_events(magic, uuid):
+	'''generate server-sent events for changes to a task
+
+	The first event is 'version', with the version of the task when we
+	started watching it.  After that there is an 'item' or 'metadata' event
+	with the new contents every time one is changed, and the stream ends
+	after a 'delete' event.  If changes come faster than the client can take
+	them, a 'missed' event says that some were thrown away.
+	'''
+	with magic.notifier.watch(uuid) as watcher:
+		try:
+			yield server_sent_event('version', magic.get_version(uuid))
+		except KeyError:
+			yield server_sent_event('delete', None)
+			return
+		while True:
+			changes = watcher.wait(config.httpd_events_keepalive)
+			if watcher.missed:
+				watcher.missed = False
+				yield server_sent_event('missed', None)
+			if not changes:
+				yield ': keepalive\n\n'
+			for event, data in changes:
+				yield server_sent_event(event, data)
+				if event == 'delete':
+					return
+
+def update_response(result):
+	'''return the JSON for the result of a conditional update
+	If the update wasn't made because it's conditions didn't match, the
+	response status is set to 409 (Conflict). Either way the current
+	state of the thing updated is returned
+	'''
+	updated, current = result
+	if not updated:
+		cherrypy.response.status = 409
+	return dumps(current)
+
 @contextmanager
 def http_resource():
 	'''propogate KeyErrors and ValueErrors as HTTP errors'''
@@ -40,6 +154,8 @@ def http_resource():
 		raise cherrypy.HTTPError(404, str(err)) # Resource not found
 	except ValueError as err:
 		raise cherrypy.HTTPError(400, str(err)) # Bad request
+	except core.store.StoreUnavailable as err:
+		raise cherrypy.HTTPError(503, str(err)) # Service unavailable
 
 def simple_error_page(status, message, traceback, version):
 	return '{"error": "%s", "message": "%s"}' % (status, message)
@@ -50,17 +166,26 @@ def error_page(status, message, traceback, version):
 cherrypy.config.update({'error_page.400': simple_error_page,
 			'error_page.404': simple_error_page,
 			'error_page.405': simple_error_page,
+			'error_page.503': simple_error_page,
 			'error_page.default': error_page
 			})
 
 class Task(object):
 
 	@expose_json
-	def index(self):
+	def index(self, limit=None, after=None):
 		if cherrypy.request.method == 'GET':
-			# List ALL THE TASKS!
-			return json.dumps(self.magic.get_tasks(),indent=1)
+			# List ALL THE TASKS! (or at least a page of them)
+			with http_resource():
+				if limit is not None:
+					limit = int(limit)
+				tasks = self.magic.get_tasks(limit, after)
+			if limit is not None and len(tasks) == limit:
+				nextpage = urllib.urlencode({'limit': limit, 'after': tasks[-1]})
+				cherrypy.response.headers['Link'] = '</task/?%s>; rel="next"' % (nextpage,)
+			return stream_json_list(tasks)
 		raise cherrypy.HTTPError(405)
+	index._cp_config = {'response.stream': True}
 
 	@expose_json
 	def create(self):
@@ -69,17 +194,18 @@ class Task(object):
 			with http_resource():
 				taskdata = json.load(cherrypy.request.body)
 				task = self.magic.create_task(taskdata)
-			return json.dumps(task,indent=1)
+			return dumps(task)
 		raise cherrypy.HTTPError(405)
 
 	@expose_json
-	def default(self, uuid, *args):
+	def default(self, uuid, *args, **params):
 		# TODO: replace this horrible, horrible spagetti
 
 		if len(args) == 0:
 			if cherrypy.request.method == 'GET':
 				with http_resource(): # Show the task
-					return json.dumps(self.magic.get_task(uuid), indent=1)
+					check_version(self.magic, uuid)
+					return dumps(self.magic.get_task(uuid))
 			elif cherrypy.request.method == 'DELETE':
 				with http_resource(): # wipe task
 					self.magic.delete_task(uuid)
@@ -90,16 +216,76 @@ class Task(object):
 			# return items that we can do now
 			if cherrypy.request.method == 'GET':
 				with http_resource():
-					return json.dumps(self.magic.ready_to_run(uuid), indent=1)
+					if 'wait' in params:
+						# Wait for them to change from what the client saw at version
+						wait = min(float(params['wait']), config.httpd_max_wait)
+						version = int(params['version']) if 'version' in params else None
+						# If there are too many waiting already, answer straight away
+						waiting = self.waiters.enter()
+						try:
+							version, ready = self.magic.wait_for_ready_to_run(uuid, version, wait if waiting else 0)
+						finally:
+							if waiting: self.waiters.leave()
+						cherrypy.response.headers['ETag'] = version_etag(version)
+						return dumps(ready)
+					# label the items with the version they were worked out from, not the latest
+					version, ready = self.magic.versioned_ready_to_run(uuid)
+					check_version(self.magic, uuid, version)
+					return dumps(ready)
+			else: raise cherrypy.HTTPError(405) # Invalid method
+		elif args[0] == 'changes':
+			# what's changed since the client last looked
+			if cherrypy.request.method == 'GET':
+				with http_resource():
+					return dumps(self.magic.get_changes(uuid, int(params.get('since', 0))))
+			else: raise cherrypy.HTTPError(405) # Invalid method
+		elif args[0] == 'events':
+			# stream changes to the task as they happen
+			if cherrypy.request.method == 'GET':
+				with http_resource():
+					self.magic.get_version(uuid)
+				if not self.waiters.enter():
+					raise cherrypy.HTTPError(503, 'too many clients waiting for events') # Service unavailable
+				cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+				cherrypy.response.headers['Cache-Control'] = 'no-cache'
+				cherrypy.response.stream = True
+				return self.waiters.held(task_events(self.magic, uuid))
+			else: raise cherrypy.HTTPError(405) # Invalid method
+		elif args[0] == 'claim':
+			# atomically take items that we can do now
+			if cherrypy.request.method == 'POST':
+				with http_resource():
+					claimdata = json.load(cherrypy.request.body)
+					if not getattr(claimdata, 'get', None):
+						raise ValueError('claim must be a dictionary')
+					claimed = self.magic.claim_items(uuid, claimdata.get('worker'), claimdata.get('max_items',1))
+					return dumps(claimed)
+			else: raise cherrypy.HTTPError(405) # Invalid method
+		elif args[0] == 'items':
+			# update lots of items at once
+			if cherrypy.request.method == 'POST':
+				with http_resource():
+					updatedata = json.load(cherrypy.request.body)
+					if not isinstance(updatedata, list):
+						raise ValueError('can only update items with a list of item updates')
+					updates = []
+					for update in updatedata:
+						if not getattr(update, 'items', None) or 'name' not in update:
+							raise ValueError('each item update must be a dictionary with a name')
+						update = dict(update)
+						updates.append((update.pop('name'), update))
+					results = self.magic.update_items(uuid, updates)
+					return dumps(results)
 			else: raise cherrypy.HTTPError(405) # Invalid method
 		elif args[0] == 'metadata':
 			if cherrypy.request.method == 'GET':
 				with http_resource():
-					return json.dumps(self.magic.get_metadata(uuid), indent=1)
+					check_version(self.magic, uuid)
+					return dumps(self.magic.get_metadata(uuid))
 			elif cherrypy.request.method == 'POST':
 				with http_resource():
 					updatedata = json.load(cherrypy.request.body)
-					return json.dumps(self.magic.update_task_metadata(uuid,updatedata), indent=1)
+					return update_response(self.magic.update_task_metadata(uuid,updatedata))
 
 		# Nothing so simple as a single task.
 		args = dict(zip(['itemname','attrib'],args))
@@ -114,24 +300,51 @@ class Task(object):
 		else:
 			if cherrypy.request.method == 'GET':
 				with http_resource():
-					return json.dumps(self.magic.get_item(uuid,args['itemname']), indent=1)
+					check_version(self.magic, uuid)
+					return dumps(self.magic.get_item(uuid,args['itemname']))
 			elif cherrypy.request.method == 'POST':
 				# Update stuff in the item
 				with http_resource():
 					updatedata = json.load(cherrypy.request.body)
-					return json.dumps(self.magic.update_item(uuid,args['itemname'],updatedata), indent=1)
+					return update_response(self.magic.update_item(uuid,args['itemname'],updatedata))
 		raise cherrypy.HTTPError(405)
 
 class Root(object):
+	# Compress responses for clients that can take it
+	_cp_config = {'tools.gzip.on': True, 'tools.gzip.mime_types': ['application/json', 'text/plain']}
+
 	@cherrypy.expose
 	def index(self):
 		cherrypy.response.headers['Content-Type'] = 'text/plain'
 		return '''make magic httpd API is running and happy
-		/task/		GET: list tasks
+		/task/		GET: list tasks (optionally ?limit=N&after=uuid to get a page at a time)
 		/task/		POST: create new task  (takes { 'requirements': [] } at minimum)
 		/task/uuid/	GET: show task
+		/task/uuid/available	GET: show items ready to run (?wait=N&version=V to wait up to N seconds for them to change from version V)
+		/task/uuid/changes	GET: show changes to the task (?since=V for only those after version V)
+		/task/uuid/events	GET: stream changes to the task as server-sent events
+		/task/uuid/items	POST: update many items (takes [ {'name': 'itemname', 'state': ...}, ... ])
+		/task/uuid/claim	POST: take items to work on (takes { 'worker': 'name', 'max_items': 1 })
+		/stats		GET: show cache and store connection statistics
+		/reload		POST: load the items again in the background. GET: show how the last reload went
 '''
 
+	@expose_json
+	def stats(self):
+		if cherrypy.request.method == 'GET':
+			return dumps(self.magic.stats())
+		raise cherrypy.HTTPError(405)
+
+	@expose_json
+	def reload(self):
+		if cherrypy.request.method == 'GET':
+			return dumps(self.magic.reload_status())
+		elif cherrypy.request.method == 'POST':
+			self.magic.start_reload()
+			cherrypy.response.status = 202
+			return dumps(self.magic.reload_status())
+		raise cherrypy.HTTPError(405)
+
 def get_cherrypy_root(magiclib):
 	'''return the root object to be given to cherrypy
 
@@ -139,23 +352,68 @@ def get_cherrypy_root(magiclib):
 	'''
 	root = Root()
 	root.task = Task()
+	root.task.waiters = WaiterLimit(config.httpd_max_waiters)
 
 	# Allow the objects to access magic
-	# this may not be the optimal way to do it; might want to start more
-	# instances so everything isn't using the same Store connection
+	# Everything shares the same Magic; Use a PooledStore so that threads
+	# aren't all waiting on the same Store connection
 	root.magic = magiclib
 	root.task.magic = magiclib
 
 	return root
 
+def get_magic():
+	'''return a Magic suitable for sharing between all the server threads'''
+	return lib.magic.Magic(store_factory=core.store.pooled_store_factory())
+
 def run_httpd():
-	magiclib = lib.magic.Magic() 
+	magiclib = get_magic()
+	# Reload items on SIGHUP rather than restarting
+	cherrypy.engine.signal_handler.handlers['SIGHUP'] = magiclib.start_reload
 	cpconfig = {'global': {'server.socket_host': config.httpd_listen_address, 'server.socket_port': config.httpd_listen_port}}
 	cherrypy.quickstart(get_cherrypy_root(magiclib), config=cpconfig)
 
 def get_wsgi_application():
-	root = get_cherrypy_root(lib.magic.Magic())
+	root = get_cherrypy_root(get_magic())
 	return cherrypy.Application(root, '/')
 
+def run_gevent_httpd():
+	'''serve the same application as run_httpd with gevent
+
+	Every connection gets a greenlet instead of a thread, so there can be
+	thousands of workers connected (and waiting for things to do) at once.
+	Calls to stores that block (on a database server) are made from a pool of
+	store_pool_size threads so that a slow store doesn't hold up everything
+	else.  Stores that keep everything in the process are called directly;
+	Their locks are patched by gevent, and only work between greenlets.
+
+	gevent's monkey patching needs to be done before anything else is
+	imported; Use magic_gevent.py to run this.
+	'''
+	import gevent
+	import signal
+	from gevent.pool import Pool
+	from gevent.pywsgi import WSGIServer
+	from gevent.threadpool import ThreadPool
+
+	threads = ThreadPool(config.store_pool_size)
+	def offload(store):
+		return core.store.ExecutorStore(store, threads.apply)
+	if core.store.Store is core.store.ShardedStore:
+		store_factory = lambda: core.store.ShardedStore(core.store.ShardedStore.shards_from_config(config.store_shards, offload))
+	elif core.store.Store.blocking:
+		store_factory = lambda: offload(core.store.Store())
+	else:
+		store_factory = core.store.Store
+	magiclib = lib.magic.Magic(store_factory=store_factory)
+	gevent.signal(signal.SIGHUP, magiclib.start_reload)
+	# Waiting only costs a greenlet, so let every connection do it
+	root = get_cherrypy_root(magiclib)
+	root.task.waiters.limit = None
+	application = cherrypy.Application(root, '/')
+	server = WSGIServer((config.httpd_listen_address, config.httpd_listen_port), application,
+			spawn=Pool(config.httpd_gevent_max_connections))
+	server.serve_forever()
+
 if __name__ == '__main__':
 	run_httpd()
@@ -2,24 +2,86 @@
 
 '''Loader of item groups'''
 
+import cPickle
+import hashlib
 import json
+import os
+import tempfile
 
+import config
 import core.marshal
 import core.deptools
 from core.bits import *
+from core.cache import LRUCache
 
 # FIXME: Need to implement predicate and requirement stuff and
 #        all that implies!
 
+class TaskTemplate(object):
+	'''the shape of a task planned for some set of requirements
+
+	Working out which items are needed for a set of requirements, and
+	unrolling groups, is the expensive bit of making a task. Once it
+	has been done, we remember which classes ended up in the task and
+	what depends on what so that we can stamp out new tasks quickly.
+	'''
+	def __init__(self, task):
+		items = list(task.items)
+		position = dict((item,pos) for pos,item in enumerate(items))
+		self.classes = [item.__class__ for item in items]
+		self.depends = [tuple(position[dep] for dep in item.depends) for item in items]
+		self.goal = position[task.goal]
+
+	def new_task(self, requirements):
+		'''return a new Task with fresh item instances in the shape of the template'''
+		items = [None if pos == self.goal else cls() for pos,cls in enumerate(self.classes)]
+		for item,depends in zip(items,self.depends):
+			if item is not None:
+				item.depends = tuple(items[dep] for dep in depends)
+		goal = items[self.goal] = TaskComplete(items[dep] for dep in self.depends[self.goal])
+		return Task(set(items), requirements, goal)
+
 class TaskFactory(object):
 	'''Factory to generate tasks'''
-	def __init__(self, classes, dependency_strategy=core.deptools.DigraphDependencyStrategy):
+	template_cache_entries = 256
+
+	def __init__(self, classes, dependency_strategy=core.deptools.DigraphDependencyStrategy, template_cache_entries=None, reduce_dependencies=None):
 		self.classes = classes
 		self.dependency_strategy = dependency_strategy
+		if template_cache_entries is None:
+			template_cache_entries = self.template_cache_entries
+		if reduce_dependencies is None:
+			reduce_dependencies = config.reduce_dependencies
+		self.reduce_dependencies = reduce_dependencies
+		self.templates = LRUCache(max_entries=template_cache_entries)
+		self.edges_before = self.edges_after = 0
+
+	def requirements_key(self, requirements):
+		'''return requirements in a form that is the same for any equivalent set of requirements
+		returns None if the requirements can't be used as a key
+		'''
+		try:
+			return tuple(sorted(set(requirements)))
+		except TypeError:
+			return None
 
 	def task_from_requirements(self, requirements):
 		'''This is to create a new task given a set of requirements
+
+		Tasks for requirements that we've seen before are made from a template
+		rather than being worked out from scratch
 		'''
+		key = self.requirements_key(requirements)
+		if key is None:
+			return self.plan_task(requirements)
+		template = self.templates.get(key)
+		if template is None:
+			template = TaskTemplate(self.plan_task(key))
+			self.templates.set(key, template)
+		return template.new_task(requirements)
+
+	def plan_task(self, requirements):
+		'''Work out from scratch what items are needed for a new task'''
 		# Instantiate items
 		items = self.dependency_strategy.instantiate_items(self.classes)
 		items = set(items.values())	# TODO: Fix instantiate_items return. this is unintuitive
@@ -37,9 +99,20 @@ class TaskFactory(object):
 		items = self.dependency_strategy.make_group_dependencies_explicit_for_items(items)
 		assert goal in items
 
+		# Unrolling groups leaves lots of dependencies that are implied by others
+		if self.reduce_dependencies:
+			before, after = self.dependency_strategy.transitive_reduction(items)
+			self.edges_before += before
+			self.edges_after += after
+
 		# Create task for great justice
 		return Task(items, requirements, goal)
 
+	def stats(self):
+		'''return information about the tasks we've planned'''
+		return dict(templates=self.templates.stats(), reduce_dependencies=self.reduce_dependencies,
+				edges_before_reduction=self.edges_before, edges_after_reduction=self.edges_after)
+
 class ObjectItemLoader(object):
 	'''Load in items defined by python objects and make a TaskFactory from them'''
 
@@ -93,3 +166,110 @@ class JSONItemLoader(ObjectItemLoader):
 	def load_item_classes_from_string(cls, data):
 		''''load json items from a file and return a TaskFactory'''
 		return cls.taskfactory_from_objects(json.loads(data))
+
+class CachedItemLoader(JSONItemLoader):
+	'''Load in items from a json file, keeping what we made of them in a cache file
+
+	Parsing and checking the items, and working out what depends on what,
+	is slow for big sets of items.  Once it has been done, the results are
+	written to the cache file along with a hash of the items file, and as
+	long as the items file is the same they are loaded from there.
+
+	The cache holds a list of (kind, name, description, predicate, depends,
+	contains) tuples, where kind is 'item' or 'group', name is normalised,
+	predicate is the predicate string as written (or None), and depends and
+	contains are positions in the list. Classes can't be pickled, so they
+	are made again from these.  Nor can parsed predicates, so they are parsed
+	again too, once for each different predicate string.
+	'''
+	cache_version = 2
+
+	@classmethod
+	def load_item_classes_from_path(cls, path, cache_path):
+		'''load json items from path and return a TaskFactory, using cache_path if it's up to date'''
+		with open(path, 'rb') as f:
+			data = f.read()
+		digest = hashlib.sha1(data).hexdigest()
+		compiled = cls.read_cache(cache_path, digest)
+		if compiled is not None:
+			try:
+				return cls.taskfactory_from_compiled(compiled)
+			except ValueError:
+				pass	# Written by something that got it wrong; Start again
+		compiled = cls.compile_objects(json.loads(data))
+		cls.write_cache(cache_path, digest, compiled)
+		return cls.taskfactory_from_compiled(compiled)
+
+	@classmethod
+	def read_cache(cls, cache_path, digest):
+		'''return the compiled items in the cache if they are for the items with digest, otherwise None'''
+		try:
+			with open(cache_path, 'rb') as f:
+				version, cached_digest, compiled = cPickle.load(f)
+		except Exception:
+			return None	# Missing, unreadable or from something else entirely
+		if version != cls.cache_version or cached_digest != digest:
+			return None
+		return compiled
+
+	@classmethod
+	def write_cache(cls, cache_path, digest, compiled):
+		'''write compiled items to the cache
+		The cache is replaced all at once so that other processes never see half of it
+		'''
+		try:
+			fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)))
+			with os.fdopen(fd, 'wb') as f:
+				cPickle.dump((cls.cache_version, digest, compiled), f, cPickle.HIGHEST_PROTOCOL)
+			os.rename(tmppath, cache_path)
+		except (IOError, OSError):
+			pass	# Not being able to cache just makes the next start slower
+
+	@classmethod
+	def compile_objects(cls, objects):
+		'''check items represented by simple python objects and return them in the form kept in the cache'''
+		marsh = core.marshal.ItemConverter()
+		for o in objects:
+			cls.check_sanity(o)
+		names = [marsh.normalise_item_name(o.get('name') or o['group']) for o in objects]
+		position = dict((name,pos) for pos,name in enumerate(names))
+		def positions(name, others):
+			for other in others:
+				pos = position.get(marsh.normalise_item_name(other))
+				if pos is None:
+					raise ValueError('"%s" refers to "%s", which is not an item or group' %(name, other))
+				yield pos
+		compiled = []
+		for name,o in zip(names, objects):
+			depends = tuple(positions(name, o.get('depends', ())))
+			contains = None
+			if 'group' in o:
+				contains = tuple(positions(name, o['contains']))
+			predicate = None
+			if 'if' in o:
+				# Parse it now so that bad predicates are found before they're cached
+				predicate = marsh.predicate_callable_to_string(marsh.predicate_string_to_callable(o['if']))
+			compiled.append(('group' if 'group' in o else 'item', name, o.get('description'), predicate, depends, contains))
+		return compiled
+
+	@classmethod
+	def taskfactory_from_compiled(cls, compiled):
+		'''make item classes from compiled items and return a TaskFactory
+		raises ValueError if they refer to items that aren't there
+		'''
+		marsh = core.marshal.ItemConverter()
+		classes = []
+		for kind,name,description,predicate,depends,contains in compiled:
+			for pos in depends + (contains or ()):
+				if not 0 <= pos < len(compiled):
+					raise ValueError('"%s" refers to item %r of %d' %(name, pos, len(compiled)))
+			itemdict = {'group': name, 'contains': ()} if kind == 'group' else {'name': name}
+			if description is not None: itemdict['description'] = description
+			if predicate is not None: itemdict['if'] = predicate
+			classes.append(marsh.itemdict_to_item_class(itemdict))
+		# Have dependencies refer to the classes they depend on
+		for item,(kind,name,description,predicate,depends,contains) in zip(classes, compiled):
+			item.depends = tuple(classes[dep] for dep in depends)
+			if contains is not None:
+				item.contains = tuple(classes[k] for k in contains)
+		return TaskFactory(classes)
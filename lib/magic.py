@@ -7,33 +7,122 @@ may very well just call this much of the time
 '''
 
 import config
+import sys
+import threading
+import time
 
-from core.store import Store
+from core.store import Store, is_internal_key
+from core.cache import LRUCache
+from core.notify import TaskNotifier
 from core.marshal import ItemConverter,TaskConverter
-from lib.loaders import JSONItemLoader
-from core.deptools import DigraphDependencyStrategy
+from lib.loaders import JSONItemLoader,CachedItemLoader
+from core.deptools import TaskDependencyManager
 from core.bits import Item
+import tools.lint
+
+def estimate_task_size(manager):
+	'''rough guess at how many bytes a cached task is using'''
+	size = sys.getsizeof(manager.task.data)
+	for item in manager.task.items:
+		size += sys.getsizeof(item) + sys.getsizeof(item.data) + sys.getsizeof(item.depends)
+		size += sum(sys.getsizeof(v) for v in item.data.values())
+	# The manager's own indexes are a few dict and set entries per item
+	return size + 200*len(manager.task.items)
 
 class Magic(object):
-	def __init__(self,store_factory=Store,dependency_strategy=DigraphDependencyStrategy):
+	def __init__(self,store_factory=Store):
 		# Load items
 		self.load_items()
 		self.store = store_factory()
-		self.dependency_strategy = dependency_strategy
+		self.task_cache = LRUCache(config.task_cache_entries, config.task_cache_size, estimate_task_size)
+		self.dependency_lock = threading.RLock()
+		self.notifier = TaskNotifier()
+		self.reload_lock = threading.Lock()
+		self.reload_state = dict(state='loaded', finished=time.time())
 
-	def load_items(self):
+	def read_items(self):
+		'''return a TaskFactory for the items in config.items_file'''
+		if config.items_cache:
+			return CachedItemLoader.load_item_classes_from_path(config.items_file, config.items_cache)
 		itemsf = open(config.items_file)
-		self.taskfactory = JSONItemLoader.load_item_classes_from_file(itemsf)
-		itemsf.close()
+		try:
+			return JSONItemLoader.load_item_classes_from_file(itemsf)
+		finally:
+			itemsf.close()
+
+	def load_items(self, taskfactory=None):
+		'''start using the items from taskfactory (or config.items_file if not given)
+
+		Anything that already has hold of the old TaskFactory (e.g. a task being
+		created) carries on with it.
+		'''
+		if taskfactory is None:
+			taskfactory = self.read_items()
+		# Tasks loaded from the store are made from the same classes where possible.
+		# Both are swapped at once, so nothing sees one from the old items and
+		# the other from the new; Take catalog once to use both together
+		self.catalog = (taskfactory, TaskConverter(taskfactory.classes))
+
+	@property
+	def taskfactory(self):
+		return self.catalog[0]
+	@property
+	def task_converter(self):
+		return self.catalog[1]
+
+	#
+	#  Reloading items
+	#
+	#  Items can be reloaded while we're running (e.g. from a signal or over
+	#  HTTP).  This is done in the background, and the new items are only
+	#  used if they pass lint; Otherwise we keep the ones we have.
+	#
+	def run_in_background(self, func):
+		'''run func in a background thread
+		Replace this to run things some other way (e.g. with a thread pool)
+		'''
+		thread = threading.Thread(target=func, name='reload_items')
+		thread.daemon = True
+		thread.start()
 
-	reload_items = load_items
+	def reload_items(self):
+		'''load and lint the items again, and start using them if they're okay
+		returns the reload state as per reload_status
+		'''
+		with self.reload_lock:
+			self.reload_state = dict(state='reloading', started=time.time())
+			try:
+				taskfactory = self.read_items()
+				tools.lint.lint_taskfactory(taskfactory)
+			except Exception as err:
+				self.reload_state = dict(state='failed', error=str(err), finished=time.time())
+			else:
+				self.load_items(taskfactory)
+				self.reload_state = dict(state='loaded', finished=time.time())
+			return self.reload_status()
+
+	def start_reload(self):
+		'''reload the items in the background, returning straight away'''
+		self.reload_state = dict(state='reloading', started=time.time())
+		self.run_in_background(self.reload_items)
+
+	def reload_status(self):
+		'''return a dict with the state of the last reload ('reloading', 'loaded' or
+		'failed'), when it finished, and what went wrong if it failed
+		'''
+		return dict(self.reload_state)
 
 	#
 	# This stuff is pretty easy. Get information about existing tasks
 	# and update them: Just pass it off to the storage module
 	#
-	def get_tasks(self):
-		return self.store.get_tasks()
+	def get_tasks(self, limit=None, after=None):
+		'''return a sorted list of task uuids, optionally a page at a time
+		returns at most limit uuids that sort after 'after'
+		'''
+		if limit is not None and (type(limit) not in (int,long) or limit < 1):
+			raise ValueError('limit must be a positive integer')
+		return self.store.get_tasks(limit, after)
 	def get_task(self, uuid):
 		metadata = self.store.metadata(uuid)
 		items = self.store.items(uuid)
@@ -50,12 +139,44 @@ class Magic(object):
 		if not metadata:
 			raise KeyError('uuid '+str(uuid)+' not found')
 		return metadata
-	def update_item(self, uuid, name, updatedict, onlyif={}):
+	def get_version(self, uuid):
+		'''return a number that goes up every time anything in the task changes'''
+		version = self.store.version(uuid)
+		if version is None:
+			raise KeyError('uuid '+str(uuid)+' not found')
+		return version
+	def get_changes(self, uuid, since):
+		'''return what has changed in a task since version since
+
+		returns {'version': version, 'changes': [...]} with the current version
+		of the task and the changes made after since, as per Store.changes.  If
+		we no longer know what changed that long ago, returns {'version': version,
+		'task': task} with the whole task instead. Updates are made again
+		if they're applied twice, so the task may already include changes made
+		after version.
+		'''
+		if type(since) not in (int,long) or since < 0:
+			raise ValueError('since must be a version of the task')
+		version, changes = self.store.changes(uuid, since)
+		if version is None:
+			raise KeyError('uuid '+str(uuid)+' not found')
+		if changes is None:
+			return {'version': version, 'task': self.get_task(uuid)}
+		return {'version': version, 'changes': changes}
+	def check_item_update(self, updatedict, onlyif={}):
+		'''check an update to an item is allowed
+		returns the update and the conditions on it (with any 'onlyif' in the update moved into the conditions)
+		raises ValueError if the update is not allowed
+		'''
 		cannot_update = set(('name','depends','if'))
-		onlyif = dict(onlyif)
+		if not getattr(updatedict, 'items', None):
+			raise ValueError('can only update an item with a dictionary')
+		updatedict, onlyif = dict(updatedict), dict(onlyif)
 		for k,v in updatedict.items():
 			if k in cannot_update:
 				raise ValueError('cannot modify item attribute "%s"' %(k,))
+			if is_internal_key(k):
+				raise ValueError('cannot modify item attribute "%s"; those starting with _ are kept for the store' %(k,))
 		if 'onlyif' in updatedict:
 			if not getattr(updatedict['onlyif'], 'items', None): 
 				raise ValueError('can only set "onlyif" to a dictionary')
@@ -64,20 +185,115 @@ class Magic(object):
 		if 'state' in updatedict:
 			if updatedict['state'] not in Item.allowed_states:
 				raise ValueError('can only change state to '+','.join(Item.allowed_states))
-		return self.store.update_item(uuid,name,updatedict,onlyif)
+		return updatedict, onlyif
+	def update_item(self, uuid, name, updatedict, onlyif={}):
+		'''update an item, only if everything in onlyif matches what's already in the item
+
+		returns a tuple of (updated, item) where updated is True iff the update was
+		made, and item is the contents of the item afterwards
+		raises KeyError if there is no such item
+		'''
+		updatedict, onlyif = self.check_item_update(updatedict, onlyif)
+		version, [(updated, item)] = self.store.versioned_update_items(uuid, [(name,updatedict,onlyif)])
+		if item is None:
+			raise KeyError(uuid+'/'+name)
+		if updated:
+			self._update_dependency_manager(uuid, version, items=[item])
+			self.notifier.changed(uuid, ('item', item))
+		return updated, item
+	def update_items(self, uuid, updates):
+		'''update many items in a task at once
+
+		updates is a list of (name, updatedict) or (name, updatedict, onlyif) tuples,
+		each of which is treated as per update_item.  Every update is checked before
+		any of them are made, and each item can only be updated once.
+
+		returns a list in the same order as updates of dicts with the item name,
+		if the update was made, and the contents of the item afterwards
+		'''
+		checked, seen = [], set()
+		for update in updates:
+			if len(update) not in (2,3):
+				raise ValueError('updates must be (name, updatedict[, onlyif])')
+			name = update[0]
+			if name in seen:
+				raise ValueError('cannot update item "%s" more than once at a time' %(name,))
+			seen.add(name)
+			updatedict, onlyif = self.check_item_update(*update[1:])
+			checked.append((name, updatedict, onlyif))
+		version, results = self.store.versioned_update_items(uuid, checked)
+		self._update_dependency_manager(uuid, version, items=[item for updated,item in results if updated])
+		for updated,item in results:
+			if updated:
+				self.notifier.changed(uuid, ('item', item))
+		return [dict(name=name, updated=updated, item=item) for (name,u,o),(updated,item) in zip(checked,results)]
+	def claim_items(self, uuid, worker_id, max_items=1):
+		'''atomically take up to max_items items that are ready to run for a worker
+
+		claimed items are set to IN_PROGRESS with owner set to worker_id.
+		returns a list of the items that were claimed, which can be empty
+		if there is nothing to do or other workers got there first
+		'''
+		if not worker_id:
+			raise ValueError('must supply a worker to claim items for')
+		if type(max_items) not in (int,long) or max_items < 1:
+			raise ValueError('can only claim a positive integer number of items')
+		claimed = []
+		for item in self.ready_to_run(uuid):
+			if len(claimed) >= max_items:
+				break
+			claim = {'state': Item.IN_PROGRESS, 'owner': worker_id}
+			version, [(updated, result)] = self.store.versioned_update_items(uuid,
+					[(item['name'], claim, {'state': Item.INCOMPLETE})])
+			if updated:
+				claimed.append(result)
+				self._update_dependency_manager(uuid, version, items=[result])
+				self.notifier.changed(uuid, ('item', result))
+		return claimed
 	def update_item_state(self, uuid, name, oldstate, newstate):
 		'''helper to update a state with a guard against the old one
-		WARNING: This actually sucks quite a bit. It doesn't guard against race conditions
-		from multiple agents.  This is deliberately not exposed to the HTTP interface for
-		that reason.
+		returns (updated, item) as per update_item. If several agents try this at
+		once, updated is only True for the one that actually changed the state
 		'''
 		return self.update_item(uuid, name, {'state': newstate}, {'state': oldstate})
 	def update_task_metadata(self, uuid, updatedict, onlyif={}):
+		'''update the metadata for a task, only if everything in onlyif matches what's already there
+
+		returns a tuple of (updated, metadata) as per update_item
+		raises KeyError if there is no such task
+		'''
+		if not getattr(updatedict, 'items', None):
+			raise ValueError('can only update metadata with a dictionary')
+		updatedict, onlyif = dict(updatedict), dict(onlyif)
 		if 'uuid' in updatedict and uuid != updatedict['uuid']:
 			raise ValueError('cannot change uuid for a task')
-		return self.store.update_metadata(uuid,updatedict,onlyif)
+		for k in updatedict:
+			if is_internal_key(k):
+				raise ValueError('cannot modify task attribute "%s"; those starting with _ are kept for the store' %(k,))
+		if 'onlyif' in updatedict:
+			if not getattr(updatedict['onlyif'], 'items', None): 
+				raise ValueError('can only set "onlyif" to a dictionary')
+			onlyif.update(updatedict.pop('onlyif'))
+		version, updated, metadata = self.store.versioned_update_metadata(uuid,updatedict,onlyif)
+		if metadata is None:
+			raise KeyError('uuid '+str(uuid)+' not found')
+		if updated:
+			self._update_dependency_manager(uuid, version, metadata=metadata)
+			self.notifier.changed(uuid, ('metadata', metadata))
+		return updated, metadata
 	def delete_task(self, uuid):
 		self.store.delete_task(uuid)
+		with self.dependency_lock:
+			self.task_cache.pop(uuid)
+		self.notifier.changed(uuid, ('delete', None))
+
+	def stats(self):
+		'''return information about how well things are going'''
+		stats = dict(task_cache=self.task_cache.stats(), watching=self.notifier.watching(),
+				task_factory=self.taskfactory.stats(), items=self.reload_status())
+		if getattr(self.store, 'stats', None):
+			stats['store'] = self.store.stats()
+		return stats
 
 	#
 	# Creating a new task is almost as easy!
@@ -85,7 +301,9 @@ class Magic(object):
 	def create_task(self, task_data):
 		if 'requirements' not in task_data:
 			raise ValueError('No requirements supplied to create task')
-		task = self.taskfactory.task_from_requirements(task_data['requirements'])
+		# Items can be reloaded while we're doing this; Stick with the ones we started with
+		taskfactory = self.taskfactory
+		task = taskfactory.task_from_requirements(task_data['requirements'])
 
 		# FIXME: Should be in core.marshal
 		# This is also an awful hack
@@ -100,15 +318,150 @@ class Magic(object):
 	#
 	#  What can we do?
 	#
+	#  Working out what is ready to run means looking at the state of every
+	#  item in the task.  Rather than doing that on every request, we keep a
+	#  TaskDependencyManager (and the Task it was built from) for the tasks
+	#  we've used recently in task_cache, and tell it about every update that
+	#  goes through us.
+	#
+	#  Each manager remembers the version of the task it was last brought up
+	#  to date with.  Before it's used, that's checked against the store, and
+	#  if anything else (e.g. another process) has changed the task, the items
+	#  that changed are read again, or the whole task if we can't tell which.
+	#
+	#  dependency_lock is shared by every task, so nothing is read from the
+	#  store while it's held; It's only taken to look at or change a manager.
+	#
+	def dependency_manager(self, uuid):
+		'''return an up to date dependency manager for a task, loading it from the store if needed'''
+		version = self.get_version(uuid)
+		with self.dependency_lock:
+			manager = self.task_cache.get(uuid)
+			if manager is not None and manager.version == version:
+				return manager
+		if manager is not None and self._refresh_dependency_manager(uuid, manager):
+			return manager
+		version = self.get_version(uuid)
+		task = self.task_converter.taskdict_to_task(self.get_task(uuid))
+		manager = TaskDependencyManager(task, version)
+		with self.dependency_lock:
+			# Someone else may have brought it up to date while we were reading
+			current = self.task_cache.peek(uuid)
+			if current is not None and current.version >= version:
+				return current
+			self.task_cache.set(uuid, manager)
+		return manager
+
+	def _refresh_dependency_manager(self, uuid, manager):
+		'''bring a dependency manager up to date with changes made to the task in the store
+		returns False if it can't be, and should be made again from scratch
+		'''
+		since = manager.version
+		version, changes = self.store.changes(uuid, since)
+		if changes is None:
+			return False
+		converter = ItemConverter()
+		# Whatever we read now is at least as new as version
+		updates = {}
+		for name in set(change['item'] for change in changes if 'item' in change):
+			itemdict = self.store.item(uuid, name)
+			if itemdict is None or name not in manager.item_by_name:
+				return False
+			updates[name] = dict((k,v) for k,v in itemdict.items() if k not in converter.reserved_keys)
+		metadata = None
+		if any(change.get('metadata') for change in changes):
+			metadata = self.store.metadata(uuid)
+		with self.dependency_lock:
+			if self.task_cache.peek(uuid) is not manager:
+				return False
+			if manager.version != since:
+				# Someone else has changed it since we started, and we can't tell
+				# which of us read each item last
+				return manager.version >= version
+			for name,data in updates.items():
+				manager.update_item(name, data)
+			if metadata is not None:
+				manager.task.data = metadata
+			manager.version = version
+		return True
+
+	def get_task_object(self, uuid):
+		'''return a core.bits.Task for a task in the store
+		This is shared with the cache; Don't change it.
+		'''
+		return self.dependency_manager(uuid).task
+
+	def _update_dependency_manager(self, uuid, version, items=(), metadata=None):
+		'''let the dependency manager for a task know about updates we've just made
+
+		version is the version of the task they made, as per
+		Store.versioned_update_items.  They're only applied to a manager that's
+		seen everything before them; If it's seen less, it's thrown away to be
+		read again, as what it's missed could be older than what it has.
+		'''
+		count = len(items) + (metadata is not None)
+		if not count:
+			return
+		converter = ItemConverter()
+		updates = [(itemdict['name'], dict((k,v) for k,v in itemdict.items() if k not in converter.reserved_keys))
+				for itemdict in items]
+		with self.dependency_lock:
+			manager = self.task_cache.peek(uuid)
+			if manager is None:
+				return
+			if version is not None and manager.version + count == version:
+				for name,data in updates:
+					manager.update_item(name, data)
+				if metadata is not None:
+					manager.task.data = metadata
+				manager.version = version
+			elif version is None or manager.version < version:
+				self.task_cache.pop(uuid)
+
 	def ready_to_run(self, uuid):
 		'''return all the items that we can run'''
-		task = self.get_task(uuid)
-		converter = TaskConverter()
-		task = converter.taskdict_to_task(task)
-		ready =  self.dependency_strategy.ready_to_run(task.items)
+		return self.versioned_ready_to_run(uuid)[1]
+
+	def versioned_ready_to_run(self, uuid):
+		'''return a tuple of (version, items) with all the items that we can run,
+		and the version of the task that they were worked out from
+		'''
+		manager = self.dependency_manager(uuid)
+		with self.dependency_lock:
+			version, ready = manager.version, manager.ready_to_run()
 		# FIXME: Evil, Evil hack
 		if 'TaskComplete' in (r.name for r in ready):
 			self.update_item(uuid, 'TaskComplete', {'state': 'COMPLETE'})
-			return self.ready_to_run(uuid)
-		ready =  self.dependency_strategy.ready_to_run(task.items)
-		return [converter.item_to_itemdict(item) for item in ready]
+			# Nobody needs to catch up on how a finished task got there
+			self.store.forget_changes(uuid)
+			manager = self.dependency_manager(uuid)
+			with self.dependency_lock:
+				version, ready = manager.version, manager.ready_to_run()
+		converter = ItemConverter()
+		return version, [converter.item_to_itemdict(item) for item in ready]
+
+	def wait_for_ready_to_run(self, uuid, version, timeout):
+		'''wait for the items that we can run to change
+
+		If the task is still at version, waits up to timeout seconds for the
+		items that are ready to run to be different.  Only changes made through
+		this instance are noticed as they happen.
+
+		returns a tuple of (version, items) with the version of the task and
+		the items that we can run, whether anything changed or not
+		'''
+		deadline = time.time() + timeout
+		with self.notifier.watch(uuid) as watcher:
+			current, ready = self.versioned_ready_to_run(uuid)
+			if current != version:
+				return current, ready
+			names = set(item['name'] for item in ready)
+			while time.time() < deadline:
+				changes = watcher.wait(deadline - time.time())
+				if ('delete', None) in changes:
+					raise KeyError('uuid '+str(uuid)+' not found')
+				if changes:
+					current, ready = self.versioned_ready_to_run(uuid)
+					if set(item['name'] for item in ready) != names:
+						break
+		return current, ready
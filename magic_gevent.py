@@ -0,0 +1,15 @@
+#! /usr/bin/env python
+
+'''Run the make-magic httpd API with gevent
+
+Use this rather than magic_httpd.py when there are lots of workers
+connected at once, or when they wait for things to become available.
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import lib.httpd
+
+if __name__ == '__main__':
+	lib.httpd.run_gevent_httpd()
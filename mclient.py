@@ -7,7 +7,6 @@ TODO: Make useful as something other than an unintuitive debugging tool
 
 import sys
 import requests
-import random
 
 base_url = 'http://localhost:4554/'
 
@@ -32,6 +31,8 @@ class CLIhandler(object):
 		print requests.get(base_url+'task/'+uuid+'/'+item).content
 		print
 		print requests.post(base_url+'task/'+uuid+'/'+item, headers={'Content-Type':'application/json'}, data=json_item_data).content
+	def cmd_update_items(self, uuid, json_items_data):
+		print requests.post(base_url+'task/'+uuid+'/items', headers={'Content-Type':'application/json'}, data=json_items_data).content
 	def cmd_update_item_state(self, uuid, item, old_state, new_state):
 		'''Example state update
 		This is a good example of where we can do item updates that will only work if the item
@@ -43,21 +44,28 @@ class CLIhandler(object):
 		may be trying to change the state to the same thing; If we're both changing it to IN_PROGRESS,
 		we don't want to both assume that we were the one to change it to that)
 
-		We guard against this by setting an attribute to a random value, and checking when we get
-		a response that that random value is what we expect.  There is nothing magical about the
-		attribute we set, but if all workers don't use the same attribute name, it's not going to be
-		as useful.  This should only be a problem if you're using different worker codebases against
-		the same task
+		The server tells us this by the response status: 200 means our update was made, and 409
+		(Conflict) means that the item didn't match our 'onlyif' and was left alone. Either way
+		we get back what is in the item now.
 		'''
 		# show the existing state just for demonstration purposes. We don't actually use it
 		print "existing state:",
 		self.cmd_item_state(uuid,item)
-		token = random.randint(1,2**48)
-		updatewith = '{"state": "%s", "_change_state_token": %d, "onlyif": {"state": "%s"}}' % (new_state, token, old_state)
+		updatewith = '{"state": "%s", "onlyif": {"state": "%s"}}' % (new_state, old_state)
 		print "updating request:",updatewith
-		print requests.post(base_url+'task/'+uuid+'/'+item, headers={'Content-Type':'application/json'}, data=updatewith).content
+		response = requests.post(base_url+'task/'+uuid+'/'+item, headers={'Content-Type':'application/json'}, data=updatewith)
+		print "updated" if response.status_code == 200 else "NOT updated (%d)" % (response.status_code,)
+		print response.content
 	def cmd_items_ready(self, uuid):
 		print requests.get(base_url+'task/'+uuid+'/available').content
+	def cmd_claim_items(self, uuid, worker, max_items=1):
+		'''Claim items that are ready to run for a worker
+
+		This is a much better way of getting work than the above; The server will only
+		hand each item to one worker, so there's no need to check if you got the lock
+		'''
+		claimwith = '{"worker": "%s", "max_items": %d}' % (worker, int(max_items))
+		print requests.post(base_url+'task/'+uuid+'/claim', headers={'Content-Type':'application/json'}, data=claimwith).content
 	def cmd_task_delete(self, uuid):
 		print requests.delete(base_url+'task/'+uuid).content
 
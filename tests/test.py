@@ -1,12 +1,33 @@
 #! /usr/bin/env python
 
 import unittest2 as unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import json
+import cPickle
+import cherrypy
 import digraphtools
 import digraphtools.topsort as topsort
+from uuid import uuid4
+try: import mongomock
+except ImportError: mongomock = None
 
+import config
 import core.bits as bits
 import core.deptools as deptools
+import core.marshal
 import core.store
+import core.cache
+import core.notify
+import lib.httpd
+import lib.loaders
+import lib.magic
+import tools.benchmark
+import tools.lint
+import tools.migratestore
 
 class BitTests(unittest.TestCase):
 	def testTask(self):
@@ -54,6 +75,9 @@ class DigraphStrategyTests(unittest.TestCase):
 	def test_find_goal_nodes(self):
 		goals = deptools.DigraphDependencyStrategy.find_goal_nodes([self.A,self.B,self.C])
 		self.assertEqual(set([self.A]), goals)
+		class D(bits.Item): pass
+		goals = deptools.DigraphDependencyStrategy.find_goal_nodes([self.A,self.B,self.C,D])
+		self.assertEqual(set([self.A,D]), goals)
 
 class SimpleStrategyTests(unittest.TestCase):
 	def setUp(self):
@@ -64,6 +88,352 @@ class SimpleStrategyTests(unittest.TestCase):
 	def test_iterate_item_dependencies(self):
 		toporder = deptools.SimpleDependencyStrategy.iterate_item_dependencies(self.A)
 		self.assertEqual(list(toporder), [self.C,self.B,self.A])
+	def test_nested_groups(self):
+		class Z(bits.Item): pass
+		class Y(bits.Item): pass
+		class D(bits.Item): pass
+		class Inner(bits.Group): contains, depends = (self.C,), (Y,)
+		class Outer(bits.Group): contains, depends = (Inner, D), (Z,)
+		class E(bits.Item): depends = (Outer,)
+		items = deptools.SimpleDependencyStrategy.instantiate_items([self.A,self.B,self.C,D,E,Y,Z,Inner,Outer])
+		unrolled = deptools.SimpleDependencyStrategy.make_group_dependencies_explicit_for_items(set(items.values()))
+		depends = dict((item.name, set(dep.name for dep in item.depends)) for item in unrolled)
+		self.assertEqual(depends['C'], set(['Y','Z']))
+		self.assertEqual(depends['D'], set(['Z']))
+		self.assertEqual(depends['E'], set(['C','D']))
+		self.assertEqual(depends['A'], set(['B','C']))
+		self.assertEqual(items[Outer].contains, set([items[self.C], items[D]]))
+	def test_deeply_nested_groups(self):
+		catalog = tools.benchmark.synthetic_catalog(500, depth=30, groups=3)
+		classes = lib.loaders.JSONItemLoader.load_item_classes_from_string(json.dumps(catalog)).classes
+		items = set(deptools.SimpleDependencyStrategy.instantiate_items(classes).values())
+		groups = set(item for item in items if isinstance(item, bits.Group))
+		# Work out what it should be the long way round
+		def members(group):
+			for k in group.contains:
+				if k in groups:
+					for member in members(k): yield member
+				else: yield k
+		expected = dict((item, set(item.depends)) for item in items if item not in groups)
+		for group in groups:
+			for member in members(group):
+				expected[member].update(group.depends)
+		for item,deps in expected.items():
+			for group in deps.intersection(groups):
+				deps.remove(group)
+				deps.update(members(group))
+		unrolled = deptools.SimpleDependencyStrategy.make_group_dependencies_explicit_for_items(items)
+		self.assertEqual(unrolled, set(expected))
+		for item in unrolled:
+			self.assertEqual(set(item.depends), expected[item])
+	def test_transitive_reduction(self):
+		items = deptools.SimpleDependencyStrategy.instantiate_items([self.A,self.B,self.C])
+		a = items[self.A]
+		self.assertEqual(deptools.SimpleDependencyStrategy.transitive_reduction(set(items.values())), (3, 2))
+		self.assertEqual(a.depends, (items[self.B],))
+	def test_transitive_reduction_keeps_reachability(self):
+		catalog = tools.benchmark.synthetic_catalog(400, fan_in=4, depth=4, groups=4)
+		factory = lib.loaders.JSONItemLoader.load_item_classes_from_string(json.dumps(catalog))
+		def reachable(task):
+			reach = {}
+			for item in deptools.SimpleDependencyStrategy.dependency_order(task.items):
+				reach[item.name] = set(dep.name for dep in item.depends)
+				for dep in item.depends:
+					reach[item.name].update(reach[dep.name])
+			return reach
+		planned = factory.plan_task([])
+		factory.reduce_dependencies = True
+		reduced = factory.plan_task([])
+		self.assertEqual(reachable(planned), reachable(reduced))
+		self.assertTrue(factory.edges_after < factory.edges_before)
+		self.assertEqual(factory.edges_before, sum(len(item.depends) for item in planned.items))
+		self.assertEqual(factory.edges_after, sum(len(item.depends) for item in reduced.items))
+
+class DeepGraphTests(unittest.TestCase):
+	'''graphs far deeper than python will recurse'''
+	size = 100000
+	def setUp(self):
+		class Link(bits.Item): pass
+		self.chain = [Link() for i in range(self.size)]
+		for dep,item in zip(self.chain, self.chain[1:]):
+			item.depends = (dep,)
+		class Leaf(bits.Item): pass
+		class Root(bits.Item): pass
+		self.root = Root()
+		self.leaves = [Leaf() for i in range(self.size)]
+		self.root.depends = tuple(self.leaves)
+	def test_iterate_item_dependencies(self):
+		for strategy in (deptools.SimpleDependencyStrategy, deptools.GraphDependencyStrategy, deptools.DigraphDependencyStrategy):
+			self.assertEqual(list(strategy.iterate_item_dependencies(self.chain[-1])), self.chain)
+			order = list(strategy.iterate_item_dependencies(self.root))
+			self.assertEqual(order[-1], self.root)
+			self.assertEqual(sorted(order[:-1]), sorted(self.leaves))
+	def test_pruned_and_early_iteration(self):
+		strategy = deptools.SimpleDependencyStrategy
+		self.assertEqual(list(strategy.iterate_pruned_item_dependencies([], self.chain[-1])), self.chain)
+		self.assertEqual(list(strategy.early_iter_all_items(self.chain[-1])), self.chain)
+	def test_order_and_reduction(self):
+		strategy = deptools.SimpleDependencyStrategy
+		self.assertEqual(strategy.dependency_order(self.chain), self.chain)
+		self.assertEqual(strategy.transitive_reduction(self.chain), (self.size-1, self.size-1))
+		items = set(self.chain)
+		self.assertEqual(strategy.make_group_dependencies_explicit_for_items(items), items)
+	def test_matches_digraphtools(self):
+		catalog = tools.benchmark.synthetic_catalog(60, fan_in=3)
+		classes = lib.loaders.JSONItemLoader.load_item_classes_from_string(json.dumps(catalog)).classes
+		items = deptools.SimpleDependencyStrategy.instantiate_items(classes).values()
+		for goal in deptools.DigraphDependencyStrategy.find_goal_nodes(items):
+			graph = deptools.DigraphDependencyStrategy.graph_from_item_deps(goal)
+			self.assertEqual(list(deptools.DigraphDependencyStrategy.iterate_item_dependencies(goal)),
+					list(digraphtools.dfs_topsort_traversal(graph, goal)))
+
+class PredicateTests(unittest.TestCase):
+	def test_cache(self):
+		ic = core.marshal.ItemConverter()
+		pred = ic.predicate_string_to_callable('(fish|chips) & !vinegar')
+		self.assertIs(pred, ic.predicate_string_to_callable('(fish|chips) & !vinegar'))
+		other = ic.predicate_string_to_callable(' ( fish | chips )&! vinegar')
+		self.assertIs(pred.func, other.func)
+		# Strings are marshalled back as they were written
+		self.assertEqual(ic.predicate_callable_to_string(pred), '(fish|chips) & !vinegar')
+		self.assertEqual(ic.predicate_callable_to_string(other), ' ( fish | chips )&! vinegar')
+		self.assertTrue(pred(['fish']))
+		self.assertFalse(pred(['fish', 'vinegar']))
+		self.assertFalse(other(['fish', 'vinegar']))
+	def test_evaluated_once(self):
+		calls = []
+		def fish(requirements):
+			calls.append(requirements)
+			return 'fish' in requirements
+		items = [type('Item%d' % (i,), (bits.Item,), dict(predicate=fish))() for i in range(100)]
+		items.append(bits.Item())
+		kept = deptools.SimpleDependencyStrategy.filter_dependency_graph(['fish', 'chips'], items)
+		self.assertEqual(kept, set(items))
+		self.assertEqual(calls, [frozenset(['fish', 'chips'])])
+	def test_equivalent_strings_evaluated_once(self):
+		calls = []
+		def fish(requirements):
+			calls.append(requirements)
+			return 'fish' in requirements
+		preds = [core.marshal.StringPredicate(string, fish) for string in ('fish', ' fish ')]
+		items = [type('Item%d' % (i,), (bits.Item,), dict(predicate=pred))() for i,pred in enumerate(preds)]
+		kept = deptools.SimpleDependencyStrategy.filter_dependency_graph(['fish'], items)
+		self.assertEqual(kept, set(items))
+		self.assertEqual(calls, [frozenset(['fish'])])
+
+class TaskDependencyManagerTests(unittest.TestCase):
+	def setUp(self):
+		class C(bits.Item): pass
+		class B(bits.Item): depends = (C,)
+		class A(bits.Item): depends = (B,C)
+		factory = lib.loaders.TaskFactory([A,B,C])
+		self.task = factory.task_from_requirements([])
+		self.manager = deptools.TaskDependencyManager(self.task)
+	def ready_names(self):
+		return [item.name for item in self.manager.ready_to_run()]
+	def test_initial_ready(self):
+		self.assertEqual(self.ready_names(), ['C'])
+	def test_matches_strategy(self):
+		ready = deptools.DigraphDependencyStrategy.ready_to_run(self.task.items)
+		self.assertEqual(set(ready), set(self.manager.ready_to_run()))
+	def test_update_item(self):
+		self.manager.update_item('C', {'state': 'IN_PROGRESS'})
+		self.assertEqual(self.ready_names(), [])
+		self.manager.update_item('C', {'state': 'COMPLETE'})
+		self.assertEqual(self.ready_names(), ['B'])
+		self.manager.update_item('B', {'state': 'COMPLETE'})
+		self.assertEqual(self.ready_names(), ['A'])
+		self.manager.update_item('C', {'state': 'INCOMPLETE'})
+		self.assertEqual(self.ready_names(), ['C'])
+		ready = deptools.DigraphDependencyStrategy.ready_to_run(self.task.items)
+		self.assertEqual(set(ready), set(self.manager.ready_to_run()))
+
+class CompactTaskTests(unittest.TestCase):
+	def setUp(self):
+		catalog = tools.benchmark.synthetic_catalog(300, fan_in=3)
+		self.task = lib.loaders.ObjectItemLoader.taskfactory_from_objects(catalog).plan_task([])
+		self.manager = deptools.TaskDependencyManager(self.task)
+		self.compact = bits.CompactTask.from_task(self.task)
+	def tearDown(self):
+		deptools.CompactDependencyStrategy.use_numpy = deptools.numpy is not None
+	def strategies(self):
+		'''run the test with and without numpy'''
+		yield deptools.CompactDependencyStrategy
+		if deptools.numpy is not None:
+			deptools.CompactDependencyStrategy.use_numpy = False
+			yield deptools.CompactDependencyStrategy
+	def assertSameReady(self, strategy):
+		ready = [self.compact.names[i] for i in strategy.ready_to_run(self.compact)]
+		self.assertEqual(sorted(ready), sorted(item.name for item in self.manager.ready_to_run()))
+	def test_find_goal_nodes(self):
+		for strategy in self.strategies():
+			self.assertEqual(strategy.find_goal_nodes(self.compact), set([self.compact.goal]))
+	def test_ready_to_run(self):
+		for strategy in self.strategies():
+			self.assertSameReady(strategy)
+		for item in deptools.SimpleDependencyStrategy.dependency_order(self.task.items)[:150]:
+			self.manager.update_item(item.name, {'state': bits.Item.COMPLETE})
+			self.compact.set_state(item.name, bits.Item.COMPLETE)
+		for strategy in self.strategies():
+			self.assertSameReady(strategy)
+	def test_taskdict(self):
+		converter = core.marshal.TaskConverter()
+		items = [dict(converter.item_to_itemdict(item), state=item.data['state']) for item in self.task.items]
+		compact = converter.taskdict_to_compact_task({'items': items, 'metadata': {'uuid': 'fnord', 'requirements': []}})
+		self.assertEqual(compact.names, self.compact.names)
+		self.assertEqual(compact.depends, self.compact.depends)
+		self.assertEqual(compact.states, self.compact.states)
+		self.assertEqual(compact.state('TaskComplete'), bits.Item.INCOMPLETE)
+
+class TaskConverterTests(unittest.TestCase):
+	def setUp(self):
+		factory = lib.loaders.ObjectItemLoader.taskfactory_from_objects(tools.benchmark.synthetic_catalog(50, depth=2))
+		self.classes = factory.classes
+		self.converter = core.marshal.TaskConverter(self.classes)
+		task = factory.plan_task([])
+		items = [dict(self.converter.item_to_itemdict(item), state=item.data['state']) for item in task.items]
+		self.taskdict = {'items': items, 'metadata': {'uuid': 'fnord', 'requirements': []}}
+	def test_uses_catalog_classes(self):
+		task = self.converter.taskdict_to_task(self.taskdict)
+		for item in task.items:
+			if item is not task.goal:
+				self.assertIn(item.__class__, self.classes)
+			self.assertFalse(hasattr(item, '__dict__'))
+		depends = dict((itemdict['name'], itemdict.get('depends', [])) for itemdict in self.taskdict['items'])
+		for item in task.items:
+			self.assertEqual([dep.name for dep in item.depends], depends[item.name])
+	def test_unknown_classes_are_kept(self):
+		goal = self.converter.taskdict_to_task(self.taskdict).goal
+		self.assertIsInstance(goal, bits.TaskComplete)
+		self.assertIs(self.converter.taskdict_to_task(self.taskdict).goal.__class__, goal.__class__)
+
+class LRUCacheTests(unittest.TestCase):
+	def test_max_entries(self):
+		cache = core.cache.LRUCache(max_entries=2)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		self.assertEqual(cache.get('a'), 1)
+		cache.set('c', 3)
+		self.assertTrue('a' in cache)
+		self.assertFalse('b' in cache)
+		self.assertEqual(cache.get('b'), None)
+		stats = cache.stats()
+		self.assertEqual((stats['hits'],stats['misses'],stats['evictions']), (1,1,1))
+	def test_max_size(self):
+		cache = core.cache.LRUCache(max_size=10, sizeof=len)
+		cache.set('a', 'x'*6)
+		cache.set('b', 'x'*4)
+		self.assertEqual(cache.size, 10)
+		cache.set('c', 'x')
+		self.assertEqual(sorted(cache.entries.keys()), ['b','c'])
+		cache.set('d', 'x'*20)
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.size, 0)
+
+class TaskNotifierTests(unittest.TestCase):
+	def test_watch(self):
+		notifier = core.notify.TaskNotifier(backlog=2)
+		notifier.changed('123456', 'nobody is watching')
+		with notifier.watch('123456') as watcher:
+			self.assertEqual(notifier.watching(), 1)
+			self.assertEqual(watcher.wait(0), [])
+			notifier.changed('654321', 'not this one')
+			for change in ('a','b','c'):
+				notifier.changed('123456', change)
+			self.assertEqual(watcher.wait(0), ['b','c'])
+			self.assertTrue(watcher.missed)
+		self.assertEqual(notifier.watching(), 0)
+	def test_wakeup(self):
+		notifier = core.notify.TaskNotifier()
+		with notifier.watch('123456') as watcher:
+			timer = threading.Timer(0.05, notifier.changed, ('123456', 'a'))
+			timer.start()
+			self.assertEqual(watcher.wait(10), ['a'])
+			timer.join()
+
+class TaskFactoryTests(unittest.TestCase):
+	def setUp(self):
+		import tests.groupedbfast
+		self.factory = lib.loaders.TaskFactory(tests.groupedbfast.items)
+	def shape(self, task):
+		return dict((item.name, sorted(dep.name for dep in item.depends)) for item in task.items)
+	def test_template_matches_plan(self):
+		for requirements in ([], ['coffee'], ['hugs','coffee','coffee']):
+			planned = self.factory.plan_task(requirements)
+			self.assertEqual(self.shape(planned), self.shape(self.factory.task_from_requirements(requirements)))
+			self.assertEqual(self.shape(planned), self.shape(self.factory.task_from_requirements(requirements)))
+	def test_template_tasks_are_independent(self):
+		first = self.factory.task_from_requirements(['coffee'])
+		second = self.factory.task_from_requirements(['coffee'])
+		self.assertEqual(len(self.factory.templates), 1)
+		self.assertTrue(first.items.isdisjoint(second.items))
+		self.assertNotEqual(first.uuid, second.uuid)
+		for item in first.items:
+			item.data['state'] = bits.Item.COMPLETE
+		for item in second.items:
+			self.assertEqual(item.data['state'], bits.Item.INCOMPLETE)
+			for dep in item.depends:
+				self.assertTrue(dep in second.items)
+		self.assertTrue(second.goal in second.items)
+
+	def test_synthetic_catalog(self):
+		catalog = tools.benchmark.synthetic_catalog(300, fan_in=3, depth=3, groups=4, predicate_density=0.2)
+		factory = lib.loaders.JSONItemLoader.load_item_classes_from_string(json.dumps(catalog))
+		task = factory.plan_task(tools.benchmark.requirements_for())
+		self.assertTrue(0 < len(task.items) <= 301)
+		for item in task.items:
+			self.assertFalse(isinstance(item, bits.Group))
+
+class CachedItemLoaderTests(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.items = os.path.join(self.tmpdir, 'items.json')
+		self.cache = os.path.join(self.tmpdir, 'items.cache')
+		self.catalog = tools.benchmark.synthetic_catalog(200, fan_in=3, depth=3, groups=2, predicate_density=0.3)
+		with open(self.items, 'w') as f:
+			json.dump(self.catalog, f)
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def itemdicts(self, factory):
+		converter = core.marshal.ItemConverter()
+		return [converter.itemclass_to_itemdict(cls) for cls in factory.classes]
+	def test_same_as_json(self):
+		expected = self.itemdicts(lib.loaders.JSONItemLoader.load_item_classes_from_string(json.dumps(self.catalog)))
+		for attempt in range(2):
+			factory = lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+			self.assertEqual(self.itemdicts(factory), expected)
+			self.assertTrue(os.path.exists(self.cache))
+		task = factory.plan_task(tools.benchmark.requirements_for())
+		self.assertTrue(task.goal in task.items)
+	def test_items_changed(self):
+		lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+		with open(self.items, 'w') as f:
+			json.dump([{'name': 'fnord'}], f)
+		factory = lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+		self.assertEqual(self.itemdicts(factory), [{'name': 'fnord'}])
+	def test_bad_cache(self):
+		with open(self.cache, 'w') as f:
+			f.write('not a pickle')
+		factory = lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+		self.assertEqual(len(factory.classes), len(self.catalog))
+	def test_missing_items(self):
+		for catalog in ([{'name': 'a', 'depends': ['fnord']}], [{'name': 'a'}, {'group': 'g', 'contains': ['a', 'fnord']}]):
+			with open(self.items, 'w') as f:
+				json.dump(catalog, f)
+			self.assertRaises(ValueError, lib.loaders.CachedItemLoader.load_item_classes_from_path, self.items, self.cache)
+			self.assertFalse(os.path.exists(self.cache))
+	def test_wrong_cache(self):
+		lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+		with open(self.cache, 'rb') as f:
+			version, digest, compiled = cPickle.load(f)
+		kind, name, description, predicate, depends, contains = compiled[-1]
+		compiled[-1] = (kind, name, description, predicate, depends + (len(compiled),), contains)
+		lib.loaders.CachedItemLoader.write_cache(self.cache, digest, compiled)
+		self.assertRaises(ValueError, lib.loaders.CachedItemLoader.taskfactory_from_compiled, compiled)
+		# It's made again from the items
+		factory = lib.loaders.CachedItemLoader.load_item_classes_from_path(self.items, self.cache)
+		self.assertEqual(len(factory.classes), len(self.catalog))
+		self.assertEqual(lib.loaders.CachedItemLoader.read_cache(self.cache, digest)[-1][4], compiled[-1][4][:-1])
 
 class TopsortTests(unittest.TestCase):
 	def test_vr_topsort(self):
@@ -74,18 +444,679 @@ class TopsortTests(unittest.TestCase):
         	for le in topsort.vr_topsort(n,grid):
 			digraphtools.verify_partial_order(digraphtools.iter_partial_order(g), le)
 
-class StoreTests(unittest.TestCase):
-	sample_json = '[{"name": "wake_up"}, {"depends": ["wake_up"], "name": "get_up"}, {"depends": ["get_up"], "name": "make_coffee"}, {"depends": ["make_coffee"], "name": "drink_coffee"}, {"depends": ["get_up"], "name": "make_breakfast"}, {"depends": ["make_breakfast"], "name": "eat_breakfast"}, {"depends": ["get_up", "eat_breakfast", "make_coffee"], "name": "walk_out_door"}, {"depends": ["walk_out_door", "eat_breakfast", "drink_coffee"], "name": "go_to_work", "description": "Leave to go to work"}]'
-	def _dont_test_memorystore(self):
-		uuid = '123456'
-		ms = core.store.MemoryStore()
-		self.assertFalse(ms.exists(uuid))
-		self.assertFalse(ms.exists(uuid, 'items'))
-		ms.new_task(uuid)
-		self.assertTrue(ms.exists(uuid))
-		self.assertFalse(ms.exists(uuid, 'items'))
-		ms.store(uuid, 'items', self.sample_json)
-		self.assertEqual(ms.retrieve(uuid, 'items'), self.sample_json)
+class LintTests(unittest.TestCase):
+	def lint(self, catalog):
+		tools.lint.lint_taskfactory(lib.loaders.ObjectItemLoader.taskfactory_from_objects(catalog))
+	def test_cycles(self):
+		self.lint([{'name': 'a'}, {'name': 'b', 'depends': ['g']}, {'group': 'g', 'contains': ['a', 'h']}, {'group': 'h', 'contains': ['a']}])
+		self.assertRaises(tools.lint.LintError, self.lint, [{'name': 'a', 'depends': ['b']}, {'name': 'b', 'depends': ['a']}])
+	def test_group_cycles(self):
+		# Depending on a group you're in
+		self.assertRaises(tools.lint.LintError, self.lint, [{'name': 'a', 'depends': ['g']}, {'name': 'b'}, {'group': 'g', 'contains': ['a', 'b']}])
+		# Being in a group that depends on something that depends on you
+		self.assertRaises(tools.lint.LintError, self.lint, [{'name': 'a'}, {'name': 'b', 'depends': ['a']}, {'group': 'g', 'contains': ['a'], 'depends': ['b']}])
+		self.assertRaises(tools.lint.LintError, self.lint, [{'name': 'a'}, {'group': 'g', 'contains': ['h']}, {'group': 'h', 'contains': ['g', 'a']}])
+
+class StoreTestsMixin(object):
+	'''tests that every store should pass. Set self.store in setUp'''
+	items = [{'name': 'wake_up', 'state': 'INCOMPLETE'},
+		 {'name': 'get_up', 'state': 'INCOMPLETE', 'depends': ['wake_up']}]
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.store = self.make_store()
+		self.store.new_task('123456', [dict(item) for item in self.items], {'requirements': ['coffee']})
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def test_new_task(self):
+		self.assertEqual(list(self.store.get_tasks()), ['123456'])
+		self.assertEqual(self.store.items('123456'), self.items)
+		self.assertEqual(self.store.item('123456', 'get_up'), self.items[1])
+		self.assertEqual(self.store.item('123456', 'fnord'), None)
+		metadata = self.store.metadata('123456')
+		self.assertEqual(metadata, {'requirements': ['coffee'], 'uuid': '123456', 'metadata': True})
+		self.assertEqual(self.store.metadata('654321'), None)
+	def test_get_tasks(self):
+		for uuid in ('3','1','2'):
+			self.store.new_task(uuid, [], {})
+		self.assertEqual(self.store.get_tasks(), ['1','123456','2','3'])
+		self.assertEqual(self.store.get_tasks(limit=2), ['1','123456'])
+		self.assertEqual(self.store.get_tasks(limit=2, after='123456'), ['2','3'])
+		self.assertEqual(self.store.get_tasks(after='3'), [])
+	def test_update_item(self):
+		updated, item = self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'}, {'state': 'FAILED'})
+		self.assertFalse(updated)
+		self.assertEqual(item['state'], 'INCOMPLETE')
+		updated, item = self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE', 'data': [1,{'a':None}]}, {'state': 'INCOMPLETE'})
+		self.assertTrue(updated)
+		self.assertEqual(item, {'name': 'wake_up', 'state': 'COMPLETE', 'data': [1,{'a':None}]})
+		self.assertEqual(self.store.item('123456', 'wake_up'), item)
+		updated, item = self.store.update_item('123456', 'wake_up', {'state': 'FAILED'}, {'data': [1,{'a':None}]})
+		self.assertTrue(updated)
+		self.assertEqual(item['state'], 'FAILED')
+		self.assertEqual(self.store.update_item('123456', 'fnord', {'state': 'FAILED'}), (False, None))
+	def test_version(self):
+		self.assertEqual(self.store.version('123456'), 0)
+		self.assertEqual(self.store.version('654321'), None)
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'}, {'state': 'FAILED'})
+		self.assertEqual(self.store.version('123456'), 0)
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		self.store.update_items('123456', [('wake_up', {'state': 'FAILED'}, {}), ('get_up', {'state': 'COMPLETE'}, {})])
+		self.store.update_metadata('123456', {'owner': 'fred'})
+		self.assertEqual(self.store.version('123456'), 4)
+		self.assertFalse('_version' in self.store.metadata('123456'))
+	def test_changes(self):
+		self.assertEqual(self.store.changes('123456', 0), (0, []))
+		self.assertEqual(self.store.changes('654321', 0), (None, None))
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		self.store.update_item('123456', 'get_up', {'state': 'COMPLETE'}, {'state': 'FAILED'})
+		self.store.update_items('123456', [('get_up', {'state': 'COMPLETE'}, {})])
+		self.store.update_metadata('123456', {'owner': 'fred'})
+		self.assertEqual(self.store.changes('123456', 1), (3, [
+			{'version': 2, 'item': 'get_up', 'update': {'state': 'COMPLETE'}},
+			{'version': 3, 'metadata': True, 'update': {'owner': 'fred'}}]))
+		self.assertEqual(self.store.changes('123456', 0)[1][0]['item'], 'wake_up')
+		self.store.forget_changes('123456')
+		self.assertEqual(self.store.changes('123456', 2), (3, None))
+		self.assertEqual(self.store.changes('123456', 3), (3, []))
+		self.store.update_item('123456', 'wake_up', {'state': 'FAILED'})
+		self.assertEqual(self.store.changes('123456', 3)[1], [{'version': 4, 'item': 'wake_up', 'update': {'state': 'FAILED'}}])
+	def test_update_items(self):
+		results = self.store.update_items('123456', [('wake_up', {'state': 'COMPLETE'}, {}),
+				('get_up', {'state': 'COMPLETE'}, {'state': 'FAILED'}), ('fnord', {'state': 'COMPLETE'}, {})])
+		self.assertEqual([updated for updated,item in results], [True,False,False])
+		self.assertEqual([item and item['state'] for updated,item in results], ['COMPLETE','INCOMPLETE',None])
+	def test_update_metadata(self):
+		updated, metadata = self.store.update_metadata('123456', {'owner': 'fred'}, {'owner': 'bob'})
+		self.assertFalse(updated)
+		self.assertFalse('owner' in metadata)
+		updated, metadata = self.store.update_metadata('123456', {'owner': 'fred'})
+		self.assertTrue(updated)
+		self.assertEqual(metadata['owner'], 'fred')
+		self.assertEqual(self.store.update_metadata('654321', {'owner': 'fred'}), (False, None))
+		self.assertEqual(self.store.metadata('123456')['owner'], 'fred')
+	def test_versioned_updates(self):
+		version, results = self.store.versioned_update_items('123456', [('wake_up', {'state': 'COMPLETE'}, {})])
+		self.assertEqual((version, results), (1, [(True, {'name': 'wake_up', 'state': 'COMPLETE'})]))
+		version, results = self.store.versioned_update_items('123456', [('wake_up', {'state': 'FAILED'}, {}),
+				('get_up', {'state': 'COMPLETE'}, {'state': 'FAILED'}), ('fnord', {'state': 'COMPLETE'}, {})])
+		self.assertEqual((version, [updated for updated,item in results]), (2, [True,False,False]))
+		version, results = self.store.versioned_update_items('123456', [('get_up', {'state': 'COMPLETE'}, {'state': 'FAILED'})])
+		self.assertEqual((version, [updated for updated,item in results]), (None, [False]))
+		version, updated, metadata = self.store.versioned_update_metadata('123456', {'owner': 'fred'})
+		self.assertEqual((version, updated, metadata['owner']), (3, True, 'fred'))
+		version, updated, metadata = self.store.versioned_update_metadata('123456', {'owner': 'bob'}, {'owner': 'jim'})
+		self.assertEqual((version, updated, metadata['owner']), (None, False, 'fred'))
+		self.assertEqual(self.store.version('123456'), 3)
+	def test_metadata_internal_keys_ignored(self):
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		updated, metadata = self.store.update_metadata('123456', {'owner': 'fred', '_changes_from': 50, '_changes': [], '_version': 7})
+		self.assertTrue(updated)
+		self.assertFalse([key for key in metadata if key.startswith('_')])
+		self.assertEqual(self.store.changes('123456', 0), (2, [{'version': 1, 'item': 'wake_up', 'update': {'state': 'COMPLETE'}},
+				{'version': 2, 'metadata': True, 'update': {'owner': 'fred'}}]))
+	def test_delete_task(self):
+		self.store.delete_task('123456')
+		self.assertEqual(list(self.store.get_tasks()), [])
+		self.assertEqual(self.store.items('123456'), [])
+		self.assertEqual(self.store.metadata('123456'), None)
+
+@unittest.skipUnless(mongomock, 'needs mongomock')
+class MongoStoreTests(StoreTestsMixin, unittest.TestCase):
+	store_class = core.store.MongoStore
+	def make_store(self):
+		connection = core.store.pymongo.Connection
+		core.store.pymongo.Connection = lambda server, port: mongomock.MongoClient()
+		try:
+			return self.store_class(database='magic_test')
+		finally:
+			core.store.pymongo.Connection = connection
+	def tearDown(self):
+		self.store.connection.drop_database('magic_test')
+		StoreTestsMixin.tearDown(self)
+	def test_stopped_before_logging(self):
+		def stop(uuid, changes):
+			raise KeyboardInterrupt
+		self.store._log_changes = stop
+		self.assertRaises(KeyboardInterrupt, self.store.update_item, '123456', 'wake_up', {'state': 'COMPLETE'})
+		self.assertRaises(KeyboardInterrupt, self.store.update_items, '123456', [('get_up', {'state': 'FAILED'}, {})])
+		del self.store._log_changes
+		self.assertEqual(self.store.item('123456', 'wake_up'), {'name': 'wake_up', 'state': 'COMPLETE'})
+		# Reading doesn't go looking for them, but trimming the log does
+		self.assertEqual(self.store.version('123456'), 0)
+		self.store.max_changes = 2
+		for owner in ('fred', 'bob', 'jim'):
+			self.store.update_metadata('123456', {'owner': owner})
+		self.assertEqual(self.store.version('123456'), 5)
+		collection = self.store._item_collection('123456')
+		self.assertFalse(collection.find_one(self.store._item_query('123456', _unlogged={'$exists': True})))
+		# Only logged once
+		self.store.update_item('123456', 'wake_up', {'state': 'FAILED'})
+		self.assertEqual(self.store.changes('123456', 5), (6, [{'version': 6, 'item': 'wake_up', 'update': {'state': 'FAILED'}}]))
+		# Nor are they lost when the log is forgotten
+		self.store._log_changes = stop
+		self.assertRaises(KeyboardInterrupt, self.store.update_items, '123456', [('get_up', {'state': 'COMPLETE'}, {})])
+		del self.store._log_changes
+		self.store.forget_changes('123456')
+		self.assertEqual(self.store.changes('123456', 7), (7, []))
+	def test_update_items_leave_nothing_behind(self):
+		collection = self.store._item_collection('123456')
+		collection.update({'name': 'get_up'}, {'$set': {'_update_token': 'fnord-0'}})
+		results = self.store.update_items('123456', [('wake_up', {'state': 'COMPLETE'}, {}),
+				('get_up', {'state': 'COMPLETE'}, {}), ('wake_up', {'state': 'FAILED'}, {'state': 'INCOMPLETE'})])
+		self.assertEqual(results, [(True, {'name': 'wake_up', 'state': 'COMPLETE'}),
+				(True, {'name': 'get_up', 'state': 'COMPLETE', 'depends': ['wake_up']}),
+				(False, {'name': 'wake_up', 'state': 'COMPLETE'})])
+		for item in collection.find(self.store._item_query('123456')):
+			self.assertFalse('_update_token' in item or '_unlogged' in item)
+		self.assertEqual(self.store.version('123456'), 2)
+	def test_versioned_update_overtaken(self):
+		log_changes = self.store._log_changes
+		def overtaken(uuid, changes):
+			self.store._set_item(uuid, 'wake_up', {'state': 'FAILED'}, {})
+			return log_changes(uuid, changes)
+		self.store._log_changes = overtaken
+		# The item isn't as it was at the version any more
+		version, results = self.store.versioned_update_items('123456', [('wake_up', {'state': 'COMPLETE'}, {})])
+		self.assertEqual((version, results), (None, [(True, {'name': 'wake_up', 'state': 'COMPLETE'})]))
+	def count_round_trips(self, call, *args):
+		'''return how many requests to the database call(*args) makes'''
+		calls, depth = [], [0]
+		def counted(method):
+			def wrapper(*args, **argd):
+				# mongomock calls it's own methods to get things done
+				if not depth[0]:
+					calls.append(method.__name__)
+				depth[0] += 1
+				try:
+					return method(*args, **argd)
+				finally:
+					depth[0] -= 1
+			return wrapper
+		names = ['find', 'find_one', 'find_and_modify', 'update', 'insert', 'remove']
+		originals = dict((name, getattr(mongomock.Collection, name)) for name in names)
+		for name,method in originals.items():
+			setattr(mongomock.Collection, name, counted(method))
+		try:
+			call(*args)
+		finally:
+			for name,method in originals.items():
+				setattr(mongomock.Collection, name, method)
+		return len(calls)
+	def test_round_trips(self):
+		# One each to update the items, one to log them, and one to say they've been logged
+		self.assertEqual(self.count_round_trips(self.store.update_item, '123456', 'wake_up', {'state': 'COMPLETE'}), 3)
+		self.assertEqual(self.count_round_trips(self.store.update_items, '123456',
+				[('wake_up', {'count': 1}, {}), ('get_up', {'count': 1}, {})]), 4)
+		self.assertEqual(self.store.version('123456'), 3)
+		# Reads only read
+		self.assertEqual(self.count_round_trips(self.store.version, '123456'), 1)
+		self.assertEqual(self.count_round_trips(self.store.changes, '123456', 0), 1)
+	def test_max_changes(self):
+		self.store.max_changes = 4
+		for i in range(5):
+			self.store.update_item('123456', 'wake_up', {'count': i})
+		self.assertEqual(self.store.changes('123456', 2), (5, None))
+		self.assertEqual([change['update']['count'] for change in self.store.changes('123456', 3)[1]], [3,4])
+		self.store.update_items('123456', [('wake_up', {'count': 5}, {}), ('get_up', {'count': 5}, {})])
+		self.assertEqual(len(self.store.changes('123456', 3)[1]), 4)
+		self.store.update_metadata('123456', {'owner': 'fred'})
+		self.assertEqual(self.store.changes('123456', 5), (8, None))
+		self.assertEqual(self.store.changes('123456', 6)[1], [{'version': 7, 'item': 'get_up', 'update': {'count': 5}},
+				{'version': 8, 'metadata': True, 'update': {'owner': 'fred'}}])
+
+class SharedMongoStoreTests(MongoStoreTests):
+	store_class = core.store.SharedMongoStore
+	def test_internal_keys_ignored(self):
+		self.store.new_task('654321', [], {})
+		self.assertEqual(self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE', '_task': '654321'}),
+				(True, {'name': 'wake_up', 'state': 'COMPLETE'}))
+		self.store.update_items('123456', [('get_up', {'_task': '654321', '_unlogged': None}, {})])
+		self.assertEqual([item['name'] for item in self.store.items('123456')], ['wake_up', 'get_up'])
+		self.assertEqual(self.store.items('654321'), [])
+		self.assertEqual(self.store.changes('654321', 0), (0, []))
+		self.assertEqual(self.store.version('123456'), 2)
+	def test_tasks_kept_apart(self):
+		self.store.new_task('654321', [{'name': 'wake_up', 'state': 'COMPLETE'}], {})
+		self.assertEqual(self.store.items('654321'), [{'name': 'wake_up', 'state': 'COMPLETE'}])
+		self.assertEqual(self.store.item('123456', 'wake_up')['state'], 'INCOMPLETE')
+		self.store.update_item('654321', 'wake_up', {'state': 'FAILED'})
+		self.assertEqual(self.store.item('123456', 'wake_up')['state'], 'INCOMPLETE')
+		self.assertEqual((self.store.version('123456'), self.store.version('654321')), (0, 1))
+		self.store.delete_task('654321')
+		self.assertEqual(self.store.items('123456'), self.items)
+		self.assertEqual(self.store.get_tasks(), ['123456'])
+
+class MigrateStoreTests(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.source = core.store.MemoryStore(journal=False)
+		self.destination = core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite'))
+		for uuid in ('123456', '654321'):
+			self.source.new_task(uuid, [dict(item) for item in StoreTestsMixin.items], {'requirements': ['coffee']})
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def test_migrate_store(self):
+		self.source.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		self.destination.new_task('654321', [], {'requirements': []})
+		self.assertEqual(tools.migratestore.migrate_store(self.source, self.destination), 1)
+		self.assertEqual(self.destination.get_tasks(), ['123456', '654321'])
+		self.assertEqual(self.destination.items('123456'), self.source.items('123456'))
+		self.assertEqual(self.destination.metadata('123456'), self.source.metadata('123456'))
+		# Tasks that were already there are left alone
+		self.assertEqual(self.destination.items('654321'), [])
+		self.assertEqual(self.source.get_tasks(), ['123456', '654321'])
+	def test_migrate_again(self):
+		self.assertEqual(tools.migratestore.migrate_store(self.source, self.destination), 2)
+		self.assertEqual(tools.migratestore.migrate_store(self.source, self.destination, delete=True), 0)
+		self.assertEqual(self.source.get_tasks(), ['123456', '654321'])
+		self.assertFalse(tools.migratestore.migrate_task(self.source, self.destination, 'fnord'))
+	def test_delete(self):
+		self.assertEqual(tools.migratestore.migrate_store(self.source, self.destination, delete=True), 2)
+		self.assertEqual(self.source.get_tasks(), [])
+		self.assertEqual(self.destination.get_tasks(), ['123456', '654321'])
+
+class SQLiteStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		return core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite'))
+
+class MemoryStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		return core.store.MemoryStore(journal=False)
+	def test_returns_copies(self):
+		self.store.item('123456', 'wake_up')['state'] = 'FAILED'
+		self.store.items('123456')[0]['state'] = 'FAILED'
+		self.assertEqual(self.store.item('123456', 'wake_up')['state'], 'INCOMPLETE')
+
+class MemoryStoreJournalTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self, compact_every=1000):
+		self.journal = os.path.join(self.tmpdir, 'magic.journal')
+		return core.store.MemoryStore(self.journal, sync_batch=1000, sync_interval=60, compact_every=compact_every)
+	def reloaded(self, store):
+		store.sync()
+		reloaded = core.store.MemoryStore(self.journal, sync_batch=1000, sync_interval=60, compact_every=1000)
+		reloaded.close()
+		return reloaded
+	def tearDown(self):
+		self.store.close()
+		StoreTestsMixin.tearDown(self)
+	def test_replay(self):
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'}, {'state': 'INCOMPLETE'})
+		self.store.update_item('123456', 'get_up', {'state': 'COMPLETE'}, {'state': 'FAILED'})
+		self.store.update_metadata('123456', {'owner': 'fred'})
+		self.store.new_task('654321', [], {})
+		self.store.delete_task('654321')
+		store = self.reloaded(self.store)
+		self.assertEqual(list(store.get_tasks()), ['123456'])
+		self.assertEqual(store.items('123456'), self.store.items('123456'))
+		self.assertEqual(store.item('123456', 'wake_up')['state'], 'COMPLETE')
+		self.assertEqual(store.item('123456', 'get_up')['state'], 'INCOMPLETE')
+		self.assertEqual(store.metadata('123456')['owner'], 'fred')
+		self.assertEqual(store.changes('123456', 0), self.store.changes('123456', 0))
+	def test_partial_write(self):
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		self.store.sync()
+		with open(self.journal, 'a') as journal:
+			journal.write('["item", "123456", "get_up", {"sta')
+		store = self.reloaded(self.store)
+		self.assertEqual(store.item('123456', 'wake_up')['state'], 'COMPLETE')
+		self.assertEqual(store.item('123456', 'get_up')['state'], 'INCOMPLETE')
+	def test_write_after_partial_write(self):
+		self.store.update_item('123456', 'wake_up', {'state': 'COMPLETE'})
+		self.store.close()
+		with open(self.journal, 'a') as journal:
+			journal.write('["item", "123456", "get_up", {"sta')
+		store = self.store = self.make_store()
+		store.update_item('123456', 'get_up', {'state': 'COMPLETE'})
+		store.update_metadata('123456', {'owner': 'fred'})
+		store = self.reloaded(store)
+		self.assertEqual(store.item('123456', 'wake_up')['state'], 'COMPLETE')
+		self.assertEqual(store.item('123456', 'get_up')['state'], 'COMPLETE')
+		self.assertEqual(store.metadata('123456')['owner'], 'fred')
+		self.assertEqual(store.version('123456'), 3)
+	def test_compaction(self):
+		self.store.close()
+		store = self.store = self.make_store(compact_every=10)
+		for i in range(25):
+			store.update_item('123456', 'wake_up', {'count': i})
+			store.sync()
+		with open(self.journal) as journal:
+			self.assertTrue(len(journal.readlines()) < 10)
+		self.assertEqual(self.reloaded(store).item('123456', 'wake_up')['count'], 24)
+		self.assertEqual(self.reloaded(store).version('123456'), 25)
+		store.update_metadata('123456', {'owner': 'fred'})
+		store.compact()
+		with open(self.journal) as journal:
+			self.assertEqual(len(journal.readlines()), 1)
+		self.assertEqual(self.reloaded(store).metadata('123456')['owner'], 'fred')
+
+class PooledStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		path = os.path.join(self.tmpdir, 'magic.sqlite')
+		return core.store.PooledStore(lambda: core.store.SQLiteStore(path), size=2, timeout=0.01)
+	def test_pool_limits(self):
+		with self.store.checkout() as first:
+			with self.store.checkout() as second:
+				self.assertFalse(first is second)
+				self.assertRaises(core.store.StoreUnavailable, self.store.item, '123456', 'wake_up')
+			self.assertEqual(self.store.item('123456', 'wake_up')['name'], 'wake_up')
+		stats = self.store.stats()
+		self.assertEqual(stats['created'], 2)
+		self.assertEqual(stats['timeouts'], 1)
+		self.assertEqual(stats['in_use'], 0)
+	def test_unpoolable(self):
+		factory = core.store.pooled_store_factory(core.store.MemoryStore)
+		self.assertTrue(factory is core.store.MemoryStore)
+
+class ExecutorStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		self.threads = set()
+		return core.store.ExecutorStore(core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')), self.apply)
+	def apply(self, method, args, argd):
+		'''run the method in another thread'''
+		result = []
+		thread = threading.Thread(target=lambda: result.append(method(*args, **argd)))
+		thread.start()
+		thread.join()
+		self.threads.add(thread.ident)
+		return result[0]
+	def test_executed(self):
+		self.store.item('123456', 'wake_up')
+		self.assertTrue(self.threads)
+		self.assertFalse(threading.current_thread().ident in self.threads)
+
+class ShardedStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		return core.store.ShardedStore([(name, core.store.MemoryStore(journal=False)) for name in ('a','b','c')])
+	def tearDown(self):
+		self.store.close()
+		StoreTestsMixin.tearDown(self)
+	def test_spread(self):
+		uuids = set(str(uuid4()) for i in range(300)).union(['123456'])
+		for uuid in uuids:
+			self.store.new_task(uuid, [], {})
+		seen = []
+		for name,shard in self.store.shards.items():
+			self.assertTrue(50 < len(shard.get_tasks()) < 150)
+			seen.extend(shard.get_tasks())
+		self.assertEqual(sorted(seen), sorted(uuids))
+		self.assertEqual(self.store.get_tasks(), sorted(uuids))
+		self.assertEqual(self.store.get_tasks(limit=10, after=min(uuids)), sorted(uuids)[1:11])
+	def test_adding_shards(self):
+		bigger = core.store.ShardedStore(self.store.shards.items() + [('d', core.store.MemoryStore(journal=False))])
+		uuids = [str(uuid4()) for i in range(1000)]
+		moved = [uuid for uuid in uuids if bigger.shard(uuid) is not self.store.shard(uuid)]
+		self.assertTrue(len(moved) < 400)
+		for uuid in moved:
+			self.assertIs(bigger.shard(uuid), bigger.shards['d'])
+		bigger.threads.close()
+
+class ShardedSQLiteStoreTests(StoreTestsMixin, unittest.TestCase):
+	def make_store(self):
+		shards = [(name, {'store': 'sqlite', 'path': os.path.join(self.tmpdir, name+'.sqlite')}) for name in ('a','b')]
+		return core.store.ShardedStore(core.store.ShardedStore.shards_from_config(shards))
+	def tearDown(self):
+		self.store.close()
+		StoreTestsMixin.tearDown(self)
+	def test_pooled(self):
+		for shard in self.store.shards.values():
+			self.assertIsInstance(shard, core.store.PooledStore)
+		self.assertEqual(sorted(self.store.stats()['shards']), ['a','b'])
+	def test_memory_journals(self):
+		journal = lambda name: os.path.join(self.tmpdir, name+'.journal')
+		shards = core.store.ShardedStore.shards_from_config([('a', {'store': 'memory', 'journal': journal('a')}),
+				('b', {'store': 'memory', 'journal': False}), ('c', {'store': 'memory', 'journal': False})])
+		self.assertEqual(shards[0][1].journal, journal('a'))
+		for name,store in shards: store.close()
+		self.assertRaises(ValueError, core.store.ShardedStore.shards_from_config, [('a', {'store': 'memory'})])
+		self.assertRaises(ValueError, core.store.ShardedStore.shards_from_config, [('a', {'store': 'memory', 'journal': journal('a')}),
+				('b', {'store': 'memory', 'journal': journal('a')})])
+	def test_wrap_blocking(self):
+		wrapped = []
+		def wrap(store):
+			wrapped.append(store)
+			return store
+		shards = [('a', {'store': 'sqlite', 'path': os.path.join(self.tmpdir, 'a.sqlite')}), ('b', {'store': 'memory', 'journal': False})]
+		store = core.store.ShardedStore(core.store.ShardedStore.shards_from_config(shards, wrap))
+		store.shards['a'].item('123456', 'wake_up')
+		store.shards['b'].get_tasks()
+		self.assertEqual([type(shard) for shard in wrapped], [core.store.SQLiteStore])
+		store.close()
+
+class MagicTests(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.magic = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.uuid = self.magic.create_task({'requirements': ['coffee']})['metadata']['uuid']
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def ready_names(self):
+		return set(item['name'] for item in self.magic.ready_to_run(self.uuid))
+	def test_ready_to_run(self):
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		self.magic.update_item(self.uuid, 'get_up', {'state': 'COMPLETE'})
+		self.assertEqual(self.ready_names(), set(['make_breakfast','make_coffee']))
+	def test_other_writers(self):
+		other = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		other.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		other.update_item(self.uuid, 'get_up', {'state': 'COMPLETE'})
+		self.assertEqual(self.ready_names(), set(['make_breakfast','make_coffee']))
+		self.assertEqual(len(self.magic.claim_items(self.uuid, 'worker1', 5)), 2)
+		other.update_task_metadata(self.uuid, {'owner': 'fred'})
+		self.assertEqual(self.magic.get_task_object(self.uuid).data['owner'], 'fred')
+		# Finishing a task throws away it's changes, so everything is read again
+		while other.ready_to_run(self.uuid):
+			for item in other.ready_to_run(self.uuid):
+				other.update_item(self.uuid, item['name'], {'state': 'COMPLETE'})
+		self.assertEqual(self.ready_names(), set())
+		other.delete_task(self.uuid)
+		self.assertRaises(KeyError, self.magic.ready_to_run, self.uuid)
+	def test_versioned_ready_to_run(self):
+		other = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		version, ready = self.magic.versioned_ready_to_run(self.uuid)
+		self.assertEqual((version, [item['name'] for item in ready]), (0, ['wake_up']))
+		other.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		# The version has to go with the items, even when they were cached before the update
+		version, ready = self.magic.versioned_ready_to_run(self.uuid)
+		self.assertEqual((version, [item['name'] for item in ready]), (1, ['get_up']))
+		self.assertEqual(version, other.get_version(self.uuid))
+	def test_delayed_update(self):
+		other = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		delayed = []
+		self.magic._update_dependency_manager = lambda *args, **argd: delayed.append((args, argd))
+		self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		del self.magic._update_dependency_manager
+		other.update_item(self.uuid, 'wake_up', {'state': 'FAILED'})
+		self.assertEqual(self.ready_names(), set())
+		# The manager has already read past it, and shouldn't go back
+		for args,argd in delayed:
+			self.magic._update_dependency_manager(*args, **argd)
+		self.assertEqual(self.ready_names(), set())
+		self.assertEqual(self.magic.dependency_manager(self.uuid).version, 2)
+		# Anything that hasn't seen what came before it is thrown away to be read again
+		delayed = []
+		self.magic._update_dependency_manager = lambda *args, **argd: delayed.append((args, argd))
+		self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		self.magic.update_item(self.uuid, 'get_up', {'state': 'COMPLETE'})
+		del self.magic._update_dependency_manager
+		self.magic._update_dependency_manager(*delayed[1][0], **delayed[1][1])
+		self.assertEqual(self.magic.task_cache.peek(self.uuid), None)
+		self.assertEqual(self.ready_names(), set(['make_breakfast','make_coffee']))
+		# And otherwise it's kept up to date without reading anything
+		manager = self.magic.dependency_manager(self.uuid)
+		self.magic.update_item(self.uuid, 'make_coffee', {'state': 'COMPLETE'})
+		self.assertEqual(manager.version, 5)
+		self.assertTrue(self.magic.task_cache.peek(self.uuid) is manager)
+	def test_store_read_without_lock(self):
+		other = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		other.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		reading, release = threading.Event(), threading.Event()
+		changes = self.magic.store.changes
+		def slow_changes(uuid, since):
+			reading.set()
+			release.wait(5)
+			return changes(uuid, since)
+		self.magic.store.changes = slow_changes
+		names = []
+		thread = threading.Thread(target=lambda: names.append(self.ready_names()))
+		thread.start()
+		try:
+			self.assertTrue(reading.wait(5))
+			# Nobody else has to wait for a slow read to use their own tasks
+			self.assertTrue(self.magic.dependency_lock.acquire(False))
+			self.magic.dependency_lock.release()
+		finally:
+			release.set()
+			thread.join()
+		self.assertEqual(names, [set(['get_up'])])
+	def test_run_to_completion(self):
+		while True:
+			ready = self.magic.ready_to_run(self.uuid)
+			if not ready: break
+			for item in ready:
+				self.magic.update_item(self.uuid, item['name'], {'state': 'COMPLETE'})
+		self.assertEqual(self.magic.get_item(self.uuid, 'TaskComplete')['state'], 'COMPLETE')
+	def test_update_item(self):
+		self.assertEqual(self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE', 'onlyif': {'state': 'FAILED'}})[0], False)
+		updated, item = self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'}, {'state': 'INCOMPLETE'})
+		self.assertTrue(updated)
+		self.assertEqual(item['state'], 'COMPLETE')
+		self.assertRaises(KeyError, self.magic.update_item, self.uuid, 'fnord', {'state': 'COMPLETE'})
+		self.assertRaises(ValueError, self.magic.update_item, self.uuid, 'wake_up', {'state': 'FNORD'})
+		for key in ('_task', '_id', '_unlogged', '_update_token', '_version', '_changes', '_changes_from'):
+			self.assertRaises(ValueError, self.magic.update_item, self.uuid, 'wake_up', {'state': 'COMPLETE', key: 'fnord'})
+			self.assertRaises(ValueError, self.magic.update_items, self.uuid, [('wake_up', {key: 'fnord'})])
+		self.assertFalse([key for key in self.magic.get_item(self.uuid, 'wake_up') if key.startswith('_')])
+	def test_get_tasks(self):
+		other = self.magic.create_task({'requirements': ['coffee']})['metadata']['uuid']
+		self.assertEqual(self.magic.get_tasks(), sorted([self.uuid, other]))
+		self.assertEqual(self.magic.get_tasks(limit=1, after=min(self.uuid, other)), [max(self.uuid, other)])
+		self.assertRaises(ValueError, self.magic.get_tasks, limit=0)
+	def test_get_changes(self):
+		self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		self.assertEqual(self.magic.get_changes(self.uuid, 0),
+				{'version': 1, 'changes': [{'version': 1, 'item': 'wake_up', 'update': {'state': 'COMPLETE'}}]})
+		self.assertRaises(ValueError, self.magic.get_changes, self.uuid, '0')
+		self.assertRaises(KeyError, self.magic.get_changes, 'fnord', 0)
+		self.test_run_to_completion()
+		changes = self.magic.get_changes(self.uuid, 1)
+		self.assertEqual(changes['task']['metadata']['uuid'], self.uuid)
+		self.assertEqual(self.magic.get_changes(self.uuid, changes['version']), {'version': changes['version'], 'changes': []})
+	def test_update_task_metadata(self):
+		self.assertEqual(self.magic.update_task_metadata(self.uuid, {'owner': 'fred', 'onlyif': {'owner': 'bob'}})[0], False)
+		self.assertTrue(self.magic.update_task_metadata(self.uuid, {'owner': 'fred'})[0])
+		self.assertEqual(self.magic.get_metadata(self.uuid)['owner'], 'fred')
+		self.assertRaises(KeyError, self.magic.update_task_metadata, 'fnord', {'owner': 'fred'})
+		self.assertRaises(ValueError, self.magic.update_task_metadata, self.uuid, {'uuid': 'fnord'})
+		for key in ('_task', '_id', '_unlogged', '_update_token', '_version', '_changes', '_changes_from'):
+			self.assertRaises(ValueError, self.magic.update_task_metadata, self.uuid, {'owner': 'bob', key: 50})
+		self.assertEqual(self.magic.get_metadata(self.uuid)['owner'], 'fred')
+	def test_claim_items(self):
+		claimed = self.magic.claim_items(self.uuid, 'worker1', 5)
+		self.assertEqual([item['name'] for item in claimed], ['wake_up'])
+		self.assertEqual(claimed[0]['owner'], 'worker1')
+		self.assertEqual(claimed[0]['state'], 'IN_PROGRESS')
+		self.assertEqual(self.magic.claim_items(self.uuid, 'worker2'), [])
+		self.assertRaises(ValueError, self.magic.claim_items, self.uuid, 'worker2', 0)
+		self.assertRaises(ValueError, self.magic.claim_items, self.uuid, None)
+	def test_competing_claims(self):
+		other = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		self.assertEqual(len(other.claim_items(self.uuid, 'worker1')), 1)
+		# Losing the race isn't an error, and the winner's claim is seen
+		self.assertEqual(self.magic.claim_items(self.uuid, 'worker2'), [])
+		self.assertEqual(self.ready_names(), set())
+		for name in ('wake_up', 'get_up'):
+			self.magic.update_item(self.uuid, name, {'state': 'COMPLETE'})
+		claimed = []
+		def claim(magic, worker):
+			claimed.extend((item['name'], worker) for item in magic.claim_items(self.uuid, worker, 5))
+		threads = [threading.Thread(target=claim, args=(magic, 'worker%d' % (i,))) for i,magic in enumerate([self.magic, other]*3)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(sorted(name for name,worker in claimed), ['make_breakfast', 'make_coffee'])
+		for name,worker in claimed:
+			self.assertEqual(self.magic.get_item(self.uuid, name)['owner'], worker)
+	def test_update_items(self):
+		results = self.magic.update_items(self.uuid, [('wake_up', {'state': 'COMPLETE'}), ('get_up', {'state': 'COMPLETE', 'onlyif': {'state': 'FAILED'}})])
+		self.assertEqual([result['updated'] for result in results], [True, False])
+		self.assertEqual(self.ready_names(), set(['get_up']))
+		self.assertRaises(ValueError, self.magic.update_items, self.uuid, [('wake_up', {'depends': []})])
+		self.assertRaises(ValueError, self.magic.update_items, self.uuid, [('wake_up', {}), ('wake_up', {})])
+
+	def test_wait_for_ready_to_run(self):
+		self.assertEqual(self.magic.wait_for_ready_to_run(self.uuid, None, 10)[0], 0)
+		version, ready = self.magic.wait_for_ready_to_run(self.uuid, 0, 0.01)
+		self.assertEqual((version, [item['name'] for item in ready]), (0, ['wake_up']))
+		def updates():
+			self.magic.update_task_metadata(self.uuid, {'owner': 'fred'})
+			self.magic.update_item(self.uuid, 'wake_up', {'state': 'COMPLETE'})
+		timer = threading.Timer(0.05, updates)
+		timer.start()
+		version, ready = self.magic.wait_for_ready_to_run(self.uuid, 0, 10)
+		timer.join()
+		self.assertEqual((version, [item['name'] for item in ready]), (2, ['get_up']))
+	def test_reload_items(self):
+		items_file = config.items_file
+		config.items_file = os.path.join(self.tmpdir, 'items.json')
+		try:
+			with open(config.items_file, 'w') as f:
+				json.dump([{'name': 'a', 'depends': ['b']}, {'name': 'b', 'depends': ['a']}], f)
+			catalog = self.magic.catalog
+			status = self.magic.reload_items()
+			self.assertEqual(status['state'], 'failed')
+			self.assertIs(self.magic.catalog, catalog)
+
+			with open(config.items_file, 'w') as f:
+				json.dump([{'name': 'a'}, {'name': 'b', 'depends': ['a']}], f)
+			# Hold on to the reload so that it can't finish before we look
+			background = []
+			self.magic.run_in_background = background.append
+			self.magic.start_reload()
+			self.assertEqual(self.magic.reload_status()['state'], 'reloading')
+			self.assertEqual(background, [self.magic.reload_items])
+			background[0]()
+			self.assertEqual(self.magic.reload_status()['state'], 'loaded')
+		finally:
+			config.items_file = items_file
+		self.assertEqual(sorted(cls.__name__ for cls in self.magic.taskfactory.classes), ['a', 'b'])
+		self.assertEqual(sorted(name for name,description in self.magic.task_converter.classes), ['a', 'b'])
+		self.assertEqual(self.ready_names(), set(['wake_up']))
+		uuid = self.magic.create_task({'requirements': []})['metadata']['uuid']
+		self.assertEqual(set(item['name'] for item in self.magic.ready_to_run(uuid)), set(['a']))
+
+class HttpdTests(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.magic = lib.magic.Magic(store_factory=lambda: core.store.SQLiteStore(os.path.join(self.tmpdir, 'magic.sqlite')))
+		self.uuid = self.magic.create_task({'requirements': ['coffee']})['metadata']['uuid']
+		self.task = lib.httpd.get_cherrypy_root(self.magic).task
+		self.task.waiters.limit = 1
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def test_max_waiters(self):
+		events = self.task.default(self.uuid, 'events')
+		self.assertTrue(next(events).startswith('event: version'))
+		# Nothing else can wait while that's listening
+		try:
+			self.task.default(self.uuid, 'events')
+		except cherrypy.HTTPError as err:
+			self.assertEqual(err.status, 503)
+		else:
+			self.fail('listened for events with too many waiting')
+		start = time.time()
+		self.assertEqual(json.loads(self.task.default(self.uuid, 'available', wait='10', version='0'))[0]['name'], 'wake_up')
+		self.assertTrue(time.time() - start < 5)
+		events.close()
+		self.assertEqual(self.task.waiters.waiting, 0)
+		timer = threading.Timer(0.05, self.magic.update_item, (self.uuid, 'wake_up', {'state': 'COMPLETE'}))
+		timer.start()
+		self.assertEqual(json.loads(self.task.default(self.uuid, 'available', wait='10', version='0'))[0]['name'], 'get_up')
+		timer.join()
+		self.assertEqual(self.task.waiters.waiting, 0)
 
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+
+'''time how the dependency strategies cope with big sets of items
+
+Real sets of items are rarely big enough to show how things will scale,
+so this makes up catalogs of items with the shape we ask for, plans a task
+from them with each dependency strategy, and times every step:
+
+	python -m tools.benchmark --items 100,1000,10000 --fan-in 3 --depth 4
+
+The results are written out as JSON so that they can be kept and
+compared between versions.
+'''
+
+import argparse
+import json
+import platform
+import random
+import signal
+import sys
+import time
+
+import core.deptools
+import lib.loaders
+from core.bits import Task,TaskComplete,CompactTask
+
+strategies = {
+	'digraph': core.deptools.DigraphDependencyStrategy,
+	'graph': core.deptools.GraphDependencyStrategy,
+}
+
+# The steps of planning a task and working out what to run, in order
+steps = ('instantiate_items', 'filter_dependency_graph', 'find_goal_nodes',
+		'make_group_dependencies_explicit_for_items', 'transitive_reduction',
+		'iterate_item_dependencies', 'ready_to_run')
+
+def synthetic_catalog(items, fan_in=2, fan_out=None, depth=0, groups=1, predicate_density=0.0, features=10, seed=0):
+	'''return a list of item dicts in the form that the loaders take
+
+	Items only ever depend on items before them in the list, so there are
+	no cycles. Every item depends on up to fan_in earlier items, and no item
+	is depended on by more than fan_out others (None for no limit).
+
+	There are groups sets of nested groups, each depth groups deep. Each
+	group contains a run of items (and the next group in), depends on items
+	before the run, and is depended on by items after it.
+
+	predicate_density of the items only apply if one of features is
+	in the requirements
+	'''
+	rand = random.Random(seed)
+	names = ['item%d' % (i,) for i in range(items)]
+	catalog = [{'name': name} for name in names]
+	dependents = [0] * items
+	for i,itemdict in enumerate(catalog):
+		candidates = [j for j in rand.sample(xrange(i), min(i, fan_in*2))
+				if fan_out is None or dependents[j] < fan_out][:fan_in]
+		for j in candidates:
+			dependents[j] += 1
+		if candidates:
+			itemdict['depends'] = [names[j] for j in candidates]
+		if rand.random() < predicate_density:
+			itemdict['if'] = 'feature%d' % (rand.randrange(features),)
+
+	for g in range(groups if depth else 0):
+		start, end = sorted(rand.sample(xrange(1, items), 2)) if items > 2 else (0, items)
+		inner = None
+		# Build from the innermost group out, each containing a wider run of items
+		for level in reversed(range(depth)):
+			shrink = (end - start) * level // (2 * depth)
+			first, last = start + shrink, end - shrink
+			groupdict = {'group': 'group%d_%d' % (g, level), 'contains': names[first:last] or [names[first]]}
+			if inner is not None:
+				inside = set(inner['contains'])
+				groupdict['contains'] = [name for name in groupdict['contains'] if name not in inside]
+				groupdict['contains'].append(inner['group'])
+			if first > 0:
+				groupdict['depends'] = [names[rand.randrange(first)]]
+			catalog.append(groupdict)
+			inner = groupdict
+		if end < items:
+			after = catalog[rand.randrange(end, items)]
+			after['depends'] = after.get('depends', []) + [inner['group']]
+	return catalog
+
+def requirements_for(features=10, seed=0):
+	'''return requirements that ask for half of the features'''
+	rand = random.Random(seed)
+	return rand.sample(['feature%d' % (i,) for i in range(features)], features // 2)
+
+class StepTimeout(Exception): pass
+
+def time_step(timings, name, func, *args):
+	'''run func, adding how long it took to timings[name]'''
+	start = time.time()
+	try:
+		result = func(*args)
+	except StepTimeout:
+		raise StepTimeout('took more than the time allowed in '+name)
+	timings.setdefault(name, []).append(time.time() - start)
+	return result
+
+def raise_timeout(signum, frame):
+	raise StepTimeout()
+
+def plan(strategy, classes, requirements, timings, reduce_dependencies=False):
+	'''plan a task the way TaskFactory does, timing each step
+
+	Steps that the strategy doesn't have are done with DigraphDependencyStrategy
+	and not timed.  returns the task
+	'''
+	fallback = core.deptools.DigraphDependencyStrategy
+	def step(name, *args):
+		if getattr(strategy, name, None) is None:
+			timings[name] = None
+			return getattr(fallback, name)(*args)
+		return time_step(timings, name, getattr(strategy, name), *args)
+
+	items = set(step('instantiate_items', classes).values())
+	items = step('filter_dependency_graph', requirements, items)
+	goal = TaskComplete(step('find_goal_nodes', items))
+	items.add(goal)
+	items = step('make_group_dependencies_explicit_for_items', items)
+	if reduce_dependencies:
+		step('transitive_reduction', items)
+	list(step('iterate_item_dependencies', goal))
+	step('ready_to_run', list(items))
+	return Task(list(items), requirements, goal)
+
+def benchmark(catalog, requirements, repeats=3, timeout=None, reduce_dependencies=False):
+	'''time each strategy planning a task from the catalog
+
+	returns a dict of results for each strategy with the best and mean
+	time for each step, or the error if it couldn't be done. If timeout
+	is given, strategies that take longer than that many seconds (over all
+	the repeats) are given up on.
+	'''
+	classes = lib.loaders.ObjectItemLoader.taskfactory_from_objects(catalog).classes
+	results = {}
+	for name, strategy in sorted(strategies.items()):
+		timings = {}
+		if timeout:
+			signal.signal(signal.SIGALRM, raise_timeout)
+			signal.alarm(timeout)
+		try:
+			for repeat in range(repeats):
+				task = plan(strategy, classes, requirements, timings, reduce_dependencies)
+		except (RuntimeError, StepTimeout) as err:
+			# RuntimeErrors are most likely from being too deep for the recursive strategies
+			results[name] = {'error': str(err)}
+			continue
+		finally:
+			signal.alarm(0)
+		result = results[name] = {'task_items': len(task.items), 'task_edges': sum(len(item.depends) for item in task.items)}
+		for step in steps:
+			times = timings.get(step)
+			result[step] = None if times is None else {'best': min(times), 'mean': sum(times) / len(times)}
+
+		# What we actually use to work out what's ready once a task exists
+		manager = time_step(timings, 'manager', core.deptools.TaskDependencyManager, task)
+		time_step(timings, 'manager', manager.ready_to_run)
+		result['task_dependency_manager'] = {'build': timings['manager'][0], 'ready_to_run': timings['manager'][1]}
+
+		# and the same again with the task packed into arrays
+		compact = time_step(timings, 'compact', CompactTask.from_task, task)
+		time_step(timings, 'compact', core.deptools.CompactDependencyStrategy.ready_to_run, compact)
+		time_step(timings, 'compact', core.deptools.CompactDependencyStrategy.find_goal_nodes, compact)
+		result['compact_task'] = {'build': timings['compact'][0], 'ready_to_run': timings['compact'][1],
+				'find_goal_nodes': timings['compact'][2], 'bytes': compact.sizeof()}
+	return results
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='time the dependency strategies with made up sets of items')
+	parser.add_argument('--items', default='100,1000,10000', help='comma separated numbers of items to try (default: %(default)s)')
+	parser.add_argument('--fan-in', type=int, default=2, help='most dependencies for each item (default: %(default)s)')
+	parser.add_argument('--fan-out', type=int, default=None, help='most items that can depend on any one item')
+	parser.add_argument('--depth', type=int, default=3, help='how deep groups are nested (default: %(default)s)')
+	parser.add_argument('--groups', type=int, default=5, help='how many sets of nested groups (default: %(default)s)')
+	parser.add_argument('--predicate-density', type=float, default=0.1, help='fraction of items with a predicate (default: %(default)s)')
+	parser.add_argument('--reduce', action='store_true', help='remove implied dependencies as per reduce_dependencies in config')
+	parser.add_argument('--repeats', type=int, default=3, help='how many times to time each step (default: %(default)s)')
+	parser.add_argument('--timeout', type=int, default=300, help='seconds to give each strategy for each number of items (default: %(default)s)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', '-o', help='file to write the results to instead of stdout')
+	args = parser.parse_args(argv)
+
+	parameters = dict((k, v) for k, v in vars(args).items() if k != 'output')
+	report = {'parameters': parameters, 'python': platform.python_version(), 'runs': []}
+	requirements = requirements_for(seed=args.seed)
+	for items in [int(n) for n in args.items.split(',')]:
+		catalog = synthetic_catalog(items, args.fan_in, args.fan_out, args.depth, args.groups,
+				args.predicate_density, seed=args.seed)
+		print >> sys.stderr, 'timing', items, 'items'
+		report['runs'].append({'items': items, 'strategies': benchmark(catalog, requirements, args.repeats, args.timeout, args.reduce)})
+
+	out = open(args.output, 'w') if args.output else sys.stdout
+	json.dump(report, out, indent=1, sort_keys=True)
+	out.write('\n')
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -26,7 +26,10 @@ this isn't going to pick up most errors, just some of them), but it should
 help pick up some dire ones
 '''
 
+import copy
+
 import core.bits
+import core.deptools
 
 class LintError(Exception): pass
 
@@ -44,16 +47,16 @@ def check_dependencies_are_instances(item):
 	raises LintError unless all members of item.depends are not of type 'type'
 	raises LintError unless all members of item.contents are not of type 'type'
 	'''
-	if type(item) == type:
+	if isinstance(item, type):
 		raise LintError("item is not an instance type",item)
 	for dep in item.depends:
-		if type(dep) == type:
+		if isinstance(dep, type):
 			raise LintError("item dependency is not an instance type",item,dep)
 
 	contains = getattr(item, 'contains', None)
 	if contains is not None:
 		for dep in item.contains:
-			if type(dep) == type:
+			if isinstance(dep, type):
 				raise LintError("group content is not an instance type",item,dep)
 
 
@@ -66,6 +69,43 @@ def check_predicate_returns_boolean(item):
 	if ret is not True and ret is not False:
 		raise LintError('item predicate does not return True or False', item, item.predicate)
 
+def is_group(item):
+	return isinstance(item, core.bits.Group) or isinstance(item, type) and issubclass(item, core.bits.Group)
+
+def check_no_cycles(items):
+	'''raise LintError if the dependencies between items (or item classes) have a cycle
+
+	Groups mustn't contain themselves, at any depth.  The dependencies checked
+	are those that items end up with in a task, where they also depend on
+	everything their groups depend on, and depending on a group means depending
+	on everything in it.  e.g. an item can't depend on a group it's in.
+	'''
+	strategy = core.deptools.SimpleDependencyStrategy
+	groups = set(item for item in items if is_group(item))
+	try:
+		strategy.dependency_order(groups, lambda group: [k for k in group.contains if k in groups])
+	except ValueError:
+		raise LintError('groups contain themselves')
+	# Work on copies, as groups are unrolled INPLACE
+	copies = dict((item, item() if isinstance(item, type) else copy.copy(item)) for item in items)
+	for item in copies.values():
+		item.depends = tuple(map(copies.get, item.depends))
+		if is_group(item):
+			item.contains = tuple(map(copies.get, item.contains))
+	try:
+		strategy.dependency_order(strategy.make_group_dependencies_explicit_for_items(set(copies.values())))
+	except ValueError:
+		raise LintError('item dependencies have a cycle')
+
+def lint_taskfactory(taskfactory):
+	'''check that a TaskFactory's items are fit to make tasks from
+	raises LintError if they aren't
+	'''
+	check_no_cycles(taskfactory.classes)
+	items = core.deptools.SimpleDependencyStrategy.instantiate_items(taskfactory.classes)
+	for item in items.values():
+		check_dependencies_are_instances(item)
+
 if __name__ == "__main__":
 	class TestItem(object):
 		predicate = lambda x: True
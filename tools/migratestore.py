@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+
+'''move tasks from one store into another
+
+The main use of this is to move from the original MongoStore layout,
+which has a collection for every task, into a SharedMongoStore which
+keeps all the tasks in the same collections:
+
+	python -m tools.migratestore mongodb mongodb_shared
+
+Tasks that are already in the destination store are left alone, so it
+is safe to run this again if it gets interrupted.  Unless --delete is
+given, the tasks are left in the source store as well.
+
+Remember to change 'store' in config.py once the tasks are moved.
+'''
+
+import sys
+
+import core.store
+
+def migrate_task(source, destination, uuid, delete=False):
+	'''copy a task from the source store into the destination store
+	returns True iff the task was copied
+	'''
+	if destination.metadata(uuid) is not None:
+		return False
+	metadata = source.metadata(uuid)
+	if metadata is None:
+		return False
+	destination.new_task(uuid, source.items(uuid), metadata)
+	if delete:
+		source.delete_task(uuid)
+	return True
+
+def migrate_store(source, destination, delete=False, verbose=False):
+	'''copy all tasks from the source store into the destination store
+	returns the number of tasks copied
+	'''
+	copied = 0
+	for uuid in source.get_tasks():
+		if migrate_task(source, destination, uuid, delete):
+			copied += 1
+			if verbose: print uuid
+	return copied
+
+if __name__ == '__main__':
+	args = [arg for arg in sys.argv[1:] if arg != '--delete']
+	if len(args) != 2 or args[0] not in core.store.stores or args[1] not in core.store.stores:
+		print >> sys.stderr, sys.argv[0],'[--delete] source destination'
+		print >> sys.stderr, 'where source and destination are one of:',' | '.join(core.store.stores)
+		sys.exit(1)
+	source = core.store.stores[args[0]]()
+	destination = core.store.stores[args[1]]()
+	copied = migrate_store(source, destination, delete='--delete' in sys.argv, verbose=True)
+	print >> sys.stderr, copied,'tasks copied'
@@ -69,6 +69,7 @@ class MonitorTask(ShowStuff):
 	def __init__(self, uuid, interval=1000):
 		self.magic = lib.magic.Magic()
 		self.uuid = uuid
+		self.version = self.magic.get_version(uuid)
 		ShowStuff.__init__(self, self.get_task_tuples(), interval)
 		self.window.set_title("make-magic task: "+uuid)
 
@@ -84,6 +85,11 @@ class MonitorTask(ShowStuff):
 			yield (item['name'], desc, color)
 		
 	def update_stuff(self):
+		# Nothing to do unless the task has changed since we last looked
+		version = self.magic.get_version(self.uuid)
+		if version == self.version:
+			return True
+		self.version = version
 		for k,v,col in self.get_task_tuples():
 			if col:
 				self.set_color(k,col)